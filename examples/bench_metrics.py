@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# Benchmark the cost of metrics on line processing.
+#
+# No connection is made; lines are fed straight into the client, once with
+# metrics disabled and once reporting into a registry.
+
+from irclib.client.client import IRCClient
+from irclib.common.metrics import MetricsRegistry
+
+import time
+
+LINES = 100000
+
+class BenchClient(IRCClient):
+    def log_callback(self, line, recv):
+        pass
+
+    def send(self, data=None):
+        pass
+
+    def timer_oneshot(self, name, time, function):
+        pass
+
+    def timer_repeat(self, name, time, function):
+        pass
+
+
+def bench(name, client, lines):
+    start = time.time()
+    client.process_lines(lines)
+    elapsed = time.time() - start
+    print('{}: {} lines in {:.3f}s'.format(name, len(lines), elapsed))
+
+
+if __name__ == '__main__':
+    registry = MetricsRegistry()
+    clients = [('disabled', BenchClient(host='localhost', port=6667,
+                                        nick='bench')),
+               ('enabled', BenchClient(host='localhost', port=6667,
+                                       nick='bench', metrics=registry))]
+
+    lines = [':nick{0}!user@host PRIVMSG #chan :message {0}'.format(i % 100)
+             for i in range(LINES)]
+
+    for name, client in clients:
+        client.current_nick = 'bench'
+        bench(name, client, lines)
+
+    samples = registry.snapshot()
+    print('dispatch_seconds count: {}'.format(sum(samples[
+        'irclib_dispatch_seconds_count'].values())))
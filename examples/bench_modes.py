@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# Benchmark NAMES processing and mass voicing on a huge channel.
+#
+# No connection is made; lines are fed straight into the client.
+
+from irclib.client.client import IRCClient
+
+import time
+
+MEMBERS = 20000
+VOICES = 5000
+MODES = 4
+
+class BenchClient(IRCClient):
+    def log_callback(self, line, recv):
+        pass
+
+    def send(self, data=None):
+        pass
+
+    def timer_oneshot(self, name, time, function):
+        pass
+
+    def timer_repeat(self, name, time, function):
+        pass
+
+
+def bench(name, client, lines):
+    start = time.time()
+    client.process_lines(lines)
+    elapsed = time.time() - start
+    print('{}: {} lines in {:.3f}s'.format(name, len(lines), elapsed))
+
+
+if __name__ == '__main__':
+    client = BenchClient(host='localhost', port=6667, nick='bench')
+
+    nicks = ['user{}'.format(i) for i in range(MEMBERS)]
+
+    client.process_lines([':server 001 bench :Welcome',
+                          ':bench!bench@localhost JOIN #huge'])
+
+    # NAMES, with every fourth user voiced
+    names = []
+    for i in range(0, MEMBERS, 50):
+        chunk = ['+' + n if (i + j) % 4 == 0 else n
+                 for j, n in enumerate(nicks[i:i+50])]
+        names.append(':server 353 bench = #huge :' + ' '.join(chunk))
+    names.append(':server 366 bench #huge :End of /NAMES list.')
+    bench('NAMES', client, names)
+
+    def modelines(modechar):
+        lines = []
+        for i in range(0, VOICES, MODES):
+            chunk = nicks[i:i+MODES]
+            lines.append(':op!op@localhost MODE #huge {}{} {}'.format(
+                modechar, 'v' * len(chunk), ' '.join(chunk)))
+        return lines
+
+    bench('mass +v', client, modelines('+'))
+    bench('mass -v', client, modelines('-'))
+    bench('mass +b', client, [':op!op@localhost MODE #huge +b *!*@host{}'.format(i)
+                              for i in range(VOICES)])
+    bench('mass -b', client, [':op!op@localhost MODE #huge -b *!*@host{}'.format(i)
+                              for i in range(VOICES)])
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# Benchmark a mass reconnect of SCRAM-SHA-256 SASL clients.
+#
+# A local stand-in server speaks just enough IRC to do CAP and SASL. Every
+# identity is used by several connections. The first round gives every client
+# its own cache (a derivation per connection), the second shares one cold
+# cache, and the third reuses the now warm cache.
+
+from irclib.client.client import IRCClient
+from irclib.client.scram import (ScramKeyCache, scram_keys, scram_parse,
+                                 SCRAM_MECHANISMS)
+
+import base64
+import hashlib
+import hmac
+import os
+import socketserver
+import threading
+import time
+
+IDENTITIES = 20
+CLIENTS = 200
+ITERATIONS = 50000
+MECHANISM = 'SCRAM-SHA-256'
+DIGEST = SCRAM_MECHANISMS[MECHANISM]
+
+# Account -> (salt, StoredKey, ServerKey), as a server would keep them
+ACCOUNTS = dict()
+
+
+class StandInHandler(socketserver.StreamRequestHandler):
+    def send(self, line):
+        self.wfile.write((line + '\r\n').encode('utf-8'))
+
+    def authenticate(self, data):
+        if data == '+':
+            return
+
+        message = base64.b64decode(data).decode('utf-8')
+        if self.scram is None:
+            # Client first
+            bare = message[3:]
+            attrs = scram_parse(bare)
+            salt, stored_key, server_key = ACCOUNTS[attrs['n']]
+            nonce = attrs['r'] + base64.b64encode(os.urandom(9)).decode()
+            first = 'r={},s={},i={}'.format(nonce,
+                                            base64.b64encode(salt).decode(),
+                                            ITERATIONS)
+            self.scram = (attrs['n'], bare, first)
+            self.send('AUTHENTICATE ' +
+                      base64.b64encode(first.encode()).decode())
+            return
+
+        # Client final
+        account, bare, first = self.scram
+        salt, stored_key, server_key = ACCOUNTS[account]
+        without_proof, sep, proof = message.rpartition(',p=')
+        auth = ','.join((bare, first, without_proof)).encode()
+        signature = hmac.new(stored_key, auth, DIGEST).digest()
+        client_key = bytes(a ^ b for a, b in zip(base64.b64decode(proof),
+                                                  signature))
+        if hashlib.new(DIGEST, client_key).digest() != stored_key:
+            self.send(':stand.in 904 * :SASL authentication failed')
+            return
+
+        verifier = hmac.new(server_key, auth, DIGEST).digest()
+        self.send('AUTHENTICATE ' + base64.b64encode(
+            ('v=' + base64.b64encode(verifier).decode()).encode()).decode())
+        self.success = True
+
+    def handle(self):
+        self.scram = None
+        self.success = False
+        nick = '*'
+
+        for raw in self.rfile:
+            line = raw.decode('utf-8').rstrip('\r\n')
+            command, sep, rest = line.partition(' ')
+            if command == 'CAP':
+                sub = rest.split()[0]
+                if sub == 'LS':
+                    self.send(':stand.in CAP * LS :sasl')
+                elif sub == 'REQ':
+                    self.send(':stand.in CAP * ACK :sasl')
+            elif command == 'AUTHENTICATE':
+                if rest == MECHANISM:
+                    self.send('AUTHENTICATE +')
+                elif rest == '+' and self.success:
+                    self.send(':stand.in 903 {} :SASL successful'.format(nick))
+                else:
+                    self.authenticate(rest)
+            elif command == 'NICK':
+                nick = rest
+            elif command == 'CAP' or command == 'USER':
+                pass
+
+            if command == 'CAP' and rest.startswith('END'):
+                self.send(':stand.in 001 {} :Welcome'.format(nick))
+                return
+
+
+class BenchClient(IRCClient):
+    def log_callback(self, line, recv):
+        pass
+
+
+def connect_one(index, port, cache, results):
+    account = 'user{}'.format(index % IDENTITIES)
+    client = BenchClient(host='127.0.0.1', port=port,
+                         nick='bench{}'.format(index), use_starttls=False,
+                         use_sts=False, sasl_username=account,
+                         sasl_pw='password-' + account,
+                         sasl_mechanism=MECHANISM,
+                         scram_cache=cache or ScramKeyCache(workers=1))
+
+    try:
+        for line in client.get_lines():
+            if line.command == '001':
+                break
+    except Exception as e:
+        results.append((False, str(e)))
+    else:
+        results.append((client.identified, None))
+    finally:
+        try:
+            client.timer_cancel_all()
+        except ValueError:
+            pass
+        client.disconnect()
+
+
+def reconnect_all(port, cache):
+    results = []
+    threads = [threading.Thread(target=connect_one,
+                                args=(i, port, cache, results))
+               for i in range(CLIENTS)]
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return time.time() - start, results
+
+
+if __name__ == '__main__':
+
+    for i in range(IDENTITIES):
+        account = 'user{}'.format(i)
+        salt = os.urandom(16)
+        client_key, server_key = scram_keys(DIGEST,
+                                            ('password-' + account).encode(),
+                                            salt, ITERATIONS)
+        ACCOUNTS[account] = (salt, hashlib.new(DIGEST, client_key).digest(),
+                             server_key)
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    port = server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    shared = ScramKeyCache()
+    for name, cache in (('uncached', None), ('cold', shared),
+                        ('warm', shared)):
+        elapsed, results = reconnect_all(port, cache)
+        ok = sum(1 for success, error in results if success)
+        print('{}: {} clients ({} identities, {} iterations) in {:.3f}s, '
+              '{} authenticated; cache {}'.format(
+                  name, CLIENTS, IDENTITIES, ITERATIONS, elapsed, ok,
+                  cache.metrics() if cache is not None else '-'))
+
+    server.shutdown()
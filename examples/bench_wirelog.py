@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# Benchmark wire logging on the line processing path.
+#
+# No connection is made; lines are fed straight into the client. Output goes
+# to /dev/null. "copying" is the old way (deepcopy, colour replacement and a
+# print for every line), for comparison.
+
+from irclib.client.client import IRCClient
+from irclib.common.colourmap import replace_colours
+from irclib.common.wirelog import WireLogger
+
+from copy import deepcopy
+
+import logging
+import os
+import time
+
+LINES = 100000
+
+class BenchClient(IRCClient):
+    def send(self, data=None):
+        pass
+
+    def timer_oneshot(self, name, time, function):
+        pass
+
+    def timer_repeat(self, name, time, function):
+        pass
+
+
+class CopyingClient(BenchClient):
+    def log_callback(self, line, recv):
+        line = deepcopy(line)
+        if line.command in ('PRIVMSG', 'NOTICE'):
+            line.params[-1] = replace_colours(line.params[-1])
+
+        print('{} {}'.format('>' if recv else '<', line), end='',
+              file=self.devnull)
+
+
+def bench(name, client, lines):
+    start = time.time()
+    client.process_lines(lines)
+    elapsed = time.time() - start
+    print('{}: {} lines in {:.3f}s'.format(name, len(lines), elapsed))
+
+
+if __name__ == '__main__':
+    devnull = open(os.devnull, 'w')
+    handler = logging.StreamHandler(devnull)
+
+    def wire_logger(name):
+        return WireLogger(logging.getLogger('bench.' + name),
+                          handlers=(handler,), queue_size=LINES)
+
+    off = wire_logger('off')
+    off.logger.setLevel(logging.WARNING)
+
+    copying = CopyingClient(host='localhost', port=6667, nick='bench')
+    copying.devnull = devnull
+
+    clients = [
+        ('copying', copying),
+        ('off', BenchClient(host='localhost', port=6667, nick='bench',
+                            wire_log=off)),
+        ('queued', BenchClient(host='localhost', port=6667, nick='bench',
+                               wire_log=wire_logger('queued'))),
+        ('sampled 1/10', BenchClient(host='localhost', port=6667,
+                                     nick='bench',
+                                     wire_log=wire_logger('sampled'),
+                                     wire_sample={'PRIVMSG' : 10})),
+    ]
+
+    lines = [':nick{0}!user@host PRIVMSG #chan :\x02message\x02 {0}'.format(
+        i % 100) for i in range(LINES)]
+
+    for name, client in clients:
+        client.current_nick = 'bench'
+        bench(name, client, lines)
+        if client.wire_log:
+            client.wire_log.stop()
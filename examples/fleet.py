@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+from irclib.client.fleet import Fleet
+
+import logging
+
+# Set log level
+logging.basicConfig(level=logging.INFO)
+
+if __name__ == '__main__':
+    fleet = Fleet(event_commands=('PRIVMSG',))
+
+    for i in range(16):
+        fleet.add(nick='Vorpel{}'.format(i), host='okami.interlinked.me',
+                  port=6667, channels=['#irclib'])
+
+    fleet.start()
+
+    try:
+        for name, kind, data in fleet.events():
+            if kind != 'line':
+                print(name, kind, data)
+            elif 'vorpel' in data.lower():
+                fleet.send(name, 'PRIVMSG', ('#irclib', 'Yes?'))
+    finally:
+        fleet.stop()
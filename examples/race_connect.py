@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+#
+# Exercise race_connect against local listeners.
+#
+# Each "address" is a listener on localhost; the connector sleeps before
+# connecting to give each one an artificial delay, and a closed port stands in
+# for an address that refuses connections.
+
+from irclib.client.connect import LatencyTable, connect_address, race_connect
+
+import socket
+import time
+
+STAGGER = 0.25
+
+
+def listener():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(8)
+    return sock
+
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+""" A connector delaying each port by delays[port], recording attempts """
+def delayed_connector(delays, attempts):
+    def connector(family, sockaddr, timeout):
+        attempts.append(sockaddr[1])
+        time.sleep(delays.get(sockaddr[1], 0))
+        return connect_address(family, sockaddr, timeout)
+
+    return connector
+
+
+def race(name, addresses, delays, latency=None):
+    attempts = []
+    start = time.time()
+    sock = race_connect(addresses, 5, STAGGER, latency,
+                        delayed_connector(delays, attempts))
+    elapsed = time.time() - start
+    port = sock.getpeername()[1]
+    sock.close()
+
+    print('{}: port {} won in {:.3f}s (attempts: {})'.format(
+        name, port, elapsed, attempts))
+    return port, elapsed, attempts
+
+
+if __name__ == '__main__':
+    listeners = [listener() for i in range(2)]
+    slow, fast = [l.getsockname()[1] for l in listeners]
+    refused = closed_port()
+
+    def address(port):
+        return (socket.AF_INET, ('127.0.0.1', port))
+
+    # The slow address is tried first, but the next attempt starts after the
+    # stagger and wins long before the slow one would have
+    port, elapsed, attempts = race('stagger', [address(slow), address(fast)],
+                                   {slow : 2})
+    assert port == fast and STAGGER <= elapsed < 1, (port, elapsed)
+
+    # A refused address doesn't hold things up for the stagger; the next
+    # attempt starts straight away, and the first to connect is used
+    port, elapsed, attempts = race('refused', [address(refused),
+                                               address(fast)], {})
+    assert port == fast and elapsed < STAGGER, (port, elapsed)
+
+    # Once connect times are known, the fast address goes first, even though
+    # it is listed last
+    latency = LatencyTable()
+    race('learn', [address(slow), address(fast)], {slow : 0.5}, latency)
+    port, elapsed, attempts = race('prefer', [address(slow), address(fast)],
+                                   {slow : 0.5}, latency)
+    assert attempts[0] == fast and elapsed < STAGGER, attempts
+
+    for l in listeners:
+        l.close()
+
+    print('All races behaved')
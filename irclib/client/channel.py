@@ -1,23 +1,41 @@
 #!/usr/bin/env python3
 
-import weakref
-from irclib.common.modes import ModeSet
+from irclib.common.modes import ModeSet, MODE_LIST
+from irclib.common.casemap import CaseFoldWeakValueDict
+from irclib.common.maskmatch import MaskIndex, users_matching
 
 class Channel(object):
     def __init__(self, network, name):
+        self.network = network
         self.name = name
 
-        self.users = weakref.WeakValueDictionary()
+        # Tracking profile level
+        self.tracking = network.tracking_for(name)
 
-        # Gather these from ISUPPORT
-        # Note there is a race here - if you instantiate this, and ISUPPORT is
-        # not in yet, you WILL get incorrect modes until you update this. YOU
-        # HAVE BEEN WARNED.
-        p_prefix = ''.join(p[0] for p in network.isupport['PREFIX'])
-        p_list, p_set, p_both, = network.isupport['CHANMODES'][:3]
+        self._users = CaseFoldWeakValueDict(network.casemap)
 
-        self.modes = ModeSet(p_list=p_list, p_set=p_set, p_both=p_both,
-                             p_prefix=p_prefix)
+        # Shared mode definitions from ISUPPORT; the client rebinds these if
+        # ISUPPORT changes.
+        self._modes = ModeSet(spec=network.chanmode_spec,
+                              casemap=network.casemap)
+
+        # NAMES payloads being collected until RPL_ENDOFNAMES
+        self.names_buffer = []
+
+        # NAMES entries not yet turned into users (lazy NAMES), by folded nick
+        self.names_raw = dict()
+
+        # List mode -> MaskIndex, built on demand
+        self.masks = dict()
+
+        # List modes whose contents we know in full
+        self.list_synced = set()
+
+        # List mode -> mask -> (setter, time)
+        self.list_info = dict()
+
+        # List replies being collected, list mode -> mask -> (setter, time)
+        self.list_pending = dict()
 
         # Are we parting the channel?
         self.parting = False
@@ -31,17 +49,127 @@ class Channel(object):
         self.topic_time = None
 
 
+    """ Create users from stored NAMES entries, if any """
+    def materialize(self):
+        if not self.names_raw:
+            return
+
+        raw = self.names_raw
+        self.names_raw = dict()
+        self.network.apply_names(self, raw.values())
+
+
+    """ Create the user for one stored NAMES entry, if there is one """
+    def materialize_nick(self, nick):
+        token = self.names_raw.pop(self.network.casemap.fold(nick), None)
+        if token is not None:
+            self.network.apply_names(self, (token,))
+
+
+    @property
+    def users(self):
+        if self.names_raw:
+            self.materialize()
+
+        return self._users
+
+
+    @property
+    def modes(self):
+        if self.names_raw:
+            self.materialize()
+
+        return self._modes
+
+
+    # These leave other stored NAMES entries be
+
     def user_add(self, nick, user):
-        self.users[nick] = user
+        if self.names_raw:
+            self.names_raw.pop(self.network.casemap.fold(nick), None)
+
+        self._users[nick] = user
+
+
+    """ Add status modes (e.g. from NAMES) for a member """
+    def status_add(self, nick, modes):
+        prefix_bits = self._modes.spec.prefix_bits
+        for mode in modes:
+            if mode in prefix_bits:
+                self._modes.add_listmode(mode, nick)
 
 
     def user_del(self, nick):
-        self.users.pop(nick, None)
+        if self.names_raw:
+            self.names_raw.pop(self.network.casemap.fold(nick), None)
+
+        self._users.pop(nick, None)
+        self._modes.prefix_remove(nick)
 
 
     def user_rename(self, oldnick, newnick):
-        user = self.users.pop(oldnick, None)
+        if self.names_raw:
+            self.materialize_nick(oldnick)
+
+        user = self._users.pop(oldnick, None)
         if not user: return
 
-        self.users[newnick] = user
+        self._users[newnick] = user
+        self._modes.prefix_rename(oldnick, newnick)
+
+
+    """ Get the MaskIndex for a list mode, building it if needed """
+    def mask_index(self, mode='b'):
+        index = self.masks.get(mode, None)
+        if index is None:
+            if self.modes.spec.classify(mode) != MODE_LIST:
+                raise ValueError('Not a list mode: {}'.format(mode))
+
+            index = MaskIndex(self.network.casemap, self.network.extban())
+            for mask in self.modes.is_set(mode):
+                index.add(mask)
+
+            self.masks[mode] = index
+
+        return index
+
+
+    """ Keep mask indexes current from a list of mode changes """
+    def update_masks(self, changes):
+        for adding, mode, param in changes:
+            index = self.masks.get(mode, None)
+            if index is None:
+                continue
+
+            if adding:
+                index.add(param)
+            else:
+                index.remove(param)
+
+
+    """ Drop mask indexes (e.g. when case mapping changes) """
+    def reset_masks(self):
+        self.masks.clear()
+
+
+    """ Get the masks in a list mode that match a user """
+    def match_user(self, user, mode='b'):
+        return self.mask_index(mode).match(user)
+
+
+    """ Check if a user is banned, taking exceptions into account """
+    def is_banned(self, user):
+        if not self.mask_index('b').matches(user):
+            return False
+
+        if 'e' in self.network.chanmode_spec.p_list:
+            if self.mask_index('e').matches(user):
+                return False
+
+        return True
+
 
+    """ Get the users in this channel a mask matches """
+    def users_matching(self, mask):
+        return users_matching(mask, self.users.values(), self.network.casemap,
+                              self.network.extban())
@@ -2,26 +2,41 @@
 
 from __future__ import unicode_literals, print_function, division
 
-import sys
-import codecs
 import importlib
 import logging
 
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
 from functools import partial
 from random import randint
-from copy import deepcopy
+from collections import deque, OrderedDict
+from threading import RLock
+from concurrent.futures import Future
+from socket import error as SocketError
 
 from irclib.client.user import User
 from irclib.client.channel import Channel
 from irclib.client.network import IRCClientNetwork
-from irclib.common.modes import ModeSet
+from irclib.client.sts import STSPolicyStore, parse_sts_value
+from irclib.client.usercache import StrangerCache
+from irclib.client.netsplit import Split
+from irclib.client.history import HistoryTracker, HistoryFetch
+from irclib.client.metrics import ClientMetrics
+from irclib.client.scram import SCRAM_MECHANISMS
+from irclib.client.request import Request, RequestTracker, reply_spec
+from irclib.client.tracking import (TrackingPolicy, TRACK_CHANNELS,
+                                    TRACK_MEMBERSHIP, TRACK_FULL)
+from irclib.common.modes import ModeSet, ModeSpec, pack_mode_changes
+from irclib.common.casemap import CaseMapping, CaseFoldDict
+from irclib.common.maskmatch import users_matching
+from irclib.common.metrics import RollingHistogram
 from irclib.common.six import u, b
-from irclib.common.colourmap import replace_colours
-
-try:
-    from queue import Queue
-except ImportError:
-    from Queue import Queue
+from irclib.common.wirelog import default_wire_logger
+from irclib.common.util import parse_server_time
+from irclib.common.numerics import RPL_WHOISUSER, RPL_WHOISLOGGEDIN
 
 
 """ Basic IRC client class. """
@@ -38,13 +53,66 @@ class IRCClient(IRCClientNetwork):
     version - CTCP version reply
     use_ssl - use SSL (default False)
     use_starttls - use STARTTLS where available (default True)
+    ssl_verify - verify the server's certificate and hostname (default False;
+                 always done for connections made because of STS)
     password - server passwrod
     default_channels - default places to join
     channel_keys - key:value pair of channel keys
     keepalive - interval to send keepalive pings (for lagcheck etc.)
+    lag_probes - lag probes (PINGs) allowed in flight at once (default 3)
+    lag_timeout - seconds before an unanswered probe times out the
+                  connection (default keepalive * lag_probes)
+    latency_window - samples kept for latency percentiles (default 1024)
     use_cap - use CAP
+    sasl_username - SASL account name
+    sasl_pw - SASL password
+    sasl_mechanism - PLAIN (default), SCRAM-SHA-256, or SCRAM-SHA-1
+    scram_cache - ScramKeyCache for derived SCRAM keys (default is shared)
     kick_autorejoin - rejoin on kick
     kick_wait - wait time for rejoin (5 seconds default)
+    use_sts - honour IRCv3 STS policies (default True)
+    sts_policy_file - file to persist STS policies in (default None)
+    sts_store - STSPolicyStore instance to use (overrides sts_policy_file)
+    connect_race - race connections to all of host's addresses (default False)
+    connect_stagger - delay between starting connection attempts (0.25s)
+    address_ttl - time to cache resolved addresses for (300 seconds)
+    address_cache - AddressCache instance to use (overrides address_ttl)
+    connect_latency - LatencyTable to prefer fast addresses with (optional)
+    names_lazy - keep NAMES replies raw until the member list is used
+    tracking - state tracking profile: 'full' (default), 'membership-only',
+               'channels-only', or 'none'
+    channel_tracking - list of (channel glob, profile) overriding tracking
+    stranger_expiry - how to expire users who share no channels with us:
+                      'lru' (default) to keep a bounded cache, or 'monitor'
+                      to poll them with MONITOR/ISON
+    stranger_cache_size - maximum users kept in the 'lru' cache (1024)
+    stranger_ttl - seconds a user is kept in the 'lru' cache (900)
+    split_detect - spot netsplits from QUIT reasons when there's no BATCH,
+                   and keep split users around for when they return (True)
+    split_timeout - seconds to keep split users for (600)
+    split_settle - seconds without rejoins before a netsplit is considered
+                   over (10)
+    whois_ttl - seconds client.whois results are reused for (300)
+    whois_cache_size - WHOIS results kept for untracked users (1024)
+    request_timeout - default seconds to wait for replies to request() (30)
+    history_fill - on rejoining a channel after a reconnect, fetch what was
+                   missed with draft/chathistory or znc.in/playback (False)
+    history_concurrency - channels fetched at once (default 3)
+    history_limit - messages asked for per CHATHISTORY request (100)
+    history_timeout - seconds to wait for a history fetch (30)
+    history_dedupe - recent messages per channel remembered, to drop
+                     repeats in history (1000)
+    pace_burst - lines sent at once by write_paced (default 4)
+    pace_interval - seconds between write_paced bursts (default 2)
+    wire_log - WireLogger to log lines through (default one shared, writing
+               to stdout), or False for none; see irclib.common.wirelog
+    wire_sample - dict of command: n, to log only one in n of those lines
+    metrics - MetricsRegistry to report into (default None, disabled); see
+              irclib.common.metrics.MetricsServer to export it
+    metrics_name - client label for this client's metrics (host:port)
+    line_filter - LineFilter to drop uninteresting lines before parsing
+    pipelined - read, dispatch and write in separate threads (default False)
+    pipeline_queue_size - bound on each pipeline hand-off queue (1024)
     """
     def __init__(self, **kwargs):
         IRCClientNetwork.__init__(self, **kwargs)
@@ -58,13 +126,46 @@ class IRCClient(IRCClientNetwork):
         self.default_channels = kwargs.get('channels', [])
         self.channel_keys = kwargs.get('channel_keys', {})
         self.keepalive = kwargs.get('keepalive', 60)
+        self.lag_probes = kwargs.get('lag_probes', 3)
+        self.lag_timeout = kwargs.get('lag_timeout', None)
+        self.latency_window = kwargs.get('latency_window', 1024)
         self.use_cap = kwargs.get('use_cap', True)
         self.use_sasl = kwargs.get('use_sasl', False)
         self.sasl_username = kwargs.get('sasl_username', None)
         self.sasl_pw = kwargs.get('sasl_pw', None)
+        self.sasl_mechanism = kwargs.get('sasl_mechanism', 'PLAIN').upper()
+        self.scram_cache = kwargs.get('scram_cache', None)
         self.autorejoin = kwargs.get('kick_autorejoin', False)
         self.autorejoin_wait = kwargs.get('kick_wait', 5)
         self.custom_dispatch = kwargs.get('custom_dispatch', [])
+        self.names_lazy = kwargs.get('names_lazy', False)
+        self.split_detect = kwargs.get('split_detect', True)
+        self.split_timeout = kwargs.get('split_timeout', 600)
+        self.split_settle = kwargs.get('split_settle', 10)
+        self.wire_log = kwargs.get('wire_log', None)
+        self.wire_sample = kwargs.get('wire_sample', None)
+        self._wire_counts = dict()
+        self.history_fill = kwargs.get('history_fill', False)
+        self.history_concurrency = kwargs.get('history_concurrency', 3)
+        self.history_limit = kwargs.get('history_limit', 100)
+        self.history_timeout = kwargs.get('history_timeout', 30)
+        self.pace_burst = kwargs.get('pace_burst', 4)
+        self.pace_interval = kwargs.get('pace_interval', 2)
+        self.use_sts = kwargs.get('use_sts', True)
+        self.sts_store = kwargs.get('sts_store', None)
+
+        if self.wire_log is None:
+            self.wire_log = default_wire_logger()
+
+        if self.lag_timeout is None:
+            self.lag_timeout = self.keepalive * self.lag_probes
+
+        if self.use_sts and self.sts_store is None:
+            self.sts_store = STSPolicyStore(kwargs.get('sts_policy_file', None))
+
+        if self.sasl_mechanism not in ('PLAIN',) + tuple(SCRAM_MECHANISMS):
+            raise ValueError('Unsupported SASL mechanism: '
+                             '{}'.format(self.sasl_mechanism))
 
         if self.use_sasl and (not self.sasl_pw or not self.sasl_username):
             self.logger.warn("Unable to use SASL, no username/password provided")
@@ -79,7 +180,54 @@ class IRCClient(IRCClientNetwork):
 
         self.pending_channels = set()
         self.isupport = dict()
-        self._whox_pending = set()
+        self.casemap = CaseMapping()
+        if self.line_filter is not None:
+            self.line_filter.casemap = self.casemap
+            self.line_filter.compile()
+
+        self.tracking = TrackingPolicy(kwargs.get('tracking', 'full'),
+                                       kwargs.get('channel_tracking', ()),
+                                       self.casemap)
+
+        self.stranger_expiry = kwargs.get('stranger_expiry', 'lru')
+        if self.stranger_expiry not in ('lru', 'monitor'):
+            raise ValueError('Unknown stranger_expiry: '
+                             '{}'.format(self.stranger_expiry))
+
+        self.strangers = StrangerCache(self.evict_stranger,
+                                       kwargs.get('stranger_cache_size', 1024),
+                                       kwargs.get('stranger_ttl', 900),
+                                       self.casemap)
+
+        # Paced output
+        self._paced = deque()
+        self._pacing = False
+        self._pacelock = RLock()
+        self._whox_pending = dict()
+
+        # Channel history marks, kept across reconnects
+        self.history = HistoryTracker(self.casemap,
+                                      kwargs.get('history_dedupe', 1000))
+
+        # Latency measurement
+        self._latencylock = RLock()
+        self._probe_count = 0
+
+        # Requests awaiting replies
+        self.requests = RequestTracker(self.casemap)
+        self.request_timeout = kwargs.get('request_timeout', 30)
+
+        # WHOIS requests in flight, by nick
+        self.whois_ttl = kwargs.get('whois_ttl', 300)
+        self.whois_cache_size = kwargs.get('whois_cache_size', 1024)
+        self._whois_inflight = CaseFoldDict(self.casemap)
+
+        # WHOIS results for users we don't otherwise track
+        self._whois_cache = CaseFoldDict(self.casemap)
+
+        # Go straight to TLS if we already know a policy; this also means we
+        # don't bother with STARTTLS at all.
+        self.apply_sts_policy()
 
         # Default handlers
         self.default_dispatch()
@@ -87,34 +235,53 @@ class IRCClient(IRCClientNetwork):
         # Set everything up
         self.reset()
 
-        # Fix printing Unicode on the screen
-        if sys.stdout.encoding != "UTF-8":
-            sys.stdout = codecs.getwriter('utf8')(sys.stdout)
+        # Metrics, if wanted
+        self._connections = 0
+        registry = kwargs.get('metrics', None)
+        if registry is not None:
+            self.metrics = ClientMetrics(self, registry,
+                                         kwargs.get('metrics_name', None))
+
 
+    """ Logging callback
 
-    """ Logging callback """
+    Lines go to wire_log, which formats them from their wire text in its own
+    thread. Nothing is done if it's off.
+    """
     def log_callback(self, line, recv):
-        if recv:
-            ch = '>'
-        else:
-            ch = '<'
+        wire_log = self.wire_log
+        if not wire_log or not wire_log.enabled():
+            return
 
-        line = deepcopy(line)
-        # special formatters
-        if line.command in ('PRIVMSG', 'NOTICE'):
-            line.params[-1] = replace_colours(line.params[-1])
+        if self.wire_sample:
+            every = self.wire_sample.get(line.command, None)
+            if every:
+                counts = self._wire_counts
+                count = counts.get(line.command, 0)
+                counts[line.command] = count + 1
+                if count % every:
+                    return
 
-        print('{} {}'.format(ch, line), end='')
+        wire_log.log(line, line.raw, recv)
 
 
     """ Generator for IRC lines, e.g. non-terminating stream """
     def get_lines(self):
         while True:
             try:
-                for l in self.process_in():
+                if self.pipelined:
+                    lines = self.process_pipelined()
+                else:
+                    lines = self.process_in()
+
+                for l in lines:
                     line = (yield l)
                     if line is not None:
                         self.linewrite(line)
+
+                    if self.reconnect_requested:
+                        # Reconnect before reading anything more
+                        break
             except:
                 try:
                     self.timer_cancel_all()
@@ -129,10 +296,28 @@ class IRCClient(IRCClientNetwork):
     """
     def default_dispatch(self):
         # Default list of dispatchers
-        dispatchers = ['account', 'away', 'introspect', 'isupport', 'join',
+        dispatchers = ['account', 'away', 'banlist', 'batch', 'introspect',
+                       'isupport', 'join', 'latency',
                        'mode', 'monitor', 'names', 'nick', 'part', 'pingpong',
                        'privmsg', 'quit', 'topic', 'welcome', 'who', 'whois']
 
+        # Leave out what no channel's tracking profile needs
+        level = self.tracking.max_level()
+        skip = set()
+        if level < TRACK_FULL:
+            skip.update(('account', 'away', 'monitor', 'who'))
+        if self.stranger_expiry != 'monitor':
+            skip.add('monitor')
+        if level < TRACK_MEMBERSHIP:
+            skip.add('names')
+        if level < TRACK_CHANNELS:
+            skip.update(('banlist', 'topic'))
+
+        dispatchers = [d for d in dispatchers if d not in skip]
+
+        if self.history_fill:
+            dispatchers.append('history')
+
         if self.use_starttls:
             dispatchers.append('starttls')
             self.use_cap = True
@@ -142,12 +327,22 @@ class IRCClient(IRCClientNetwork):
             self.use_cap = True
 
         # CAP state
+        self.cap_req = set()
         if self.use_cap:
             dispatchers.append('cap')
 
             # Capabilities
-            self.cap_req = {'multi-prefix', 'account-notify', 'away-notify',
-                            'away-notify', 'extended-join'}
+            self.cap_req.update(('cap-notify', 'batch', 'labeled-response',
+                                 'server-time'))
+            if level >= TRACK_MEMBERSHIP:
+                self.cap_req.update(('multi-prefix', 'userhost-in-names'))
+            if level >= TRACK_FULL:
+                self.cap_req.update(('account-notify', 'away-notify',
+                                     'extended-join'))
+
+            if self.history_fill:
+                self.cap_req.update(('draft/chathistory', 'znc.in/playback',
+                                     'message-tags'))
 
             if self.use_starttls:
                 self.cap_req.add('tls')
@@ -169,6 +364,14 @@ class IRCClient(IRCClientNetwork):
                 for hook in imp.hooks_ctcp_in:
                     self.add_ctcp_in(*hook)
 
+            if hasattr(imp, 'hooks_batch'):
+                for hook in imp.hooks_batch:
+                    self.add_batch(*hook)
+
+            if hasattr(imp, 'hooks_event'):
+                for hook in imp.hooks_event:
+                    self.add_event(*hook)
+
         # Begin the imports
         for module in dispatchers:
             # Ergh I'd like it to use a relative import.
@@ -195,7 +398,11 @@ class IRCClient(IRCClientNetwork):
         self.pending_channels.clear() 
 
         # Reset caps
-        self.supported_cap = []
+        self.supported_cap = set()
+        self.cap_values = dict()
+        self.cap_pending = set()
+        self.cap_refused = set()
+        self.cap_listed = False
         self.cap_end = False
 
         # Reset ISUPPORT
@@ -208,9 +415,20 @@ class IRCClient(IRCClientNetwork):
         # Not sure if this is correct but it's good enough
         self.isupport['CHANMODES'] = ['beI', 'k', 'l', 'imntsp']
        
+        # No CASEMAPPING means rfc1459; what outlives the connection is
+        # folded again
+        self.casemap.set('rfc1459')
+        self.tracking.compile()
+        if self.line_filter is not None:
+            self.line_filter.compile()
+        self.history.rekey()
+
         # Map prefix to mode
         self.prefix_to_mode = {s:m for m,s in self.isupport['PREFIX']}
 
+        # Channel mode definitions
+        self.chanmode_spec = ModeSpec.from_isupport(self.isupport)
+
         # Handshaken?
         self.handshake = False
 
@@ -220,9 +438,27 @@ class IRCClient(IRCClientNetwork):
         # Identified?
         self.identified = False
 
+        # SASL exchange state
+        self.sasl_buffer = []
+        self.sasl_state = None
+
         # Lag stats
-        self._last_pingstr = None
-        self._last_pingtime = 0
+        with self._latencylock:
+            # Token -> [queued, sent] monotonic times, oldest first
+            self._probes = OrderedDict()
+
+            # Messages awaiting echo-message, as
+            # (command, folded target, text, monotonic, wall clock)
+            self._echoes = deque(maxlen=256)
+
+            # rtt - PING round trip, from when it hit the wire
+            # queue - time PINGs spent queued behind paced output
+            # echo - round trip of our messages, with echo-message
+            # delivery - time from sending a message to the server's
+            #            server-time stamp on its echo (includes clock skew)
+            self.latency = {name : RollingHistogram(self.latency_window)
+                            for name in ('rtt', 'queue', 'echo', 'delivery')}
+
         self.lag = 0
 
         # Nick trials
@@ -233,11 +469,34 @@ class IRCClient(IRCClientNetwork):
         if hasattr(self, '_msg_last'):
             del self._msg_last
 
+        # Paced output
+        with self._pacelock:
+            self._paced.clear()
+            self._pacing = False
+
+        # Outstanding list mode fetches
+        if hasattr(self, '_list_fetches'):
+            for future in self._list_fetches.values():
+                future.set_exception(IOError('Connection reset'))
+        self._list_fetches = dict()
+
+        # Channel commands awaiting a possible 482, by channel
+        self._chanop_sent = CaseFoldDict(self.casemap)
+
+        # History fetches die with the connection
+        self.history.clear_fetches()
+
+        # Open batches
+        self.batches.clear()
+
         # Pending WHOX replies
         self._whox_pending.clear()
 
-        # ISON list pending
-        self._ison_list = Queue()
+        # Requests in flight
+        self.requests.fail_all(IOError('Connection reset'))
+        self._request_timer = False
+        self._whois_inflight.clear()
+        self._whois_cache.clear()
 
         try:
             # Cancel all outstanding timers
@@ -245,9 +504,16 @@ class IRCClient(IRCClientNetwork):
         except ValueError:
             pass
 
+        # Users in the stranger cache are dropped with the rest
+        self.strangers.clear()
+
+        # Netsplits in progress, by (server, server), and their users
+        self.splits = dict()
+        self.split_nicks = CaseFoldDict(self.casemap)
+
         # Authoriative
-        self.channels = dict()
-        self.users = dict()
+        self.channels = CaseFoldDict(self.casemap)
+        self.users = CaseFoldDict(self.casemap)
 
         # Our own stuff
         self.current_nick = None
@@ -269,18 +535,31 @@ class IRCClient(IRCClientNetwork):
             if self.cap_end:
                 return
 
-            # End of CAP if we're not using SASL
-            if self.use_cap and not self.use_sasl:
-                self.cap_terminate()
-            elif self.use_sasl and 'sasl' in self.supported_cap:
-                self.cmdwrite('AUTHENTICATE', ['PLAIN'])
+            if self.use_sasl and 'sasl' in self.supported_cap:
+                # CAP 302 servers list their mechanisms
+                mechanisms = self.cap_values.get('sasl', None)
+                if mechanisms and self.sasl_mechanism not in \
+                        mechanisms.split(','):
+                    self.logger.warn('SASL mechanism {} not offered by server '
+                                     '(has {})'.format(self.sasl_mechanism,
+                                                       mechanisms))
+                    self.cap_terminate()
+                    return
+
+                self.cmdwrite('AUTHENTICATE', [self.sasl_mechanism])
 
                 # Abort SASL after some time
                 self.timer_oneshot('cap_terminate', 15, self.cap_terminate)
+            elif self.use_cap:
+                # End of CAP if we're not doing SASL
+                self.cap_terminate()
 
 
     """ Start initial handshake """
     def connect(self, timeout=10):
+        if not self.connected:
+            self.apply_sts_policy()
+
         IRCClientNetwork.connect(self, timeout)
 
         self.do_handshake()
@@ -292,12 +571,17 @@ class IRCClient(IRCClientNetwork):
             return
 
         self.handshake = True
+
+        self._connections += 1
+        if self.metrics is not None:
+            self.metrics.connected(self._connections == 1)
+
         if not self.use_cap:
             # Not using CAP :(
             self.dispatch_register()
         elif self.use_cap:
-            # Request caps
-            self.cmdwrite('CAP', ['LS'])
+            # Request caps (302 for cap values, needed for STS)
+            self.cmdwrite('CAP', ['LS', '302'])
 
             # Cancel CAP after some time
             self.timer_oneshot('cap_terminate', 10, self.cap_terminate)
@@ -313,37 +597,500 @@ class IRCClient(IRCClientNetwork):
         self.dispatch_register()
 
 
+    """ Caps we want which the server offers, but we haven't asked for """
+    def cap_wanted(self):
+        return ((self.cap_req & set(self.cap_values)) - self.supported_cap -
+                self.cap_pending - self.cap_refused)
+
+
+    """ Send CAP REQ for some caps, split to fit in lines
+
+    Each line is ACK'd or NAK'd as a whole, so this is safe.
+    """
+    def cap_send_req(self, caps):
+        # Why 510? crlf
+        maxlen = 510 - len('CAP REQ :')
+
+        chunks = [[]]
+        length = 0
+        for cap in sorted(caps):
+            if chunks[-1] and length + len(cap) + 1 > maxlen:
+                chunks.append([])
+                length = 0
+
+            length += len(cap) + (1 if chunks[-1] else 0)
+            chunks[-1].append(cap)
+            self.cap_pending.add(cap)
+
+        for chunk in chunks:
+            if chunk:
+                self.cmdwrite('CAP', ['REQ', ' '.join(chunk)])
+
+
+    """ Request capabilities, including after registration
+
+    Caps the server doesn't offer yet are requested if it announces them later
+    with cap-notify.
+    """
+    def request_cap(self, *caps):
+        if not self.use_cap:
+            raise ValueError('CAP is disabled')
+
+        self.cap_req.update(caps)
+        self.cap_refused.difference_update(caps)
+
+        if not self.cap_listed:
+            # Requested when CAP LS finishes
+            return
+
+        wanted = self.cap_wanted()
+        if wanted:
+            self.cap_send_req(wanted)
+
+
+    """ Use TLS directly if there is a known STS policy for this host """
+    def apply_sts_policy(self):
+        if not self.use_sts or self.use_ssl:
+            return
+
+        port = self.sts_store.get(self.host)
+        if port is None:
+            return
+
+        self.logger.info('Using known STS policy for {}: TLS on port '
+                         '{}'.format(self.host, port))
+        self.port = port
+        self.use_ssl = True
+        self.use_starttls = False
+        self.ssl_verify = True
+
+
+    """ Process an STS policy sent by the server
+
+    Returns True if we are reconnecting to upgrade the connection.
+    """
+    def process_sts(self, value):
+        if not self.use_sts:
+            return False
+
+        policy = parse_sts_value(value)
+
+        if not self.ssl_wrapped:
+            # Insecure connection, we must upgrade
+            port = policy.get('port')
+            if not port or not port.isdigit():
+                self.logger.warn('Invalid STS upgrade policy: {}'.format(value))
+                return False
+
+            self.logger.info('STS upgrade requested, reconnecting with TLS on '
+                             'port {}'.format(port))
+            self.port = int(port)
+            self.use_ssl = True
+            self.use_starttls = False
+            self.ssl_verify = True
+            self.request_reconnect()
+            return True
+
+        if not self.ssl_verified:
+            # Anyone in the middle could have sent this
+            self.logger.warn('Not persisting STS policy from an unverified '
+                             'TLS connection')
+            return False
+
+        # Secure, verified connection, persist the policy
+        duration = policy.get('duration')
+        if not duration or not duration.isdigit():
+            self.logger.warn('Invalid STS persistence policy: {}'.format(value))
+            return False
+
+        self.sts_store.set(self.host, self.port, int(duration))
+        return False
+
+
+    """ Change the case mapping, and re-fold everything keyed on it """
+    def set_casemapping(self, name):
+        # Stored NAMES entries are keyed on the old folding
+        self.materialize_pending()
+        self.casemap.set(name)
+        self.tracking.compile()
+        if self.line_filter is not None:
+            self.line_filter.compile()
+        self.strangers.rekey()
+        self._whox_pending = {rid : self.casemap.fold(channel) for rid, channel
+                              in self._whox_pending.items()}
+
+        self.users.rekey()
+        self.channels.rekey()
+        self.split_nicks.rekey()
+        self._whois_inflight.rekey()
+        self._whois_cache.rekey()
+        self._chanop_sent.rekey()
+        self.history.rekey()
+
+        for split in self.splits.values():
+            split.parked = {self.casemap.fold(user.nick) : user for user in
+                            split.parked.values()}
+
+        for user in self.users.values():
+            user.channels.rekey()
+
+        for ch in self.channels.values():
+            ch.users.rekey()
+            ch.modes.rekey()
+            ch.reset_masks()
+
+
+    """ Rebuild channel mode definitions from ISUPPORT
+
+    All channels are switched over to the new definitions together.
+    """
+    def update_mode_spec(self):
+        spec = ModeSpec.from_isupport(self.isupport)
+        if spec == self.chanmode_spec:
+            return
+
+        self.chanmode_spec = spec
+        for ch in self.channels.values():
+            ch.modes.rebind(spec)
+
+            # Mask indexes and list state may describe modes that are gone
+            ch.reset_masks()
+            ch.list_synced &= set(spec.p_list)
+            for state in (ch.list_info, ch.list_pending):
+                for mode in list(state):
+                    if mode not in spec.p_list:
+                        del state[mode]
+
+
+    """ Get the EXTBAN token as (prefix, types), or None """
+    def extban(self):
+        value = self.isupport.get('EXTBAN', None)
+        if isinstance(value, tuple):
+            return value
+        elif value:
+            # No prefix (e.g. InspIRCd sends EXTBAN=,ABCD...)
+            return ('', value.lstrip(','))
+
+        return None
+
+
+    """ Get the users we know of that a mask matches """
+    def users_matching(self, mask):
+        return users_matching(mask, self.users.values(), self.casemap,
+                              self.extban())
+
+
+    """ Check if a nick is ours """
+    def is_current_nick(self, nick):
+        return self.casemap.equal(nick, self.current_nick)
+
+
+    """ Get the tracking profile level for a channel
+
+    With no channel, the default profile (used for e.g. private messages) is
+    returned.
+    """
+    def tracking_for(self, channel=None):
+        return self.tracking.get(channel)
+
+
     """ Add a user to expiry checks """
     def expire_user(self, nick):
         if len(self.users[nick].channels) == 0:
+            if self.tracking.default < TRACK_FULL:
+                # No MONITOR/ISON; just forget them
+                self.delete_user(nick)
+                return
+
+            if self.stranger_expiry == 'lru':
+                # Forgotten when the cache fills up or they go quiet
+                self.strangers.add(nick)
+                return
+
             if 'MONITOR' in self.isupport:
                 # We support monitor :D
                 self.cmdwrite('MONITOR', ('+', nick))
             else:
                 # :( use ISON as a fallback
-                isoncheck = partial(self.cmdwrite, 'ISON', (nick,))
-                timername = 'ison_user_{}'.format(nick)
+                isoncheck = partial(self.ison_check, nick)
+                timername = 'ison_user_{}'.format(self.casemap.fold(nick))
                 self.timer_repeat(timername, 60, isoncheck)
                 isoncheck()
 
 
+    """ Check if users are still online with ISON, forgetting them if not """
+    def ison_check(self, *nicks):
+        future = self.request('ISON', nicks)
+        future.add_done_callback(partial(self.ison_done, nicks))
+
+
+    """ Handle the reply to ison_check """
+    def ison_done(self, nicks, future):
+        if future.exception() is not None:
+            return
+
+        fold = self.casemap.fold
+        present = set()
+        for line in future.result():
+            present.update(fold(nick) for nick in line.params[-1].split())
+
+        for nick in nicks:
+            if fold(nick) in present:
+                continue
+
+            user = self.users.get(nick, None)
+            if user is None or user.channels:
+                continue
+
+            # User absent :(.
+            self.timer_cancel('ison_user_{}'.format(fold(nick)))
+            self.delete_user(nick)
+
+
     """ Unexpire a user """
     def unexpire_user(self, nick):
-        self.timer_cancel('ison_user_{}'.format(nick))
+        if self.tracking.default < TRACK_FULL:
+            # Never expired
+            return
+
+        if self.stranger_expiry == 'lru':
+            self.strangers.discard(nick)
+            return
+
+        self.timer_cancel('ison_user_{}'.format(self.casemap.fold(nick)))
         if 'MONITOR' in self.isupport:
             # XXX might send useless monitor
             self.cmdwrite('MONITOR', ('-', nick))
 
 
+    """ Park a user who quit in a netsplit, until they return
+
+    servers is the pair of servers from the QUIT reason.
+    """
+    def split_park(self, servers, nick):
+        user = self.users.pop(nick, None)
+        if user is None:
+            return
+
+        self.strangers.discard(nick)
+
+        for ch in list(user.channels.values()):
+            ch.user_del(nick)
+            user.channel_del(ch.name)
+
+        split = self.splits.get(servers, None)
+        if split is None:
+            split = self.splits[servers] = Split(servers)
+            self.timer_oneshot(split.name, self.split_timeout,
+                               partial(self.split_expire, servers))
+            self.call_event('netsplit', servers)
+
+        old = self.split_nicks.get(nick, None)
+        if old is not None and old is not split:
+            # Parked twice?
+            old.parked.pop(self.casemap.fold(nick), None)
+
+        split.parked[self.casemap.fold(nick)] = user
+        self.split_nicks[nick] = split
+
+
+    """ Get a parked user back, if they're the same person
+
+    Returns the User, now tracked again, or None.
+    """
+    def split_rejoin(self, nick, username=None, host=None):
+        split = self.split_nicks.pop(nick, None)
+        if split is None:
+            return None
+
+        user = split.parked.pop(self.casemap.fold(nick), None)
+        if user is None:
+            return None
+
+        if ((username and user.user and username != user.user) or
+                (host and user.host and host != user.host)):
+            # Someone else has the nick now
+            user = None
+        else:
+            user.nick = nick
+            self.users[nick] = user
+            split.rejoined.append(nick)
+
+        if not split.parked:
+            # Everyone's back
+            self.split_end(split)
+            self.splits.pop(split.servers, None)
+            self.timer_cancel(split.name)
+            self.timer_cancel(split.name + '_settle')
+        elif user is not None and not split.ended:
+            self.timer_oneshot(split.name + '_settle', self.split_settle,
+                               partial(self.split_settled, split.servers))
+
+        return user
+
+
+    """ Announce the end of a netsplit (once) """
+    def split_end(self, split):
+        if split.ended:
+            return
+
+        split.ended = True
+        self.call_event('netsplit_end', split.servers, split.rejoined,
+                        split.missing())
+
+
+    """ Rejoins have died down """
+    def split_settled(self, servers):
+        split = self.splits.get(servers, None)
+        if split is not None:
+            self.split_end(split)
+
+
+    """ Give up on users who didn't come back from a netsplit """
+    def split_expire(self, servers):
+        split = self.splits.pop(servers, None)
+        if split is None:
+            return
+
+        self.split_end(split)
+
+        for user in split.parked.values():
+            if self.split_nicks.get(user.nick, None) is split:
+                del self.split_nicks[user.nick]
+
+        split.parked.clear()
+
+
+    """ Drop a user evicted from the stranger cache """
+    def evict_stranger(self, nick):
+        user = self.users.get(nick, None)
+        if user is not None and not user.channels:
+            self.users.pop(nick, None)
+
+
+    """ Unexpire many users at once """
+    def unexpire_users(self, nicks):
+        if self.tracking.default < TRACK_FULL or not nicks:
+            return
+
+        # Each nick only once
+        nicks = list({self.casemap.fold(n) : n for n in nicks}.values())
+
+        if self.stranger_expiry == 'lru':
+            for nick in nicks:
+                self.strangers.discard(nick)
+
+            return
+
+        for nick in nicks:
+            self.timer_cancel('ison_user_{}'.format(self.casemap.fold(nick)))
+
+        if 'MONITOR' in self.isupport:
+            # Batch the removals up
+            chunk = []
+            length = 0
+            for nick in nicks:
+                if chunk and length + len(nick) + 1 > 400:
+                    self.cmdwrite('MONITOR', ('-', ','.join(chunk)))
+                    chunk = []
+                    length = 0
+
+                chunk.append(nick)
+                length += len(nick) + 1
+
+            if chunk:
+                self.cmdwrite('MONITOR', ('-', ','.join(chunk)))
+
+
     """ Create a user """
     def create_user(self, nick, user=None, host=None, realname=None,
                     account=None):
-        self.users[nick] = User(self, nick, user, host, realname, account)
+        u = self.users[nick] = User(self, nick, user, host, realname, account)
+        return u
+
+
+    """ Apply NAMES entries (e.g. '@+nick!user@host') to a channel in one pass
+
+    Handles multi-prefix and userhost-in-names.
+    """
+    def apply_names(self, ch, tokens):
+        prefix_to_mode = self.prefix_to_mode
+        users = self.users
+        name = ch.name
+
+        for token in tokens:
+            # Status prefixes
+            index = 0
+            while index < len(token) and token[index] in prefix_to_mode:
+                index += 1
+
+            status = token[:index]
+            if index:
+                token = token[index:]
+
+            nick, sep, userhost = token.partition('!')
+            if not nick:
+                continue
+
+            if sep:
+                username, sep, host = userhost.partition('@')
+            else:
+                username = host = None
+
+            user = users.get(nick, None)
+            if user is None:
+                user = self.create_user(nick, username, host)
+            elif sep:
+                user.user = username
+                user.host = host
+
+            user.channel_add(name, ch)
+            ch.user_add(nick, user)
+
+            if status:
+                ch.status_add(nick, [prefix_to_mode[s] for s in status])
+
+
+    """ Split NAMES payloads into entries by folded nick, for names_raw """
+    def index_names(self, payloads):
+        fold = self.casemap.fold
+        prefixes = ''.join(self.prefix_to_mode)
+        index = dict()
+
+        for payload in payloads:
+            for token in payload.split():
+                nick = token.lstrip(prefixes).partition('!')[0]
+                if nick:
+                    index[fold(nick)] = token
+
+        return index
+
+
+    """ Create a user from stored NAMES entries, in any channel listing them
+
+    Used when a nick we may not know yet quits, changes nick, or speaks.
+    """
+    def materialize_nick(self, nick):
+        if not self.names_lazy:
+            return
+
+        folded = self.casemap.fold(nick)
+        for ch in self.channels.values():
+            if ch.names_raw and folded in ch.names_raw:
+                ch.materialize_nick(nick)
+
+
+    """ Materialize every channel with NAMES entries still stored """
+    def materialize_pending(self):
+        for ch in list(self.channels.values()):
+            if ch.names_raw:
+                ch.materialize()
 
 
     """ Delete a user """
     def delete_user(self, nick):
         self.users.pop(nick, None)
+        self.strangers.discard(nick)
 
 
     """ Create a channel """
@@ -364,8 +1111,8 @@ class IRCClient(IRCClientNetwork):
         if channel not in self.channels:
             self.create_channel(channel)
 
-        self.channels[channel].user_add(nick, client.users[nick])
-        self.users[nick].channel_add(channel, client.channels[channel])
+        self.channels[channel].user_add(nick, self.users[nick])
+        self.users[nick].channel_add(channel, self.channels[channel])
 
 
     """ Combine channels for join """
@@ -426,3 +1173,519 @@ class IRCClient(IRCClientNetwork):
             else:
                 joinfunc()
 
+
+    """ Queue a command to be sent at a limited rate
+
+    Up to pace_burst lines are sent every pace_interval seconds.
+    """
+    def write_paced(self, command, params=[]):
+        with self._pacelock:
+            self._paced.append((command, params))
+            if self._pacing:
+                return
+
+            self._pacing = True
+
+        self.pace_flush()
+
+
+    """ Send the next burst of paced lines """
+    def pace_flush(self):
+        with self._pacelock:
+            burst = []
+            while self._paced and len(burst) < self.pace_burst:
+                burst.append(self._paced.popleft())
+
+            reschedule = bool(self._paced)
+            if not reschedule:
+                self._pacing = False
+
+        # Timers take their own lock; don't hold ours across that
+        if reschedule:
+            self.timer_oneshot('paced_write', self.pace_interval,
+                               self.pace_flush)
+
+        for command, params in burst:
+            self.cmdwrite(command, params)
+
+
+    """ Send a PING to sample lag
+
+    Up to lag_probes may be in flight. Probes go out through write_paced, so
+    time spent queued behind paced output is measured apart from the network
+    round trip. Raises socket.error if the oldest probe is past lag_timeout.
+
+    Returns the probe's token, or None if too many are in flight.
+    """
+    def lag_probe(self):
+        now = monotonic()
+        with self._latencylock:
+            for queued, sent in self._probes.values():
+                if now - queued > self.lag_timeout:
+                    raise SocketError('Socket timed out')
+
+                # Only the oldest matters
+                break
+
+            if len(self._probes) >= self.lag_probes:
+                return None
+
+            self._probe_count += 1
+            token = 'lag{}'.format(self._probe_count)
+            self._probes[token] = [now, None]
+
+        self.write_paced('PING', [token])
+        return token
+
+
+    """ Record the answer to a lag probe """
+    def lag_pong(self, token):
+        now = monotonic()
+        with self._latencylock:
+            if token not in self._probes:
+                return
+
+            # Anything sent before this one isn't coming back
+            while True:
+                key, (queued, sent) = self._probes.popitem(last=False)
+                if key == token:
+                    break
+
+        if sent is None:
+            sent = queued
+
+        self.lag = now - sent
+        self.latency['rtt'].add(self.lag)
+        self.latency['queue'].add(sent - queued)
+        self.logger.info('LAG: {}'.format(self.lag))
+
+
+    """ How history can be fetched here: 'chathistory', 'playback', or None """
+    def history_mode(self):
+        if 'draft/chathistory' in self.supported_cap:
+            return 'chathistory'
+        elif 'znc.in/playback' in self.supported_cap:
+            return 'playback'
+
+        return None
+
+
+    """ Messages to ask for per CHATHISTORY request """
+    def history_page(self):
+        limit = self.isupport_int('CHATHISTORY', 0)
+        if limit > 0:
+            return min(limit, self.history_limit)
+
+        return self.history_limit
+
+
+    """ Fetch what was missed in a channel since we last saw it
+
+    Fetches are started history_concurrency at a time, and sent paced.
+    Returns False if there's nothing to fetch from, or no way to fetch.
+    """
+    def history_fetch(self, channel):
+        after = self.history.after(channel)
+        if after is None or self.history_mode() is None:
+            return False
+
+        if self.history.add(HistoryFetch(channel, after)):
+            self.history_next()
+
+        return True
+
+
+    """ Start queued history fetches """
+    def history_next(self):
+        mode = self.history_mode()
+        for fetch in self.history.start(self.history_concurrency):
+            channel = fetch.channel
+            msgid, time = fetch.after
+
+            if mode == 'chathistory':
+                after = 'msgid={}'.format(msgid) if msgid else \
+                        'timestamp={}'.format(time)
+                command = ('CHATHISTORY', ['AFTER', channel, after,
+                                           str(self.history_page())])
+            elif mode == 'playback' and time is not None:
+                command = ('PRIVMSG', ['*playback', 'PLAY {} {}'.format(
+                    channel, parse_server_time(time))])
+            else:
+                # Can't be done (any more)
+                self.history_finish(channel)
+                continue
+
+            self.timer_oneshot('history_{}'.format(self.casemap.fold(channel)),
+                               self.history_timeout,
+                               partial(self.history_expire, channel))
+            self.write_paced(*command)
+
+
+    """ A history fetch has come back
+
+    received - lines in the reply
+    replayed - of which were new and replayed
+    last - (msgid, time) of the last line, to carry on from
+    """
+    def history_done(self, channel, received=0, replayed=0, last=None):
+        self.timer_cancel('history_{}'.format(self.casemap.fold(channel)))
+        self.history_finish(channel, received, replayed, last)
+
+
+    """ Give up on a history fetch """
+    def history_expire(self, channel):
+        self.logger.warn('History fetch for {} timed out'.format(channel))
+        self.history_finish(channel)
+
+
+    def history_finish(self, channel, received=0, replayed=0, last=None):
+        fetch = self.history.finish(channel)
+        if fetch is None:
+            return
+
+        fetch.replayed += replayed
+        if (self.history_mode() == 'chathistory' and last is not None and
+                received >= self.history_page()):
+            # Probably more; carry on where this page left off
+            fetch.after = last
+            self.history.add(fetch, True)
+        else:
+            self.call_event('history_filled', channel, fetch.replayed)
+
+        self.history_next()
+
+
+    """ Return latency percentiles for this connection """
+    def latency_metrics(self):
+        return {name : hist.metrics() for name, hist in self.latency.items()}
+
+
+    """ Get a numeric ISUPPORT token, or default """
+    def isupport_int(self, name, default=None):
+        value = self.isupport.get(name, None)
+        if isinstance(value, int):
+            return value
+
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return default
+
+
+    """ Get the TARGMAX limit for a command, or default """
+    def targmax(self, command, default=None):
+        value = self.isupport.get('TARGMAX', None)
+        if value is None:
+            return default
+
+        if isinstance(value, tuple):
+            # Only one item
+            value = [value]
+
+        for item in value:
+            if not isinstance(item, tuple) or item[0].upper() != command:
+                continue
+
+            if not item[1]:
+                # No limit
+                return None
+
+            try:
+                return int(item[1])
+            except ValueError:
+                return default
+
+        return default
+
+
+    """ Work out how much room a line we send has once relayed """
+    def line_room(self, command, target):
+        if self.current_nick and self.current_user and self.current_host:
+            prefix = len(self.current_nick) + len(self.current_user) + \
+                     len(self.current_host) + 4
+        else:
+            # Conservative guess
+            prefix = 100
+
+        # Why 510? crlf
+        return 510 - prefix - len(command) - len(target) - 2
+
+
+    """ Change modes on a channel, using as few lines as possible
+
+    changes - list of (adding, mode, param); param is True for no param
+
+    Changes that are already reflected in the channel's modes are skipped.
+    Lines are packed according to the MODES token and line length, and sent
+    through write_paced. Returns the list of (modestring, params) sent.
+    """
+    def mode_batch(self, channel, changes):
+        ch = self.channels.get(channel, None)
+        if ch is not None:
+            would_change = ch.modes.would_change
+            changes = [(adding, mode, param) for adding, mode, param in changes
+                       if would_change(mode, adding, param)]
+
+        maxmodes = self.isupport_int('MODES', 3)
+        maxlen = self.line_room('MODE', channel)
+
+        packed = pack_mode_changes(changes, maxmodes, maxlen)
+        for modestring, params in packed:
+            self.write_paced('MODE', [channel, modestring] + params)
+
+        return packed
+
+
+    """ Kick users from a channel, using as few lines as possible
+
+    Users not in the channel are skipped. Nicks are packed according to the
+    TARGMAX token for KICK and line length, and sent through write_paced.
+    """
+    def kick_batch(self, channel, nicks, reason=None):
+        ch = self.channels.get(channel, None)
+        if ch is not None:
+            nicks = [nick for nick in nicks if nick in ch.users]
+
+        maxtargets = self.targmax('KICK', 1)
+        maxlen = self.line_room('KICK', channel)
+        if reason:
+            maxlen -= len(reason) + 2
+
+        chunks = []
+        chunk = []
+        length = 0
+        for nick in nicks:
+            if chunk and ((maxtargets and len(chunk) >= maxtargets) or
+                          length + len(nick) + 1 > maxlen):
+                chunks.append(chunk)
+                chunk = []
+                length = 0
+
+            chunk.append(nick)
+            length += len(nick) + 1
+
+        if chunk:
+            chunks.append(chunk)
+
+        for chunk in chunks:
+            params = [channel, ','.join(chunk)]
+            if reason:
+                params.append(reason)
+
+            self.write_paced('KICK', params)
+
+        return chunks
+
+
+    """ Fetch a channel list mode (bans, exceptions, invexes, ...)
+
+    Returns a Future whose result is the list of masks. If the list is already
+    known, the Future is complete straight away; if a fetch is already in
+    progress, its Future is shared. Once fetched, the list is kept current
+    from MODE changes.
+    """
+    def fetch_list(self, channel, mode='b', refresh=False, timeout=60):
+        ch = self.channels.get(channel, None)
+        if ch is None:
+            raise ValueError('Not on channel {}'.format(channel))
+
+        if mode not in ch.modes.spec.p_list:
+            raise ValueError('Not a list mode: {}'.format(mode))
+
+        if mode in ch.list_synced and not refresh:
+            future = Future()
+            future.set_result(ch.modes.is_set(mode))
+            return future
+
+        key = (self.casemap.fold(channel), mode)
+        future = self._list_fetches.get(key, None)
+        if future is not None:
+            return future
+
+        future = self._list_fetches[key] = Future()
+        ch.list_pending.pop(mode, None)
+
+        failure = partial(self.list_fetch_failed, channel, 'Timed out', mode)
+        self.timer_oneshot('list_fetch_{}_{}'.format(key[0], mode), timeout,
+                           failure)
+
+        try:
+            self.cmdwrite('MODE', (channel, '+' + mode))
+        except Exception as e:
+            # Never sent, so nothing will answer it
+            self._list_fetches.pop(key, None)
+            self.timer_cancel('list_fetch_{}_{}'.format(key[0], mode))
+            future.set_exception(e)
+            raise
+
+        return future
+
+
+    """ Complete a list fetch """
+    def list_fetch_done(self, channel, mode, masks):
+        key = (self.casemap.fold(channel), mode)
+        future = self._list_fetches.pop(key, None)
+        if future is None:
+            return
+
+        self.timer_cancel('list_fetch_{}_{}'.format(key[0], mode))
+
+        if masks is None:
+            future.set_exception(ValueError('Not on channel '
+                                            '{}'.format(channel)))
+        else:
+            future.set_result(masks)
+
+
+    """ Fail list fetches for a channel (all modes if mode is None) """
+    def list_fetch_failed(self, channel, reason, mode=None):
+        folded = self.casemap.fold(channel)
+        for key in list(self._list_fetches):
+            if key[0] != folded or (mode is not None and key[1] != mode):
+                continue
+
+            future = self._list_fetches.pop(key)
+            self.timer_cancel('list_fetch_{}_{}'.format(*key))
+            future.set_exception(IOError('Could not fetch list: '
+                                         '{}'.format(reason)))
+
+
+    """ Send a command and get a Future for its replies
+
+    The Future's result is the list of reply Lines. It fails with
+    RequestError if the server replies with an error, or IOError on timeout
+    or disconnection.
+
+    Where the server supports labeled-response, replies are matched by label;
+    otherwise they're matched on the numerics the command is known to produce,
+    in the order requests were sent. spec may be given as (replies, ends,
+    errors, loose) for commands that aren't known.
+    """
+    def request(self, command, params=[], timeout=None, spec=None):
+        command = command.upper()
+        params = list(params)
+
+        if spec is None:
+            spec = reply_spec(command, params)
+
+        if 'labeled-response' in self.supported_cap:
+            label = self.requests.new_label()
+        elif spec is None:
+            raise ValueError('No way to match replies to {}'.format(command))
+        else:
+            label = None
+
+        if timeout is None:
+            timeout = self.request_timeout
+
+        request = Request(command, params, spec, label, timeout)
+        self.requests.add(request)
+
+        if not self._request_timer:
+            self._request_timer = True
+            self.timer_repeat('request_expire', 1, self.requests.expire)
+
+        try:
+            if label is not None:
+                self.cmdwrite(command, params, {'label' : label})
+            else:
+                self.cmdwrite(command, params)
+        except:
+            # Never sent, so nothing will answer it
+            self.requests.remove(request)
+            raise
+
+        return request.future
+
+
+    """ Dispatch a line, then hand it to any request waiting for it """
+    def dispatch_line(self, line):
+        IRCClientNetwork.dispatch_line(self, line)
+
+        requests = self.requests
+        if not (requests.labels or requests.pending) or line.batch is not None:
+            return
+
+        if line.tags and line.command != 'BATCH':
+            label = line.tag('label')
+            if label is not None:
+                requests.labeled(label, [] if line.command == 'ACK' else
+                                 [line])
+                return
+
+        requests.route(line)
+
+
+    """ WHOIS a user, returning a Future for their User
+
+    If the user's WHOIS info is newer than whois_ttl, it's used as is. If a
+    WHOIS for the nick is already in flight, its Future is shared; otherwise
+    exactly one WHOIS is sent. Fails with RequestError if there's no such
+    nick.
+    """
+    def whois(self, nick, refresh=False, timeout=None):
+        user = self.users.get(nick, None)
+        if user is None:
+            user = self._whois_cache.get(nick, None)
+
+        if (not refresh and user is not None and user.whois_time is not None
+                and monotonic() - user.whois_time < self.whois_ttl):
+            future = Future()
+            future.set_result(user)
+            return future
+
+        future = self._whois_inflight.get(nick, None)
+        if future is not None:
+            return future
+
+        future = self._whois_inflight[nick] = Future()
+        try:
+            request = self.request('WHOIS', (nick,), timeout)
+        except Exception as e:
+            # e.g. not connected; don't leave later callers waiting on this
+            if self._whois_inflight.get(nick, None) is future:
+                del self._whois_inflight[nick]
+
+            future.set_exception(e)
+            return future
+
+        request.add_done_callback(partial(self.whois_done, nick, future))
+        return future
+
+
+    """ Complete a WHOIS started by whois """
+    def whois_done(self, nick, future, request):
+        if self._whois_inflight.get(nick, None) is future:
+            del self._whois_inflight[nick]
+
+        error = request.exception()
+        if error is not None:
+            future.set_exception(error)
+            return
+
+        user = self.users.get(nick, None)
+        if user is None:
+            # Not tracked; build one from the replies
+            user = User(self, nick)
+            for line in request.result():
+                if line.command == RPL_WHOISUSER:
+                    user.user, user.host, unused, user.realname = \
+                        line.params[2:6]
+                elif line.command == RPL_WHOISLOGGEDIN:
+                    user.account = line.params[2]
+
+            user.whois_time = now = monotonic()
+
+            cache = self._whois_cache
+            if len(cache) >= self.whois_cache_size:
+                # Make room
+                for key, cached in list(dict.items(cache)):
+                    if now - cached.whois_time >= self.whois_ttl:
+                        dict.__delitem__(cache, key)
+
+                if len(cache) >= self.whois_cache_size:
+                    cache.clear()
+
+            cache[nick] = user
+
+        future.set_result(user)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+""" Multi-address connection racing (Happy Eyeballs style) """
+
+import socket
+
+from threading import Thread, RLock
+from time import time
+
+try:
+    from time import monotonic
+except ImportError:
+    monotonic = time
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+
+""" Default connector; returns a connected socket or raises """
+def connect_address(family, sockaddr, timeout):
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(sockaddr)
+    except:
+        sock.close()
+        raise
+
+    return sock
+
+
+""" Caches name resolution results for a while
+
+Resolution happens in a separate thread, so a stuck resolver can't hang the
+caller past the timeout.
+
+resolver - getaddrinfo-like function to use
+ttl - time in seconds to cache results for
+"""
+class AddressCache(object):
+    def __init__(self, ttl=300, resolver=socket.getaddrinfo):
+        self.ttl = ttl
+        self.resolver = resolver
+        self.cache = dict()
+        self.lock = RLock()
+
+
+    """ Resolve a host and port to a list of (family, sockaddr) """
+    def resolve(self, host, port, timeout=None):
+        key = (host, port)
+        with self.lock:
+            item = self.cache.get(key, None)
+            if item is not None and item[0] > monotonic():
+                return item[1]
+
+        result = Queue()
+        def do_resolve():
+            try:
+                result.put(self.resolver(host, port, 0, socket.SOCK_STREAM))
+            except Exception as e:
+                result.put(e)
+
+        thread = Thread(target=do_resolve, name='resolve_{}'.format(host))
+        thread.daemon = True
+        thread.start()
+
+        try:
+            addrinfo = result.get(timeout=timeout)
+        except Empty:
+            raise socket.timeout('Timed out resolving {}'.format(host))
+
+        if isinstance(addrinfo, Exception):
+            raise addrinfo
+
+        addresses = []
+        for family, socktype, proto, canonname, sockaddr in addrinfo:
+            if (family, sockaddr) not in addresses:
+                addresses.append((family, sockaddr))
+
+        with self.lock:
+            self.cache[key] = (monotonic() + self.ttl, addresses)
+
+        return addresses
+
+
+    """ Forget cached results """
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+
+""" Remembers how long connecting to each address took
+
+Failed attempts are recorded as a penalty so the address sorts last.
+"""
+class LatencyTable(object):
+    def __init__(self, weight=0.3, penalty=30.0):
+        self.weight = weight
+        self.penalty = penalty
+        self.latency = dict()
+        self.lock = RLock()
+
+
+    """ Record a connect time (None for failure) """
+    def record(self, sockaddr, elapsed):
+        if elapsed is None:
+            elapsed = self.penalty
+
+        with self.lock:
+            old = self.latency.get(sockaddr, None)
+            if old is not None:
+                elapsed = (self.weight * elapsed) + ((1 - self.weight) * old)
+
+            self.latency[sockaddr] = elapsed
+
+
+    """ Sort addresses, fastest known first, then unknown in given order """
+    def order(self, addresses):
+        with self.lock:
+            known = [a for a in addresses if a[1] in self.latency]
+            unknown = [a for a in addresses if a[1] not in self.latency]
+            known.sort(key=lambda a: self.latency[a[1]])
+
+        return known + unknown
+
+
+""" Interleave address families, as RFC 6555 recommends """
+def interleave(addresses):
+    families = []
+    byfamily = dict()
+    for family, sockaddr in addresses:
+        if family not in byfamily:
+            families.append(family)
+            byfamily[family] = []
+
+        byfamily[family].append((family, sockaddr))
+
+    ret = []
+    while any(byfamily.values()):
+        for family in families:
+            if byfamily[family]:
+                ret.append(byfamily[family].pop(0))
+
+    return ret
+
+
+""" Race connections to several addresses, returning the first to succeed
+
+A new attempt is started every stagger seconds, or straight away when an
+attempt fails. Sockets that connect after the winner are closed.
+
+addresses - list of (family, sockaddr)
+timeout - overall timeout
+stagger - delay between starting attempts
+latency - optional LatencyTable to record into and order by
+connector - function(family, sockaddr, timeout) returning a connected socket
+"""
+def race_connect(addresses, timeout=10, stagger=0.25, latency=None,
+                 connector=connect_address):
+    if not addresses:
+        raise socket.error('No addresses to connect to')
+
+    if latency is not None:
+        addresses = latency.order(addresses)
+    else:
+        addresses = interleave(addresses)
+
+    results = Queue()
+    lock = RLock()
+    state = {'winner' : None}
+
+    def attempt(family, sockaddr):
+        start = monotonic()
+        try:
+            sock = connector(family, sockaddr, timeout)
+        except (IOError, OSError) as e:
+            if latency is not None:
+                latency.record(sockaddr, None)
+
+            results.put((None, sockaddr, e))
+            return
+
+        elapsed = monotonic() - start
+        if latency is not None:
+            latency.record(sockaddr, elapsed)
+
+        with lock:
+            if state['winner'] is not None:
+                # Lost the race
+                sock.close()
+                return
+
+            state['winner'] = sock
+
+        results.put((sock, sockaddr, None))
+
+    deadline = monotonic() + timeout if timeout is not None else None
+    pending = list(addresses)
+    running = 0
+    error = None
+
+    while pending or running:
+        if pending:
+            thread = Thread(target=attempt, args=pending.pop(0),
+                            name='connect_attempt')
+            thread.daemon = True
+            thread.start()
+            running += 1
+
+        # Wait for a result, or until it's time to start the next attempt
+        while True:
+            if deadline is not None:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+
+            if pending:
+                wait = stagger
+                if deadline is not None:
+                    wait = min(wait, remaining)
+            else:
+                wait = remaining if deadline is not None else None
+
+            try:
+                sock, sockaddr, e = results.get(timeout=wait)
+            except Empty:
+                break
+
+            running -= 1
+            if sock is not None:
+                return sock
+
+            error = e
+            if pending or not running:
+                # Start the next one now
+                break
+
+        if deadline is not None and monotonic() >= deadline:
+            break
+
+    with lock:
+        # Nothing may win from here on in
+        state['winner'] = False
+
+    # ...but something may have won just as we gave up
+    while True:
+        try:
+            sock, sockaddr, e = results.get_nowait()
+        except Empty:
+            break
+
+        if sock is not None:
+            return sock
+
+    if error is None:
+        error = socket.timeout('Timed out connecting')
+
+    raise error
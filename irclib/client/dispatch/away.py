@@ -5,7 +5,7 @@ def dispatch_away(client, line):
     if line.hostmask is None: return
 
     nick = line.hostmask.nick
-    if nick == client.current_nick:
+    if client.is_current_nick(nick):
         # o_O
         return
 
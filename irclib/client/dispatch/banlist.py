@@ -0,0 +1,167 @@
+from collections import OrderedDict, deque
+
+from irclib.common.dispatch import (PRIORITY_DEFAULT, PRIORITY_DECREASED,
+                                    PRIORITY_LOW)
+from irclib.common.numerics import *
+
+# List reply numerics -> mode
+LIST_ENTRY = {
+    RPL_BANLIST : 'b',
+    RPL_EXCEPTLIST : 'e',
+    RPL_INVITELIST : 'I',
+    RPL_QUIETLIST : 'q',
+}
+
+LIST_END = {
+    RPL_ENDOFBANLIST : 'b',
+    RPL_ENDOFEXCEPTLIST : 'e',
+    RPL_ENDOFINVITELIST : 'I',
+    RPL_ENDOFQUIETLIST : 'q',
+}
+
+# Channel commands remembered per channel, to put a 482 down to
+CHANOP_SENT_MAX = 64
+
+
+""" Dispatch a list mode entry """
+def dispatch_list_entry(client, line):
+    mode = LIST_ENTRY[line.command]
+    params = line.params[2:]
+    if line.command == RPL_QUIETLIST:
+        # Charybdis sends the mode character too
+        params = params[1:]
+
+    if not params:
+        return
+
+    ch = client.channels.get(line.params[1], None)
+    if ch is None:
+        return
+
+    mask = params[0]
+    setter = params[1] if len(params) > 1 else None
+    settime = params[2] if len(params) > 2 else None
+
+    pending = ch.list_pending.get(mode, None)
+    if pending is None:
+        # Unsolicited (or someone else asked); still worth having
+        pending = ch.list_pending[mode] = OrderedDict()
+
+    pending[mask] = (setter, settime)
+
+
+""" Dispatch the end of a list """
+def dispatch_list_end(client, line):
+    mode = LIST_END[line.command]
+    ch = client.channels.get(line.params[1], None)
+    if ch is None:
+        client.list_fetch_done(line.params[1], mode, None)
+        return
+
+    pending = ch.list_pending.pop(mode, OrderedDict())
+
+    # ch._modes, as list modes don't need stored NAMES entries created
+    if mode in ch._modes.spec.p_list:
+        # Now authoritative
+        ch._modes.modes[mode] = OrderedDict((mask, True) for mask in pending)
+        ch.list_info[mode] = dict(pending)
+        ch.list_synced.add(mode)
+        ch.masks.pop(mode, None)
+
+    client.list_fetch_done(ch.name, mode, list(pending))
+
+    # The server answers in order, so anything sent before this query that
+    # was going to draw a 482 has done so by now
+    sent = client._chanop_sent.get(ch.name, None)
+    if sent is not None and mode in sent:
+        while sent.popleft() != mode:
+            pass
+
+
+""" Keep set-by info current from MODE changes (runs after the mode hook) """
+def dispatch_list_mode(client, line):
+    changes = getattr(line, 'mode_changes', None)
+    if not changes:
+        return
+
+    ch = client.channels.get(line.params[0], None)
+    if ch is None:
+        return
+
+    setter = str(line.hostmask) if line.hostmask else None
+    for adding, mode, param in changes:
+        info = ch.list_info.get(mode, None)
+        if info is None:
+            continue
+
+        if adding:
+            info[param] = (setter, None)
+        else:
+            info.pop(param, None)
+
+
+""" Note commands that may draw ERR_CHANOPRIVSNEEDED, in the order sent
+
+List queries are noted by mode, anything else as None.
+"""
+def dispatch_chanop_out(client, line):
+    params = line.params
+    if line.cancelled or len(params) < 2:
+        # Mode and topic queries never get a 482
+        return
+
+    if line.command == 'INVITE':
+        channel = params[1]
+    else:
+        channel = params[0]
+
+    if channel not in client.channels:
+        return
+
+    query = None
+    if line.command == 'MODE' and len(params) == 2:
+        mode = params[1].lstrip('+')
+        if len(mode) == 1 and mode in client.chanmode_spec.p_list:
+            query = mode
+
+    sent = client._chanop_sent.get(channel, None)
+    if sent is None:
+        sent = client._chanop_sent[channel] = deque(maxlen=CHANOP_SENT_MAX)
+
+    sent.append(query)
+
+
+""" We can't do something; only fail a list fetch if it was the list """
+def dispatch_list_denied(client, line):
+    if len(line.params) < 2:
+        return
+
+    channel = line.params[1]
+    sent = client._chanop_sent.get(channel, None)
+    if not sent:
+        return
+
+    mode = sent.popleft()
+    if mode is not None:
+        client.list_fetch_failed(channel, line.params[-1], mode)
+
+
+hooks_in = (
+    (RPL_BANLIST, PRIORITY_DEFAULT, dispatch_list_entry),
+    (RPL_EXCEPTLIST, PRIORITY_DEFAULT, dispatch_list_entry),
+    (RPL_INVITELIST, PRIORITY_DEFAULT, dispatch_list_entry),
+    (RPL_QUIETLIST, PRIORITY_DEFAULT, dispatch_list_entry),
+    (RPL_ENDOFBANLIST, PRIORITY_DEFAULT, dispatch_list_end),
+    (RPL_ENDOFEXCEPTLIST, PRIORITY_DEFAULT, dispatch_list_end),
+    (RPL_ENDOFINVITELIST, PRIORITY_DEFAULT, dispatch_list_end),
+    (RPL_ENDOFQUIETLIST, PRIORITY_DEFAULT, dispatch_list_end),
+    ('MODE', PRIORITY_DECREASED, dispatch_list_mode),
+    (ERR_CHANOPRIVSNEEDED, PRIORITY_DEFAULT, dispatch_list_denied),
+)
+
+hooks_out = (
+    ('MODE', PRIORITY_LOW, dispatch_chanop_out),
+    ('KICK', PRIORITY_LOW, dispatch_chanop_out),
+    ('TOPIC', PRIORITY_LOW, dispatch_chanop_out),
+    ('INVITE', PRIORITY_LOW, dispatch_chanop_out),
+)
@@ -0,0 +1,92 @@
+""" IRCv3 BATCH handlers, applying whole batches in one pass """
+from irclib.common.dispatch import PRIORITY_DEFAULT
+from irclib.client.tracking import TRACK_MEMBERSHIP
+
+
+""" Netsplit: remove everyone who quit at once """
+def dispatch_netsplit(client, batch):
+    users = client.users
+    strangers = client.strangers
+
+    client.call_event('netsplit', tuple(batch.params[:2]))
+
+    for line in batch.lines:
+        if line.command != 'QUIT' or line.hostmask is None:
+            client.call_dispatch_in(line)
+            continue
+
+        nick = line.hostmask.nick
+        client.materialize_nick(nick)
+        user = users.pop(nick, None)
+        if user is None:
+            continue
+
+        strangers.discard(nick)
+        for ch in list(user.channels.values()):
+            ch.user_del(nick)
+
+
+""" Netjoin: add everyone who came back at once """
+def dispatch_netjoin(client, batch):
+    users = client.users
+    channels = client.channels
+    joined = []
+
+    for line in batch.lines:
+        if (line.command != 'JOIN' or line.hostmask is None or
+                client.is_current_nick(line.hostmask.nick)):
+            client.call_dispatch_in(line)
+            continue
+
+        channel = line.params[0]
+        ch = channels.get(channel, None)
+        if ch is None or ch.tracking < TRACK_MEMBERSHIP:
+            continue
+
+        nick = line.hostmask.nick
+        user = users.get(nick, None)
+        if user is None:
+            if len(line.params) > 2:
+                # extended-join
+                account = line.params[1]
+                realname = line.params[2]
+                if account == '*':
+                    account = None
+            else:
+                account = realname = None
+
+            user = client.create_user(nick, line.hostmask.user,
+                                      line.hostmask.host, realname, account)
+
+        ch.user_add(nick, user)
+        user.channel_add(channel, ch)
+        joined.append(nick)
+
+    client.unexpire_users(joined)
+    client.call_event('netsplit_end', tuple(batch.params[:2]), joined, [])
+
+
+""" Replies to a labeled request: dispatch them, then complete the request """
+def dispatch_labeled_response(client, batch):
+    for line in batch.lines:
+        client.call_dispatch_in(line)
+
+    for nested in batch.batches:
+        client.call_batch(nested)
+
+    label = batch.line.tag('label') if batch.line is not None else None
+    if label is not None:
+        client.requests.labeled(label, batch.lines)
+
+
+""" History playback isn't live state; leave it to batched_in hooks """
+def dispatch_chathistory(client, batch):
+    pass
+
+
+hooks_batch = (
+    ('netsplit', PRIORITY_DEFAULT, dispatch_netsplit),
+    ('netjoin', PRIORITY_DEFAULT, dispatch_netjoin),
+    ('chathistory', PRIORITY_DEFAULT, dispatch_chathistory),
+    ('labeled-response', PRIORITY_DEFAULT, dispatch_labeled_response),
+)
@@ -7,56 +7,136 @@ def dispatch_cap(client, line):
         'ACK' : dispatch_cap_ack,
         'LS' : dispatch_cap_ls,
         'NAK' : dispatch_cap_nak,
+        'NEW' : dispatch_cap_new,
+        'DEL' : dispatch_cap_del,
     }
-   
+
     if line.params[1] in dispatch:
         return dispatch[line.params[1]](client, line)
 
 
+""" Parse a list of caps into a dict of cap -> value (or None) """
+def cap_parse(caps):
+    ret = dict()
+    for cap in caps.split():
+        name, sep, value = cap.partition('=')
+        ret[name] = value if sep else None
+
+    return ret
+
+
+""" Continue registration once all requested caps are answered """
+def cap_negotiated(client):
+    if client.cap_end or client.cap_pending or not client.cap_listed:
+        # Runtime change, or still waiting
+        return
+
+    client.timer_cancel('cap_terminate')
+
+    if 'tls' in client.supported_cap and client.use_starttls and not client.use_ssl:
+        # Start TLS negotiation
+        client.cmdwrite('STARTTLS')
+    else:
+        # Register only if we don't need STARTTLS
+        client.dispatch_register()
+
+
 def dispatch_cap_ls(client, line):
+    # Caps may have values (CAP LS 302)
+    client.cap_values.update(cap_parse(line.params[-1]))
+
+    if len(line.params) > 3 and line.params[2] == '*':
+        # Multi-line reply, more to come
+        return
+
+    client.cap_listed = True
+
+    if client.cap_end:
+        # Nothing to negotiate
+        return
+
     client.timer_cancel('cap_terminate')
 
-    # Request common caps
-    caps = line.params[-1].split()
+    if 'sts' in client.cap_values:
+        if client.process_sts(client.cap_values['sts']):
+            # Reconnecting with TLS
+            return
 
-    common = u(' ').join(client.cap_req.intersection(caps))
+    # Request common caps
+    wanted = client.cap_wanted()
 
-    if not common:
+    if not wanted:
         # No common caps
         client.cap_terminate()
+        return
 
-    # Request common caps
-    client.cmdwrite('CAP', ('REQ', common))
+    client.cap_send_req(wanted)
 
     # Restart the timer
     client.timer_oneshot('cap_terminate', 10, client.cap_terminate)
 
 
 def dispatch_cap_ack(client, line):
-    # Cancel
-    client.timer_cancel('cap_terminate')
+    # Caps follow; a - prefix means it was disabled
+    for cap in line.params[-1].split():
+        if cap.startswith('-'):
+            cap = cap[1:]
+            client.supported_cap.discard(cap)
+        else:
+            client.supported_cap.add(cap)
 
-    # Caps follow
-    client.supported_cap = line.params[-1].lower().split()
+        client.cap_pending.discard(cap)
 
-    if 'tls' in client.supported_cap and client.use_starttls and not client.use_ssl:
-        # Start TLS negotiation
-        client.cmdwrite('STARTTLS')
-    else:
-        # Register only if we don't need STARTTLS
-        client.dispatch_register()
+    cap_negotiated(client)
 
 
 def dispatch_cap_nak(client, line):
-    client.timer_cancel('cap_terminate')
-
     client.logger.warn('caps could not be approved: {}'.format(
         line.params[-1]))
 
-    client.cap_terminate()
+    # Don't ask again, unless told to
+    for cap in line.params[-1].split():
+        client.cap_pending.discard(cap)
+        client.cap_refused.add(cap)
+
+    cap_negotiated(client)
+
+
+""" New caps are available (cap-notify) """
+def dispatch_cap_new(client, line):
+    caps = cap_parse(line.params[-1])
+    client.cap_values.update(caps)
+
+    if 'sts' in caps:
+        if client.process_sts(caps['sts']):
+            # Reconnecting with TLS
+            return
+
+    client.call_event('cap_new', caps)
+
+    if not client.cap_listed:
+        # Requested when CAP LS finishes
+        return
+
+    wanted = client.cap_wanted()
+    if wanted:
+        client.cap_send_req(wanted)
+
+
+""" Caps have gone away (cap-notify) """
+def dispatch_cap_del(client, line):
+    caps = line.params[-1].split()
+    for cap in caps:
+        client.cap_values.pop(cap, None)
+        client.supported_cap.discard(cap)
+        client.cap_pending.discard(cap)
+
+    client.call_event('cap_del', caps)
+
+    # Don't wait on replies that won't come
+    cap_negotiated(client)
 
 
 hooks_in = (
     ('CAP', PRIORITY_DEFAULT, dispatch_cap),
 )
-
@@ -0,0 +1,90 @@
+""" Fill in channel history missed while disconnected """
+from irclib.common.dispatch import PRIORITY_DEFAULT, PRIORITY_FIRST
+
+
+def is_channel(client, target):
+    chantypes = client.isupport.get('CHANTYPES', None) or '#&'
+    return bool(target) and target[0] in chantypes
+
+
+""" Keep our place in channels """
+def dispatch_history_mark(client, line):
+    if line.replay or not line.tags or not line.params:
+        return
+
+    channel = line.params[0]
+    if is_channel(client, channel):
+        client.history.note(channel, line)
+
+
+""" Fetch what we missed when we rejoin """
+def dispatch_history_join(client, line):
+    if line.hostmask is None or not client.is_current_nick(line.hostmask.nick):
+        return
+
+    channel = line.params[0]
+    client.history_fetch(channel)
+
+    # Carry on from here next time, if nothing else is said
+    if line.tags:
+        client.history.note(channel, line)
+
+
+""" The server couldn't give us history """
+def dispatch_history_fail(client, line):
+    params = line.params
+    if len(params) < 3 or params[0] != 'CHATHISTORY':
+        return
+
+    client.logger.warn('History fetch failed: {}'.format(' '.join(params[1:])))
+
+    # FAIL CHATHISTORY <code> [<subcommand> <target> ...] :<description>;
+    # which context params are given varies, so look for the target
+    inflight = client.history.inflight
+    for param in params[2:-1]:
+        if param in inflight:
+            client.history_done(param)
+            break
+
+
+""" Replay a history batch through the usual dispatch, dropping repeats """
+def dispatch_history_batch(client, batch):
+    if not batch.params:
+        return
+
+    channel = batch.params[0]
+    history = client.history
+    replayed = 0
+    last = None
+
+    for line in batch.lines:
+        if line.command not in ('PRIVMSG', 'NOTICE'):
+            # Membership and the like are already current
+            continue
+
+        msgid, time = line.tag('msgid'), line.tag('time')
+        if msgid or time:
+            last = (msgid, time)
+
+        if not history.note(channel, line):
+            continue
+
+        line.replay = True
+        client.call_dispatch_in(line)
+        replayed += 1
+
+    if channel in history.inflight:
+        client.history_done(channel, len(batch.lines), replayed, last)
+
+
+hooks_in = (
+    ('PRIVMSG', PRIORITY_FIRST, dispatch_history_mark),
+    ('NOTICE', PRIORITY_FIRST, dispatch_history_mark),
+    ('JOIN', PRIORITY_DEFAULT, dispatch_history_join),
+    ('FAIL', PRIORITY_DEFAULT, dispatch_history_fail),
+)
+
+hooks_batch = (
+    ('chathistory', PRIORITY_DEFAULT, dispatch_history_batch),
+    ('znc.in/playback', PRIORITY_DEFAULT, dispatch_history_batch),
+)
@@ -9,7 +9,7 @@ def dispatch_introspect(client, line):
     if not line.hostmask.nick:
         return
 
-    if line.hostmask.nick != client.current_nick:
+    if not client.is_current_nick(line.hostmask.nick):
         return
 
     if line.hostmask.user:
@@ -10,6 +10,7 @@ def dispatch_isupport(client, line):
         client.logger.error('ISUPPORT broken, probably old server')
         return
 
+    update_modes = False
     for token in isupport:
         name, sep, value = token.partition('=')
 
@@ -71,6 +72,17 @@ def dispatch_isupport(client, line):
         client.isupport[name] = value
         client.logger.debug('ISUPPORT token: {} {}'.format(name, value))
 
+        if name == 'CASEMAPPING':
+            client.set_casemapping(value)
+        elif name in ('PREFIX', 'CHANMODES'):
+            update_modes = True
+        elif name == 'EXTBAN':
+            for ch in client.channels.values():
+                ch.reset_masks()
+
+    if update_modes:
+        client.update_mode_spec()
+
 
 hooks_in = (
     (RPL_ISUPPORT, PRIORITY_DEFAULT, dispatch_isupport),
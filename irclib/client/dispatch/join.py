@@ -3,15 +3,19 @@ from functools import partial
 
 from irclib.common.dispatch import PRIORITY_DEFAULT
 from irclib.common.numerics import *
+from irclib.client.tracking import TRACK_CHANNELS, TRACK_MEMBERSHIP, TRACK_FULL
 
 """ Dispatch other user join """
 def dispatch_other_join(client, line):
     if not line.hostmask: return
 
-    if line.hostmask.nick == client.current_nick:
+    if client.is_current_nick(line.hostmask.nick):
         return
 
     channel = line.params[0]
+    if client.tracking_for(channel) < TRACK_MEMBERSHIP:
+        return
+
     if len(line.params) > 1:
         # extended-join
         account = line.params[1]
@@ -27,10 +31,10 @@ def dispatch_other_join(client, line):
     user = line.hostmask.user
     host = line.hostmask.host
 
-    unexpire_user(nick)
+    client.unexpire_user(nick)
 
-    # Create a user if one doesn't exist
-    if nick not in client.users:
+    # Create a user if one doesn't exist (or wasn't lost in a netsplit)
+    if nick not in client.users and not client.split_rejoin(nick, user, host):
         client.create_user(nick, user, host, realname, account)
 
     if channel in client.channels:
@@ -44,11 +48,11 @@ def dispatch_other_join(client, line):
 """ Dispatch us joining """
 def dispatch_client_join(client, line):
     if not line.hostmask: return
-    if line.hostmask.nick != client.current_nick:
+    if not client.is_current_nick(line.hostmask.nick):
         return
 
     channel = line.params[0]
-    client.pending_channels.discard(channel)
+    client.pending_channels.discard(client.casemap.fold(channel))
 
     if len(line.params) > 1:
         account = line.params[1]
@@ -57,24 +61,32 @@ def dispatch_client_join(client, line):
             client.logger.warn('We\'ve been logged out!')
             client.identified = False
 
+    level = client.tracking_for(channel)
+    if level < TRACK_CHANNELS:
+        return
+
     if channel not in client.channels:
         client.create_channel(channel)
 
     # Request modes
     client.cmdwrite('MODE', [channel])
 
+    if level < TRACK_FULL:
+        # No WHO polling
+        return
+
     if 'WHOX' in client.isupport:
-        num = randint(0, 999)
+        num = str(randint(0, 999))
         count = 0
         while num in client._whox_pending:
-            num = randint(0, 999)
+            num = str(randint(0, 999))
             count += 1
             if count > 1024: return
 
-        client._whox_pending.add(num)
+        # Replies with this token are for this channel
+        client._whox_pending[num] = client.casemap.fold(channel)
 
-        num = str(num)
-        whoparam = (channel, '%tcuisnflar,'+num)
+        whoparam = (channel, '%tcuihsnflar,'+num)
     else:
         whoparam = (channel,)
 
@@ -98,7 +110,7 @@ def dispatch_err_join(client, line):
     client.logger.warn('Could not join channel {}: {} {}'.format(
         line.params[1], line.command, line.params[-1]))
 
-    client.pending_channels.discard(line.params[1])
+    client.pending_channels.discard(client.casemap.fold(line.params[1]))
 
 
 """ Outgoing hook for pending joins """
@@ -106,18 +118,22 @@ def dispatch_pending_join(client, line):
     if len(line.params) == 0: return
 
     chlist = line.params[0].split(',')
-    client.pending_channels.update(chlist)
+    client.pending_channels.update(client.casemap.fold(ch) for ch in chlist)
 
 
 """ Dispatch timestamp setting """
 def dispatch_ts(client, line):
     channel = line.params[1]
+    if channel not in client.channels: return
+
     client.channels[channel].timestamp = int(line.params[-1])
 
 
 """ Dispatch channel URL setting """
 def dispatch_url(client, line):
     channel = line.params[1]
+    if channel not in client.channels: return
+
     client.channels[channel].url = line.params[-1]
 
 
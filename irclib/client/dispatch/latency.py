@@ -0,0 +1,78 @@
+""" Delivery latency of our own messages, using echo-message and server-time """
+from time import time
+
+try:
+    from time import monotonic
+except ImportError:
+    monotonic = time
+
+from irclib.common.dispatch import PRIORITY_FIRST, PRIORITY_LOW
+from irclib.common.util import parse_server_time
+
+
+""" Note when a lag probe actually goes out """
+def dispatch_probe_out(client, line):
+    if not line.params:
+        return
+
+    with client._latencylock:
+        probe = client._probes.get(line.params[-1], None)
+        if probe is not None and probe[1] is None:
+            probe[1] = monotonic()
+
+
+""" Remember messages we send, to time their echoes """
+def dispatch_echo_out(client, line):
+    if 'echo-message' not in client.supported_cap:
+        return
+
+    if line.cancelled or len(line.params) < 2:
+        return
+
+    with client._latencylock:
+        client._echoes.append((line.command, client.casemap.fold(line.params[0]),
+                               line.params[-1], monotonic(), time()))
+
+
+""" Match an echo to what we sent """
+def dispatch_echo_in(client, line):
+    if line.hostmask is None or line.replay or len(line.params) < 2:
+        return
+
+    if not client.is_current_nick(line.hostmask.nick):
+        return
+
+    now = monotonic()
+    target = client.casemap.fold(line.params[0])
+    message = line.params[-1]
+
+    with client._latencylock:
+        echoes = client._echoes
+        for index, echo in enumerate(echoes):
+            if echo[:3] == (line.command, target, message):
+                break
+        else:
+            return
+
+        # Earlier messages weren't echoed (or were split up)
+        for x in range(index + 1):
+            echoes.popleft()
+
+    command, target, message, sent, wall = echo
+    client.latency['echo'].add(now - sent)
+
+    stamp = parse_server_time(line.tag('time'))
+    if stamp is not None:
+        client.latency['delivery'].add(stamp - wall)
+
+
+hooks_in = (
+    ('PRIVMSG', PRIORITY_FIRST, dispatch_echo_in),
+    ('NOTICE', PRIORITY_FIRST, dispatch_echo_in),
+)
+
+hooks_out = (
+    ('PING', PRIORITY_LOW, dispatch_probe_out),
+    ('PRIVMSG', PRIORITY_LOW, dispatch_echo_out),
+    ('NOTICE', PRIORITY_LOW, dispatch_echo_out),
+)
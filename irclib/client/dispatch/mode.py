@@ -1,5 +1,4 @@
 from irclib.common.dispatch import PRIORITY_DEFAULT
-from irclib.common.six import u, b
 from irclib.common.numerics import *
 
 """ Dispatch SNOMASK storage """
@@ -10,29 +9,54 @@ def dispatch_snomask(client, line):
         client.snomask = line.params[1][1:]
 
 
-""" Dispatch MODE for channel/user """
+""" Apply channel mode changes without undoing lazy NAMES
+
+Only members named in a status mode need creating first; reading ch.modes
+would create every member.
+"""
+def apply_channel_modes(ch, modes, params):
+    if ch.names_raw:
+        # Params that aren't stored NAMES entries are left be
+        for param in params:
+            ch.materialize_nick(param)
+
+    changes = ch._modes.apply(modes, params)
+    ch.update_masks(changes)
+    return changes
+
+
+""" Dispatch MODE for channel/user
+
+The changes made are stored in line.mode_changes as a list of (adding, mode,
+param), for the benefit of later hooks.
+"""
 def dispatch_mode(client, line):
     target = line.params[0]
-    if target == client.current_nick:
+    line.mode_changes = []
+    if len(line.params) < 2:
+        return
+
+    if client.is_current_nick(target):
         # Us
-        modestring = u(' ').join(line.params[1:])
-        client.umodes.parse_modestring(modestring)
+        line.mode_changes = client.umodes.apply(line.params[1],
+                                                line.params[2:])
         return
 
     ch = client.channels.get(target, None)
     if ch is None: return
 
-    modestring = u(' ').join(line.params[1:])
-    ch.modes.parse_modestring(modestring)
+    line.mode_changes = apply_channel_modes(ch, line.params[1],
+                                            line.params[2:])
 
 
 """ Dispatch mode setting """
 def dispatch_rpl_mode(client, line):
+    line.mode_changes = []
     ch = client.channels.get(line.params[1], None)
     if ch is None: return
 
-    modestring = u(' ').join(line.params[2:])
-    ch.modes.parse_modestring(modestring)
+    line.mode_changes = apply_channel_modes(ch, line.params[2],
+                                            line.params[3:])
 
 
 hooks_in = (
@@ -1,38 +1,37 @@
 from irclib.common.dispatch import PRIORITY_DEFAULT
 from irclib.common.numerics import *
+from irclib.client.tracking import TRACK_MEMBERSHIP
 
-""" Dispatch names """
+""" Dispatch names
+
+Replies are buffered until RPL_ENDOFNAMES, then applied in one go.
+"""
 def dispatch_names(client, line):
     ch = client.channels.get(line.params[2], None)
-    if ch is None: return
+    if ch is None or ch.tracking < TRACK_MEMBERSHIP: return
 
-    nicks = line.params[-1].split()
-    for nick in nicks:
-        # Go through each character in the nick
-        # look for channel prefixes
-        mode = []
-        while nick[0] in client.prefix_to_mode:
-            # Shift
-            prefix = nick[0]
-            nick = nick[1:]
-            mode.append(client.prefix_to_mode[prefix])
+    ch.names_buffer.append(line.params[-1])
 
-        # Apply
-        for m in mode:
-            ch.modes.add_mode(m, nick)
 
-        # Add the user
-        if nick not in client.users:
-            client.create_user(nick)
+""" Dispatch end of names """
+def dispatch_end_names(client, line):
+    ch = client.channels.get(line.params[1], None)
+    if ch is None: return
 
-        # Add channel to user
-        client.users[nick].channel_add(ch.name, ch)
+    buf = ch.names_buffer
+    if not buf: return
 
-        # Add user to channel
-        ch.user_add(nick, client.users[nick])
+    ch.names_buffer = []
+
+    if client.names_lazy:
+        # Keep them until someone looks
+        ch.names_raw.update(client.index_names(buf))
+    else:
+        client.apply_names(ch, (token for payload in buf for token in
+                                payload.split()))
 
 
 hooks_in = (
     (RPL_NAMREPLY, PRIORITY_DEFAULT, dispatch_names),
+    (RPL_ENDOFNAMES, PRIORITY_DEFAULT, dispatch_end_names),
 )
-
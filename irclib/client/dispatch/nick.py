@@ -2,36 +2,38 @@ from random import randint
 
 from irclib.common.dispatch import PRIORITY_DEFAULT
 from irclib.common.numerics import *
+from irclib.client.tracking import TRACK_FULL
 
 """ Nickname tracking """
 def dispatch_nick(client, line):
     oldnick = line.hostmask.nick
-    newnick = line.param[-1]
+    newnick = line.params[-1]
 
     # We might even have these :P
     user = line.hostmask.user
     host = line.hostmask.host
 
-    if oldnick == client.current_nick:
+    if client.is_current_nick(oldnick):
         # Our own nick
         client.current_nick = newnick
         return
 
     # Other user's nick
+    client.materialize_nick(oldnick)
+
     if oldnick in client.users:
-        client.users[newnick] = client.users[oldnick]
-        client.users[newnick].nick = newnick
-        client.users[newnick].user = user
-        client.users[newnick].host = host
+        # Pop first; the new nick may fold the same as the old one
+        u = client.users.pop(oldnick)
+        client.users[newnick] = u
+        client.strangers.rename(oldnick, newnick)
+        u.nick = newnick
+        if user: u.user = user
+        if host: u.host = host
 
         # Update in channels
-        for channel, ch in client.channels.items():
-            if oldnick in ch.users:
-                ch.user_rename(oldnick, newnick)
-
-        # Delete the old nick :3
-        del client.users[oldnick]
-    else:
+        for ch in list(u.channels.values()):
+            ch.user_rename(oldnick, newnick)
+    elif client.tracking_for() >= TRACK_FULL:
         client.logger.debug('Got a nick change for unknown user {}:{}'.format(
             oldnick, newnick))
         # Not sure why this is happening but ok.
@@ -90,7 +92,7 @@ def dispatch_alt_nick(client, line):
     client.cmdwrite('NICK', [nick])
 
 
-hook_in = (
+hooks_in = (
     ('NICK', PRIORITY_DEFAULT, dispatch_nick),
     (ERR_ERRONEUSNICKNAME, PRIORITY_DEFAULT, dispatch_alt_nick),
     (ERR_NICKNAMEINUSE, PRIORITY_DEFAULT, dispatch_alt_nick),
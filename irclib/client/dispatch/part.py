@@ -1,18 +1,27 @@
 from functools import partial
 
 from irclib.common.dispatch import PRIORITY_DEFAULT
+from irclib.client.tracking import TRACK_CHANNELS, TRACK_FULL
 
 """ Dispatch foreign user """
 def dispatch_other_part(client, line):
     if not line.hostmask: return
 
-    if line.hostmask.nick != client.current_nick:
+    if line.command == 'KICK':
+        nick = line.params[1]
+    else:
+        nick = line.hostmask.nick
+
+    if client.is_current_nick(nick):
         return
 
-    nick = line.hostmask.nick
     channel = line.params[0]
 
     if channel not in client.channels:
+        if client.tracking_for(channel) < TRACK_CHANNELS:
+            # Not tracked
+            return
+
         client.logger.critical('DESYNC detected! Part detected in a channel we '
                                'did NOT know about!')
         return
@@ -31,22 +40,54 @@ def dispatch_other_part(client, line):
 def dispatch_self_part(client, line):
     if not line.hostmask: return
 
-    if line.hostmask.nick != client.current_nick:
+    if line.command == 'KICK':
+        nick = line.params[1]
+    else:
+        nick = line.hostmask.nick
+
+    if not client.is_current_nick(nick):
         return
 
     channel = line.params[0]
-    client.pending_channels.discard(channel)
+    folded = client.casemap.fold(channel)
+    client.pending_channels.discard(folded)
 
-    ch = client.channels.pop(channel, None)
-    if ch is None: return
+    # Stop polling it
+    for rid, whochannel in list(client._whox_pending.items()):
+        if whochannel == folded:
+            del client._whox_pending[rid]
+
+    try:
+        client.timer_cancel('sendwho_{}'.format(channel))
+        client.timer_cancel('sendwho_r_{}'.format(channel))
+    except ValueError:
+        pass
 
-    if not ch.parting:
+    ch = client.channels.pop(channel, None)
+    if ch is None:
+        if client.tracking_for(channel) >= TRACK_CHANNELS:
+            return
+
+        # Untracked; we only know about kicks
+        parting = line.command != 'KICK'
+        key = client.channel_keys.get(channel, '')
+    else:
+        parting = ch.parting
+        key = ch.modes.is_set('k')
+
+        if ch.tracking < TRACK_FULL:
+            # Nothing expires these users, so forget them now
+            for nick, user in list(ch.users.items()):
+                user.channel_del(channel)
+                if not user.channels:
+                    client.delete_user(nick)
+
+    if not parting:
         client.logger.warn('Removed from channel {}'.format(channel))
 
-    if line.command == 'KICK' or not ch.parting:
+    if line.command == 'KICK' or not parting:
         if client.autorejoin:
             # Use key if needed
-            key = ch.modes.has_mode('k')
             if not key:
                 key = ''
 
@@ -61,7 +102,8 @@ def dispatch_pending_part(client, line):
     if len(line.params) == 0: return
 
     chlist = line.params[0].split(',')
-    client.pending_channels.difference_update(chlist)
+    client.pending_channels.difference_update(client.casemap.fold(ch)
+                                              for ch in chlist)
 
     for channel in chlist:
         if channel not in client.channels: continue
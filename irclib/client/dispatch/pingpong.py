@@ -1,5 +1,3 @@
-from time import time
-
 from irclib.common.dispatch import PRIORITY_DEFAULT
 
 """ Generic dispatcher for ping """
@@ -9,19 +7,10 @@ def dispatch_ping(client, line):
 
 """ Dispatches keepalive message """
 def dispatch_pong(client, line):
-    if client._last_pingstr is None:
-        return
-
-    if line.params[-1] != client._last_pingstr:
-        return
-
-    client._last_pingstr = None
-    client.lag = time() - client._last_pingtime
-    client.logger.info('LAG: {}'.format(client.lag))
+    client.lag_pong(line.params[-1])
 
 
 hooks_in = (
     ('PING', PRIORITY_DEFAULT, dispatch_ping),
     ('PONG', PRIORITY_DEFAULT, dispatch_pong),
 )
-
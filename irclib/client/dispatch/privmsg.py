@@ -6,16 +6,20 @@ from irclib.common.dispatch import (PRIORITY_DEFAULT, PRIORITY_LOW,
                                     PRIORITY_FIRST)
 from irclib.common.line import Line, Hostmask
 from irclib.common.util import splitstr
+from irclib.client.tracking import TRACK_FULL
 
 
 """ Foreign privmsg (NOT CTCP) """
 def dispatch_privmsg(client, line):
-    if line.hostmask is None:
+    if line.hostmask is None or line.replay:
         return
 
     nick = line.hostmask.nick
+    if nick not in client.users:
+        # May only be in stored NAMES entries so far
+        client.materialize_nick(nick)
 
-    if line.params[0] != client.current_nick:
+    if not client.is_current_nick(line.params[0]):
         # Update just in case (for old ircd's/hyperion)
         user = line.hostmask.user
         host = line.hostmask.host
@@ -24,6 +28,18 @@ def dispatch_privmsg(client, line):
             client.users[nick].user = user
             client.users[nick].host = host
 
+    if client.is_current_nick(nick):
+        # Our own message, echoed back (echo-message); we're no stranger
+        return
+
+    if client.tracking_for() < TRACK_FULL:
+        # Not keeping track of strangers
+        return
+
+    if client.strangers.touch(nick):
+        # Still around
+        return
+
     if nick not in client.users:
         # TODO - maybe whois?
         client.create_user(nick, line.hostmask.user, line.hostmask.host)
@@ -37,10 +53,14 @@ def dispatch_ctcp_in(client, line):
     if len(line.params) <= 1:
         return
 
-    if not line.hostmask:
+    if not line.hostmask or line.replay:
         return
 
     target = line.hostmask.nick 
+    if client.is_current_nick(target):
+        # Our own message, echoed back (echo-message)
+        return
+
     message = line.params[-1]
 
     if not (message.startswith('\x01') or message.endswith('\x01')):
@@ -1,14 +1,30 @@
 from irclib.common.dispatch import PRIORITY_DEFAULT
+from irclib.client.netsplit import split_servers
 
 """ Dispatch quitting """
 def dispatch_quit(client, line):
-    if line.hostmask.nick == client.current_nick:
+    if client.is_current_nick(line.hostmask.nick):
         client.logger.info('Quitting network')
         return
 
     nick = line.hostmask.nick
-    if nick in client.users:
-        client.users.pop(nick, None)
+    client.materialize_nick(nick)
+
+    if client.split_detect and line.params:
+        servers = split_servers(line.params[-1])
+        if servers is not None:
+            # Keep them for when they come back
+            client.split_park(servers, nick)
+            return
+
+    user = client.users.pop(nick, None)
+    if user is None:
+        return
+
+    client.strangers.discard(nick)
+
+    for ch in list(user.channels.values()):
+        ch.user_del(nick)
 
 
 hooks_in = (
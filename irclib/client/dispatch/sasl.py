@@ -3,43 +3,114 @@ import base64
 from irclib.common.dispatch import PRIORITY_DEFAULT
 from irclib.common.util import splitstr
 from irclib.common.numerics import *
+from irclib.client.scram import ScramClient, SCRAM_MECHANISMS
 
-""" Authenticate to the server
+""" Send a SASL payload, split as needed """
+def sasl_send(client, data):
+    send = base64.b64encode(data.encode('utf-8'))
+    send = send.decode('ascii')
 
-TODO - other auth types
-"""
+    # Split into 400 byte chunks
+    split = splitstr(send, 400) or ['+']
+    for item in split:
+        client.cmdwrite('AUTHENTICATE', [item])
+
+    # Padding, if needed
+    if len(split[-1]) == 400:
+        client.cmdwrite('AUTHENTICATE', ['+'])
+
+
+""" Abort SASL """
+def sasl_abort(client, reason):
+    client.logger.error('SASL auth aborted: {}'.format(reason))
+    client.sasl_state = None
+    client.cmdwrite('AUTHENTICATE', ['*'])
+
+
+""" Authenticate to the server """
 def dispatch_sasl_authenticate(client, line):
     client.timer_cancel('cap_terminate')
 
-    # We got an authentication message?
-    if line.params[0] != '+':
-       client.logger.warn('Unexpected response from SASL auth agent, '
-                          'continuing')
+    if client.identified:
+        return
+
+    # Reassemble the server's message
+    param = line.params[0]
+    if param != '+':
+        client.sasl_buffer.append(param)
+        if len(param) == 400:
+            # More to come
+            return
+
+    data = ''.join(client.sasl_buffer)
+    client.sasl_buffer = []
+
+    try:
+        data = base64.b64decode(data).decode('utf-8')
+    except (TypeError, ValueError):
+        sasl_abort(client, 'Undecodable message from server')
+        return
+
+    if client.sasl_mechanism in SCRAM_MECHANISMS:
+        dispatch_sasl_scram(client, data)
+    else:
+        if param != '+':
+            client.logger.warn('Unexpected response from SASL auth agent, '
+                               'continuing')
 
-    if not client.identified:
         # Generate
         send = '{acct}\0{acct}\0{pw}'.format(acct=client.sasl_username,
                                              pw=client.sasl_pw)
-        send = base64.b64encode(send.encode('utf-8'))
-        send = send.decode('ascii')
+        sasl_send(client, send)
+
+    # Timeout authentication
+    client.timer_oneshot('cap_terminate', 15, client.cap_terminate)
+
 
-        # Split into 400 byte chunks
-        split = splitstr(send, 400)
-        for item in split:
-            client.cmdwrite('AUTHENTICATE', [item])
- 
-        # Padding, if needed
-        if len(split[-1]) == 400:
-            client.cmdwrite('AUTHENTICATE', ['+'])
+""" Step through a SCRAM exchange """
+def dispatch_sasl_scram(client, data):
+    state = client.sasl_state
 
-        # Timeout authentication
-        client.timer_oneshot('cap_terminate', 15, client.cap_terminate)
+    if state is None:
+        # Start
+        scram = ScramClient(client.sasl_mechanism, client.sasl_username,
+                            client.sasl_pw, client.scram_cache)
+        client.sasl_state = scram
+        sasl_send(client, scram.first())
+    elif state.auth_message is None:
+        # Server first; the key derivation may happen in another thread
+        try:
+            future = state.final(data)
+        except ValueError as e:
+            sasl_abort(client, str(e))
+            return
+
+        def send_final(future):
+            if client.sasl_state is not state:
+                # Gone
+                return
+
+            if future.exception() is not None:
+                sasl_abort(client, str(future.exception()))
+                return
+
+            sasl_send(client, future.result())
+
+        future.add_done_callback(send_final)
+    else:
+        # Server final
+        if not state.verify(data):
+            sasl_abort(client, 'Server signature did not verify')
+            return
+
+        client.cmdwrite('AUTHENTICATE', ['+'])
 
 
 def dispatch_sasl_success(client, line):
     client.timer_cancel('cap_terminate')
 
     client.identified = True
+    client.sasl_state = None
     if line.command == RPL_SASLSUCCESS:
         # end CAP
         client.cap_terminate()
@@ -47,6 +118,7 @@ def dispatch_sasl_success(client, line):
 
 def dispatch_sasl_error(client, line):
     client.timer_cancel('cap_terminate')
+    client.sasl_state = None
 
     # SASL failed
     client.logger.error('SASL auth failed! Error: {} {}'.format(
@@ -62,4 +134,3 @@ hooks_in = (
     (ERR_SASLFAIL, PRIORITY_DEFAULT, dispatch_sasl_error),
     (ERR_SASLTOOLONG, PRIORITY_DEFAULT, dispatch_sasl_error),
 )
-
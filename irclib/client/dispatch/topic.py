@@ -2,12 +2,16 @@ from time import time
 
 from irclib.common.dispatch import PRIORITY_DEFAULT
 from irclib.common.numerics import *
+from irclib.client.tracking import TRACK_CHANNELS
 
 """ Dispatch the channel topic """
 def dispatch_rpl_topic(client, line):
     channel = line.params[1]
 
     if channel not in client.channels:
+        if client.tracking_for(channel) < TRACK_CHANNELS:
+            return
+
         client.logger.critical('DESYNC detected! got a topic for a channel we '
                                'are not in!')
         return
@@ -20,6 +24,9 @@ def dispatch_rpl_topictime(client, line):
     channel = line.params[1]
 
     if channel not in client.channels:
+        if client.tracking_for(channel) < TRACK_CHANNELS:
+            return
+
         client.logger.critical('DESYNC detected! got a topic for a channel we '
                                'are not in!')
         return
@@ -33,6 +40,9 @@ def dispatch_topic(client, line):
     channel = line.params[0]
 
     if channel not in client.channels:
+        if client.tracking_for(channel) < TRACK_CHANNELS:
+            return
+
         client.logger.critical('DESYNC detected! got a topic for a channel we '
                                'are not in!')
         return
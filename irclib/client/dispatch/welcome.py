@@ -1,20 +1,11 @@
 from irclib.common.dispatch import PRIORITY_DEFAULT
 from irclib.common.numerics import *
-from irclib.common.util import randomstr
 
-from socket import error as SocketError
-from time import time
 from functools import partial
 
 """ Sends a keepalive message """
 def dispatch_keepalive(client):
-    if client._last_pingstr is not None:
-        raise SocketError('Socket timed out')
-
-    client._last_pingtime = time()
-    client._last_pingstr = randomstr()
-
-    client.cmdwrite('PING', [client._last_pingstr])
+    client.lag_probe()
 
 
 """ Generic dispatch for RPL_WELCOME 
@@ -2,7 +2,7 @@ from irclib.common.dispatch import PRIORITY_DEFAULT
 from irclib.common.numerics import *
 
 """ Parse flags in WHO """
-def parse_flags(client, flags):
+def parse_flags(client, nick, channel, flags):
     # Parse the status field
     for char in flags:
         if char == '*':
@@ -19,7 +19,8 @@ def parse_flags(client, flags):
             # Add the status mode
             ch = client.channels[channel]
             mode = client.prefix_to_mode[char]
-            ch.modes.add_mode(mode, nick)
+            ch.materialize_nick(nick)
+            ch.status_add(nick, mode)
         else:
             client.logger.info('Unknown WHO symbol recieved: {}'.format(char))
 
@@ -30,7 +31,7 @@ def dispatch_who(client, line):
         # Shift
         params = line.params[1:]
         # Fucking eh, WHO is a crock of shit
-        channel, username, host, server, nick, flags, other = params
+        channel, user, host, server, nick, flags, other = params
     except ValueError:
         # I give up.
         client.logger.warn('Could not parse WHO reply ({})'.format(str(line)))
@@ -58,13 +59,13 @@ def dispatch_who(client, line):
     # Set this...
     client.users[nick].server = server
 
-    parse_flags(client, flags)
+    parse_flags(client, nick, channel, flags)
 
 
 """ Dispatch whox """
 def dispatch_whox(client, line):
     # Check param count
-    if len(line.params) != 11:
+    if len(line.params) != 12:
         client.logger.debug('Wrong param count for WHOX')
         return
 
@@ -73,8 +74,8 @@ def dispatch_whox(client, line):
 
     # unpack
     try:
-        rid, channel, user, ip, server = params[:5]
-        nick, flags, idle, account, realname = params[5:]
+        rid, channel, user, ip, host, server = params[:6]
+        nick, flags, idle, account, realname = params[6:]
     except ValueError:
         client.logger.warn('Could not parse WHOX reply ({})'.format(str(line)))
         return
@@ -82,15 +83,15 @@ def dispatch_whox(client, line):
     # Check if we requested it
     if rid not in client._whox_pending:
         return
-    else:
-        client._last_rid = rid
 
     # Don't care
     if channel == '*':
         return
-    elif channel not in client.channels:
+    elif client._whox_pending[rid] != client.casemap.fold(channel):
         # Weird. must be someone else's whox check?
         return
+    elif channel not in client.channels:
+        return
 
     # Not logged in
     if account == '0':
@@ -113,20 +114,11 @@ def dispatch_whox(client, line):
     client.users[nick].ip = ip
     client.users[nick].server = server
 
-    parse_flags(client, flags)
-
-
-""" End of whox """
-def dispatch_end_whox(client, line):
-    lastrid = getattr(client, '_last_rid', None)
-    if lastrid is None: return
-
-    client._whox_pending.discard(lastrid)
+    parse_flags(client, nick, channel, flags)
 
 
 hooks_in = (
     (RPL_WHOREPLY, PRIORITY_DEFAULT, dispatch_who),
     (RPL_WHOSPCRPL, PRIORITY_DEFAULT, dispatch_whox),
-    (RPL_ENDOFWHO, PRIORITY_DEFAULT, dispatch_end_whox),
 )
 
@@ -1,15 +1,29 @@
 from irclib.common.dispatch import PRIORITY_DEFAULT
 from irclib.common.numerics import *
 
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
 """ Dispatch WHOIS """
 def dispatch_whois(client, line):
     info = line.command
     nick = line.params[1]
     if nick not in client.users:
-        return
+        if info != RPL_WHOISUSER or nick not in client._whois_inflight:
+            return
+
+        # Someone asked for this user with client.whois
+        client.create_user(nick)
+        client.expire_user(nick)
+        if nick not in client.users:
+            # Not tracking them
+            return
 
     if info == RPL_WHOISUSER:
-        client.user, client.host, unused, client.realname = line.params[2:]
+        u = client.users[nick]
+        u.user, u.host, unused, u.realname = line.params[2:]
     elif info == RPL_WHOISCHANNELS:
         # Through each channel
         channels = line.params[-1].split()
@@ -17,22 +31,22 @@ def dispatch_whois(client, line):
         for channel in channels:
             mode = [] 
             orig = channel
-            while channel[0] in client.prefix_to_modes:
+            while channel[0] in client.prefix_to_mode:
                 # Check for broken servers etc.
                 if (channel[0] in chantypes and channel[1] not in chantypes and
-                    channel[1] not in client.prefix_to_modes):
+                    channel[1] not in client.prefix_to_mode):
                     break
 
                 # Add the mode to the list
-                mode.append(client.prefix_to_modes[channel[0]])
+                mode.append(client.prefix_to_mode[channel[0]])
                 channel = channel[1:]
 
             if channel not in client.channels: continue
 
             ch = client.channels[channel]
 
-            for m in mode:
-                ch.modes.add_mode(m, nick)
+            ch.materialize_nick(nick)
+            ch.status_add(nick, mode)
 
             # Add user to channel and vice versa
             client.users[nick].channel_add(channel, ch)
@@ -63,6 +77,8 @@ def dispatch_whois(client, line):
             # No account ... ?
             client.users[nick].account = ''
 
+        client.users[nick].whois_time = monotonic()
+
 hooks_in = (
     (RPL_WHOISUSER, PRIORITY_DEFAULT, dispatch_whois),
     (RPL_WHOISCHANNELS, PRIORITY_DEFAULT, dispatch_whois),
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+
+""" Run fleets of clients sharded across worker processes """
+
+import logging
+import multiprocessing
+
+from bisect import bisect
+from hashlib import md5
+from threading import Thread, Event, RLock
+
+from irclib.client.client import IRCClient
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+
+""" Consistent hash ring mapping keys to nodes
+
+>>> ring = HashRing(range(4))
+>>> ring.get('irc.example.org/bot') in range(4)
+True
+"""
+class HashRing(object):
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.ring = dict()
+        self.keys = []
+
+        for node in nodes:
+            self.add(node)
+
+
+    @staticmethod
+    def hash(key):
+        return int(md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+    """ Add a node to the ring """
+    def add(self, node):
+        for i in range(self.replicas):
+            key = self.hash('{}:{}'.format(node, i))
+            self.ring[key] = node
+
+        self.keys = sorted(self.ring)
+
+
+    """ Remove a node from the ring """
+    def remove(self, node):
+        for i in range(self.replicas):
+            self.ring.pop(self.hash('{}:{}'.format(node, i)), None)
+
+        self.keys = sorted(self.ring)
+
+
+    """ Get the node responsible for a key """
+    def get(self, key):
+        if not self.keys:
+            raise ValueError('No nodes in ring')
+
+        index = bisect(self.keys, self.hash(key)) % len(self.keys)
+        return self.ring[self.keys[index]]
+
+
+""" Run one client forever, reconnecting as needed
+
+Reports connecting, connected, and disconnected (with the error, if any)
+events for each connection attempt.
+"""
+def _run_client(name, client, events, stop, reconnect_wait, event_commands):
+    while not stop.is_set():
+        connected = False
+        error = None
+        try:
+            events.put((name, 'connecting', None))
+            for line in client.get_lines():
+                if not connected and client.connected:
+                    connected = True
+                    events.put((name, 'connected', None))
+
+                if event_commands is None or line.command in event_commands:
+                    events.put((name, 'line', str(line)))
+
+                if stop.is_set():
+                    break
+        except Exception as e:
+            error = str(e)
+
+        events.put((name, 'disconnected', error))
+        client.disconnect()
+        if not stop.is_set():
+            stop.wait(reconnect_wait)
+
+
+""" Worker process entry point """
+def _worker_main(index, configs, commands, events, client_class,
+                 reconnect_wait, event_commands):
+    logger = logging.getLogger(__name__)
+    clients = dict()
+    stop = Event()
+
+    def start_client(name, kwargs):
+        if name in clients:
+            logger.warn('Worker {}: duplicate client {}'.format(index, name))
+            return
+
+        client = client_class(**kwargs)
+        clients[name] = client
+
+        thread = Thread(target=_run_client, name='client_{}'.format(name),
+                        args=(name, client, events, stop, reconnect_wait,
+                              event_commands))
+        thread.daemon = True
+        thread.start()
+
+    for name, kwargs in configs.items():
+        start_client(name, kwargs)
+
+    # Control channel
+    while True:
+        item = commands.get()
+        if item[0] == 'stop':
+            break
+        elif item[0] == 'add':
+            start_client(item[1], item[2])
+        elif item[0] == 'cmd':
+            name, command, params = item[1:]
+            client = clients.get(name, None)
+            if client is None or not client.connected:
+                events.put((name, 'error', 'Not connected'))
+                continue
+
+            try:
+                client.cmdwrite(command, params)
+            except Exception as e:
+                events.put((name, 'error', str(e)))
+
+    stop.set()
+    for client in clients.values():
+        client.disconnect()
+
+
+""" Supervises a fleet of clients sharded across worker processes
+
+Connections are assigned to workers by consistent hashing of their name (by
+default "host/nick"), so a given connection always lands on the same worker.
+Crashed workers are restarted with the same connections.
+
+workers - number of worker processes (default is the number of CPUs)
+client_class - IRCClient subclass to run; must be importable by workers
+reconnect_wait - time to wait before reconnecting a connection
+event_commands - commands to forward as events (default is all of them)
+check_interval - how often to check for dead workers
+"""
+class Fleet(object):
+    def __init__(self, workers=None, client_class=IRCClient, reconnect_wait=5,
+                 event_commands=None, check_interval=1):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        self.workers = workers
+        self.client_class = client_class
+        self.reconnect_wait = reconnect_wait
+        if event_commands is not None:
+            event_commands = frozenset(event_commands)
+        self.event_commands = event_commands
+        self.check_interval = check_interval
+
+        self.ring = HashRing(range(workers))
+        self.configs = [dict() for x in range(workers)]
+        self.processes = [None] * workers
+        self.commands = [None] * workers
+        self.events_queue = multiprocessing.Queue()
+
+        # Restart counts per worker
+        self.restarts = [0] * workers
+
+        self.running = False
+        self.stopped = Event()
+        self.lock = RLock()
+
+        self.logger = logging.getLogger(__name__)
+
+
+    """ Work out the connection name for a config """
+    @staticmethod
+    def connection_name(kwargs):
+        return '{}/{}'.format(kwargs.get('host'), kwargs.get('nick', 'irclib'))
+
+
+    """ Get the worker index for a connection """
+    def worker_for(self, name):
+        return self.ring.get(name)
+
+
+    """ Add a connection to the fleet; returns its name """
+    def add(self, name=None, **kwargs):
+        if name is None:
+            name = self.connection_name(kwargs)
+
+        index = self.worker_for(name)
+        with self.lock:
+            if name in self.configs[index]:
+                raise ValueError('Duplicate connection {}'.format(name))
+
+            self.configs[index][name] = kwargs
+            if self.running:
+                self.commands[index].put(('add', name, kwargs))
+
+        return name
+
+
+    """ Start a worker process """
+    def spawn(self, index):
+        commands = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_worker_main,
+                                          name='irclib_worker_{}'.format(index),
+                                          args=(index, self.configs[index],
+                                                commands, self.events_queue,
+                                                self.client_class,
+                                                self.reconnect_wait,
+                                                self.event_commands))
+        process.daemon = True
+        process.start()
+
+        self.processes[index] = process
+        self.commands[index] = commands
+
+
+    """ Start all workers and the supervisor """
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+
+            self.running = True
+            self.stopped.clear()
+            for index in range(self.workers):
+                self.spawn(index)
+
+        thread = Thread(target=self.supervise, name='irclib_fleet_supervisor')
+        thread.daemon = True
+        thread.start()
+
+
+    """ Restart dead workers """
+    def supervise(self):
+        while not self.stopped.wait(self.check_interval):
+            with self.lock:
+                if not self.running:
+                    break
+
+                for index, process in enumerate(self.processes):
+                    if process.is_alive():
+                        continue
+
+                    self.logger.warn('Worker {} died (exit code {}), '
+                                     'restarting'.format(index,
+                                                         process.exitcode))
+                    self.restarts[index] += 1
+                    self.spawn(index)
+
+
+    """ Send a command on a given connection """
+    def send(self, name, command, params=[]):
+        index = self.worker_for(name)
+        if name not in self.configs[index]:
+            raise ValueError('No such connection {}'.format(name))
+
+        self.commands[index].put(('cmd', name, command, list(params)))
+
+
+    """ Get the next event as (name, kind, data)
+
+    kind is one of 'connecting', 'connected', 'line', 'disconnected', or
+    'error'. data is the line for 'line', and the error (or None) for
+    'disconnected' and 'error'. Returns None on timeout.
+    """
+    def get_event(self, timeout=None):
+        try:
+            return self.events_queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+
+    """ Generator for events, e.g. non-terminating stream """
+    def events(self):
+        while self.running:
+            event = self.get_event(self.check_interval)
+            if event is not None:
+                yield event
+
+
+    """ Stop all workers """
+    def stop(self, timeout=5):
+        with self.lock:
+            if not self.running:
+                return
+
+            self.running = False
+            self.stopped.set()
+
+            for index, process in enumerate(self.processes):
+                self.commands[index].put(('stop',))
+
+            for process in self.processes:
+                process.join(timeout)
+                if process.is_alive():
+                    process.terminate()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
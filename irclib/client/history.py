@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+""" Channel history, for filling in what was missed while disconnected """
+
+from __future__ import unicode_literals
+
+from collections import deque
+from threading import RLock
+
+from irclib.common.casemap import CaseFoldDict
+from irclib.common.util import parse_server_time
+
+
+""" Where we got to in a channel, and the messages seen there recently
+
+dedupe - number of recent messages remembered, to drop repeats
+"""
+class ChannelMark(object):
+    def __init__(self, dedupe=1000):
+        # Newest message seen (msgid and server-time tags)
+        self.msgid = None
+        self.time = None
+        self.stamp = None
+
+        self.seen = set()
+        self.order = deque()
+        self.dedupe = dedupe
+
+
+    """ Identify a message, by msgid if it has one """
+    @staticmethod
+    def key(line):
+        msgid = line.tag('msgid')
+        if msgid is not None:
+            return msgid
+
+        nick = line.hostmask.nick if line.hostmask is not None else None
+        return (line.tag('time'), nick, line.command, line.params[-1] if
+                line.params else None)
+
+
+    """ Record a message; returns False if it's been seen already """
+    def add(self, line):
+        key = self.key(line)
+        if key in self.seen:
+            return False
+
+        self.seen.add(key)
+        self.order.append(key)
+        if len(self.order) > self.dedupe:
+            self.seen.discard(self.order.popleft())
+
+        time = line.tag('time')
+        stamp = parse_server_time(time)
+        if stamp is not None and self.stamp is not None and stamp < self.stamp:
+            # Older than where we are (e.g. history); don't go backwards
+            return True
+
+        self.msgid = line.tag('msgid')
+        if stamp is not None:
+            self.time = time
+            self.stamp = stamp
+
+        return True
+
+
+    """ Where to fetch history from, as (msgid, time), or None """
+    def after(self):
+        if self.msgid is None and self.time is None:
+            return None
+
+        return (self.msgid, self.time)
+
+
+""" A history fetch for one channel
+
+after - (msgid, time) to fetch from
+replayed - messages replayed so far (over all pages)
+"""
+class HistoryFetch(object):
+    def __init__(self, channel, after, replayed=0):
+        self.channel = channel
+        self.after = after
+        self.replayed = replayed
+
+
+""" Keeps channel marks across reconnects, and schedules history fetches
+
+Fetches are queued, and at most a set number are started at once; see
+start().
+"""
+class HistoryTracker(object):
+    def __init__(self, casemap, dedupe=1000):
+        self.casemap = casemap
+        self.dedupe = dedupe
+
+        # Channel -> ChannelMark; these outlive the connection
+        self.marks = CaseFoldDict(casemap)
+
+        # Waiting and running fetches
+        self.queue = deque()
+        self.inflight = CaseFoldDict(casemap)
+
+        self.lock = RLock()
+
+
+    """ Record a message in a channel; returns False if it's a repeat """
+    def note(self, channel, line):
+        with self.lock:
+            mark = self.marks.get(channel, None)
+            if mark is None:
+                mark = self.marks[channel] = ChannelMark(self.dedupe)
+
+            return mark.add(line)
+
+
+    """ Where to fetch a channel's history from, or None if we've no mark """
+    def after(self, channel):
+        mark = self.marks.get(channel, None)
+        if mark is None:
+            return None
+
+        return mark.after()
+
+
+    """ Queue a fetch; returns False if one is already queued or running """
+    def add(self, fetch, first=False):
+        with self.lock:
+            channel = fetch.channel
+            if channel in self.inflight or any(self.casemap.equal(channel,
+                                                                  f.channel)
+                                               for f in self.queue):
+                return False
+
+            if first:
+                self.queue.appendleft(fetch)
+            else:
+                self.queue.append(fetch)
+
+            return True
+
+
+    """ Take queued fetches to start, keeping at most concurrency running """
+    def start(self, concurrency):
+        with self.lock:
+            started = []
+            while self.queue and len(self.inflight) < concurrency:
+                fetch = self.queue.popleft()
+                self.inflight[fetch.channel] = fetch
+                started.append(fetch)
+
+            return started
+
+
+    """ Stop tracking a running fetch; returns it, or None """
+    def finish(self, channel):
+        with self.lock:
+            return self.inflight.pop(channel, None)
+
+
+    """ Drop all fetches (e.g. on disconnect); marks are kept """
+    def clear_fetches(self):
+        with self.lock:
+            self.queue.clear()
+            self.inflight.clear()
+
+
+    """ Re-fold channel names, after the case mapping changes """
+    def rekey(self):
+        with self.lock:
+            self.marks.rekey()
+            self.inflight.rekey()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+""" Metrics for a client, reported into a MetricsRegistry """
+
+from __future__ import unicode_literals
+
+import weakref
+
+
+""" A client's view of a MetricsRegistry
+
+Per-line figures (lines, bytes, dispatch time) are counted as they happen;
+everything else (queues, buffers, timers, tracked state, latency) is read
+from the client only when the registry is collected.
+
+client - the IRCClient
+registry - MetricsRegistry to report into (may be shared by many clients)
+name - value of the client label (default host:port)
+"""
+class ClientMetrics(object):
+    def __init__(self, client, registry, name=None):
+        if name is None:
+            name = '{}:{}'.format(client.host, client.port)
+
+        self.name = name
+        self.registry = registry
+        label = (name,)
+
+        self.lines = registry.counter('irclib_lines_total',
+                                      'Lines by direction and command',
+                                      ('client', 'direction', 'command'))
+        self.bytes = registry.counter('irclib_line_bytes_total',
+                                      'Line sizes (incoming sizes are in '
+                                      'characters) by direction and command',
+                                      ('client', 'direction', 'command'))
+        self.errors = registry.counter('irclib_parse_errors_total',
+                                       'Incoming lines that could not be '
+                                       'parsed', ('client',))
+        self.dispatch = registry.histogram('irclib_dispatch_seconds',
+                                           'Time to dispatch incoming lines',
+                                           ('client',))
+        self.connects = registry.counter('irclib_connects_total',
+                                         'Connections made', ('client',))
+        self.reconnects = registry.counter('irclib_reconnects_total',
+                                           'Connections made after the first',
+                                           ('client',))
+
+        # Cached label tuples, by (direction, command)
+        self.labels = dict()
+        self.label = label
+
+        ref = weakref.ref(client)
+
+        def reader(function):
+            def read():
+                client = ref()
+                if client is None:
+                    return None
+
+                return function(client)
+
+            return read
+
+        outbound = registry.gauge('irclib_outbound_queue',
+                                  'Lines or chunks waiting to be sent',
+                                  ('client', 'queue'))
+        outbound.track(reader(lambda c: len(c._paced)), (name, 'paced'))
+        outbound.track(reader(lambda c: c.pipeline.outgoing.qsize()
+                              if c.pipeline is not None else 0),
+                       (name, 'pipeline'))
+
+        send_buffer = registry.gauge('irclib_send_buffer_bytes',
+                                     'Unsent bytes buffered', ('client',))
+        send_buffer.track(reader(lambda c: len(getattr(c, 'send_buffer',
+                                                       b''))), label)
+
+        timers = registry.gauge('irclib_timers', 'Timers scheduled',
+                                ('client',))
+        timers.track(reader(lambda c: len(c._timer.timers) if
+                            hasattr(c, '_timer') else 0), label)
+
+        tracked = registry.gauge('irclib_tracked', 'Tracked state',
+                                 ('client', 'kind'))
+        tracked.track(reader(lambda c: len(c.users)), (name, 'users'))
+        tracked.track(reader(lambda c: len(c.channels)), (name, 'channels'))
+        tracked.track(reader(lambda c: len(c.strangers)), (name, 'strangers'))
+        tracked.track(reader(lambda c: len(c.requests)), (name, 'requests'))
+
+        registry.gauge('irclib_lag_seconds', 'Last measured lag',
+                       ('client',)).track(reader(lambda c: c.lag), label)
+
+        latency = registry.summary('irclib_latency_seconds',
+                                   'Rolling latency percentiles (see '
+                                   'IRCClient.latency)', ('client', 'kind'))
+        for kind in ('rtt', 'queue', 'echo', 'delivery'):
+            latency.track(reader(lambda c, kind=kind: c.latency[kind]),
+                          (name, kind))
+
+
+    def key(self, direction, command):
+        key = (direction, command)
+        labels = self.labels.get(key, None)
+        if labels is None:
+            labels = self.labels[key] = (self.name, direction, command)
+
+        return labels
+
+
+    """ Count an incoming line """
+    def line_in(self, command, size):
+        labels = self.key('in', command)
+        self.lines.inc(1, labels)
+        self.bytes.inc(size, labels)
+
+
+    """ Count an outgoing line """
+    def line_out(self, command, size):
+        labels = self.key('out', command)
+        self.lines.inc(1, labels)
+        self.bytes.inc(size, labels)
+
+
+    def parse_error(self):
+        self.errors.inc(1, self.label)
+
+
+    def dispatched(self, seconds):
+        self.dispatch.observe(seconds, self.label)
+
+
+    def connected(self, first):
+        self.connects.inc(1, self.label)
+        if not first:
+            self.reconnects.inc(1, self.label)
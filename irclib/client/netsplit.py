@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+""" Netsplit detection for networks without BATCH """
+
+from __future__ import unicode_literals
+
+import re
+
+
+# A QUIT reason of the form "left.server.name split.server.name"
+SPLIT_REASON = re.compile(r'^([^\s.:]+(?:\.[^\s.:]+)+) ([^\s.:]+(?:\.[^\s.:]+)+)$')
+
+
+""" Get the servers from a netsplit QUIT reason, or None if it isn't one
+
+>>> split_servers('hub.example.net leaf.example.net')
+('hub.example.net', 'leaf.example.net')
+>>> split_servers('Quit: going home') is None
+True
+"""
+def split_servers(reason):
+    if not reason:
+        return None
+
+    match = SPLIT_REASON.match(reason)
+    if match is None:
+        return None
+
+    return match.group(1), match.group(2)
+
+
+""" A netsplit in progress
+
+Users who quit in the split are parked here, so that they can be put back as
+they were when they rejoin.
+"""
+class Split(object):
+    def __init__(self, servers):
+        self.servers = servers
+
+        # Folded nick -> User
+        self.parked = dict()
+
+        # Nicks which have come back
+        self.rejoined = []
+
+        # Has the end of the split been announced?
+        self.ended = False
+
+
+    """ Timer name base for this split """
+    @property
+    def name(self):
+        return 'netsplit_{}_{}'.format(*self.servers)
+
+
+    """ Nicks still missing """
+    def missing(self):
+        return [user.nick for user in self.parked.values()]
@@ -9,11 +9,19 @@ import logging
 from threading import RLock
 from abc import ABCMeta, abstractmethod
 
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
 from irclib.common.six import u, b, PY3
 from irclib.common.dispatch import Dispatcher
-from irclib.common.line import Line
+from irclib.common.line import Line, split_line
+from irclib.common.batch import Batch
 from irclib.common.util import socketerror
 from irclib.common.timer import TimerList
+from irclib.client.connect import AddressCache, race_connect
+from irclib.client.pipeline import Pipeline
 
 try:
     import ssl
@@ -31,8 +39,29 @@ class IRCClientNetwork(object):
         self.port = kwargs.get('port')
         self.use_ssl = kwargs.get('use_ssl', False)
         self.use_starttls = kwargs.get('use_starttls', True)
+        self.ssl_verify = kwargs.get('ssl_verify', False)
         self.blocking = kwargs.get('blocking', True)
 
+        # Connect to all addresses for host in parallel
+        self.connect_race = kwargs.get('connect_race', False)
+        self.connect_stagger = kwargs.get('connect_stagger', 0.25)
+        self.address_cache = kwargs.get('address_cache', None)
+        self.connect_latency = kwargs.get('connect_latency', None)
+
+        if self.connect_race and self.address_cache is None:
+            self.address_cache = AddressCache(kwargs.get('address_ttl', 300))
+
+        # Cheap pre-parse filtering of incoming lines
+        self.line_filter = kwargs.get('line_filter', None)
+
+        # Threaded reader/dispatcher/writer mode
+        self.pipelined = kwargs.get('pipelined', False)
+        self.pipeline_queue_size = kwargs.get('pipeline_queue_size', 1024)
+        self.pipeline = None
+
+        if self.pipelined and not self.blocking:
+            raise RuntimeError('Pipelined mode requires blocking mode')
+
         if any(e is None for e in (self.host, self.port)):
             raise RuntimeError('No valid host or port specified')
 
@@ -48,6 +77,10 @@ class IRCClientNetwork(object):
         if self.use_ssl:
             # Unneeded and probably harmful. :P
             self.use_starttls = False
+        elif self.pipelined and self.use_starttls:
+            # The reader would race the TLS handshake
+            warnings.warn('STARTTLS is unavailable in pipelined mode')
+            self.use_starttls = False
 
         # Non-blocking errors
         errs = ('EINPROGRESS', 'EWOULDBLOCK', 'EAGAIN', 'EINTR', 'ERESTART',
@@ -62,9 +95,15 @@ class IRCClientNetwork(object):
 
         # Connection flag
         self.connected = False
+
+        # Set to drop and remake the connection (see request_reconnect)
+        self.reconnect_requested = False
         self.sock = None
         self.ssl_wrapped = False
 
+        # Set when the server's certificate was checked on wrapping
+        self.ssl_verified = False
+
         # Dispatch
         self.dispatch_cmd_in = Dispatcher()
         self.dispatch_cmd_out = Dispatcher()
@@ -72,6 +111,19 @@ class IRCClientNetwork(object):
         self.dispatch_ctcp_in = Dispatcher()
         self.dispatch_ctcp_out = Dispatcher()
 
+        # Batches, by type, and per-line hooks for lines in batches
+        self.dispatch_batch = Dispatcher()
+        self.dispatch_batched_in = Dispatcher()
+
+        # Open batches, by reference
+        self.batches = dict()
+
+        # Library events (e.g. netsplit)
+        self.dispatch_event = Dispatcher()
+
+        # ClientMetrics, when metrics are enabled
+        self.metrics = None
+
         # Our logger
         self.logger = logging.getLogger(__name__)
 
@@ -110,11 +162,18 @@ class IRCClientNetwork(object):
         if line.cancelled:
             self.logger.debug('Line cancelled due to hook')
 
-        self.log_callback(line, False)
         if PY3:
-            self.send(bytes(line))
+            data = bytes(line)
         else:
-            self.send(unicode(line).encode('utf-8', 'replace'))
+            data = unicode(line).encode('utf-8', 'replace')
+
+        line.raw = data
+        self.log_callback(line, False)
+
+        if self.metrics is not None:
+            self.metrics.line_out(line.command, len(data))
+
+        self.send(data)
 
 
     """ Write a CTCP request to the wire """
@@ -129,9 +188,12 @@ class IRCClientNetwork(object):
         self.cmdwrite('NOTICE', (target, response))
 
 
-    """ Write a raw command to the wire """
-    def cmdwrite(self, command, params=[]):
-        self.linewrite(Line(command=command, params=params))
+    """ Write a raw command to the wire
+
+    tags may be a dict of message tags to send along with it.
+    """
+    def cmdwrite(self, command, params=[], tags=None):
+        self.linewrite(Line(command=command, params=params, tags=tags))
 
 
     """ Connect to the server
@@ -140,19 +202,22 @@ class IRCClientNetwork(object):
     Note gevent will not be pleased if you do not have a timeout.
     """
     def connect(self, timeout=10):
+        if self.connect_race:
+            return self.connect_parallel(timeout)
+
         with self.connlock:
             if not self.connected:
                 self.sock = socket.socket()
                 self.setblocking(self.blocking)
 
-                if self.use_ssl and not self.use_starttls:
-                    self.wrap_ssl()
-
                 self.send_buffer = bytes()
                 self.recv_buffer = bytes() 
-                self.ssl_wrapped = False
+                self.ssl_wrapped = self.ssl_verified = False
                 self.reset()
 
+                if self.use_ssl and not self.use_starttls:
+                    self.wrap_ssl()
+
             if timeout is not None:
                 self.sock.settimeout(timeout)
 
@@ -161,6 +226,77 @@ class IRCClientNetwork(object):
                 self.connected = True
 
 
+    """ Connect by racing all addresses for the host
+
+    The connection is always made in blocking mode; the socket is set to the
+    configured mode afterwards.
+    """
+    def connect_parallel(self, timeout=10):
+        with self.connlock:
+            if self.connected:
+                return
+
+            addresses = self.address_cache.resolve(self.host, self.port,
+                                                   timeout)
+            self.sock = race_connect(addresses, timeout, self.connect_stagger,
+                                     self.connect_latency)
+
+            self.send_buffer = bytes()
+            self.recv_buffer = bytes()
+            self.ssl_wrapped = self.ssl_verified = False
+            self.reset()
+
+            if self.use_ssl and not self.use_starttls:
+                self.wrap_ssl()
+
+            self.setblocking(self.blocking)
+            self.connected = True
+
+
+    """ Close the connection
+
+    The socket is shut down first, as closing it alone doesn't wake a thread
+    blocked reading from it.
+    """
+    def disconnect(self):
+        with self.connlock:
+            if self.sock is not None:
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except (IOError, OSError):
+                    # Not connected
+                    pass
+
+                try:
+                    self.sock.close()
+                except (IOError, OSError):
+                    pass
+
+            self.connected = False
+
+
+    """ Remake the connection once the lines in hand are dispatched
+
+    Safe to call from a hook; the connection is only dropped by the next
+    process_in or process_pipelined (get_lines gets there straight away).
+    """
+    def request_reconnect(self):
+        self.reconnect_requested = True
+
+
+    """ Drop the connection if a reconnect was asked for """
+    def check_reconnect(self):
+        if not self.reconnect_requested:
+            return False
+
+        self.reconnect_requested = False
+        if self.pipeline is not None:
+            self.pipeline.stop()
+
+        self.disconnect()
+        return True
+
+
     """ Wrap the socket in SSL """
     def wrap_ssl(self):
         with self.connlock:
@@ -170,16 +306,29 @@ class IRCClientNetwork(object):
             if self.ssl_wrapped:
                 self.logger.warn('Attempting to wrap SSL-wrapped class')
 
+            verify = self.ssl_verify
+            if verify and not hasattr(ssl, 'create_default_context'):
+                self.logger.warn('Certificate verification is unavailable')
+                verify = False
+
+            self.ssl_verified = False
             try:
-                self.sock = ssl.wrap_socket(self.sock)
+                if verify:
+                    context = ssl.create_default_context()
+                    self.sock = context.wrap_socket(self.sock,
+                                                    server_hostname=self.host)
+                else:
+                    self.sock = ssl.wrap_socket(self.sock)
             except (IOError, OSError) as e:
                 if e.errno in self.nonblock:
                     self.use_ssl = True
                     self.ssl_wrapped = True
+                    self.ssl_verified = verify
                 raise
 
             self.use_ssl = True
             self.ssl_wrapped = True
+            self.ssl_verified = verify
 
 
     """ Set the socket non-blocking """
@@ -218,6 +367,12 @@ class IRCClientNetwork(object):
 
     """ Send data onto the wire """
     def send(self, data=None):
+        pipeline = self.pipeline
+        if pipeline is not None and pipeline.running:
+            if data:
+                pipeline.send(data)
+            return
+
         with self.outlock:
             # Assume connected
             self.connected = True
@@ -301,6 +456,12 @@ class IRCClientNetwork(object):
         return [(None, None)]
 
 
+    """ Dispatch for a library event """
+    def call_event(self, event, *args):
+        if self.dispatch_event.has_name(event):
+            return self.dispatch_event.run(event, (self,) + args)
+
+
     """ Dispatch for CTCP incoming """
     def call_ctcp_in(self, line, target, command, param):
         if self.dispatch_ctcp_in.has_name(command):
@@ -315,6 +476,40 @@ class IRCClientNetwork(object):
                                                         command, param))
 
 
+    """ Dispatch a completed batch
+
+    Batch handlers get the whole batch at once; lines in batches without a
+    handler are dispatched as usual.
+    """
+    def call_batch(self, batch):
+        if not self.dispatch_batch.has_name(batch.type):
+            for line in batch.lines:
+                self.call_dispatch_in(line)
+
+            for nested in batch.batches:
+                self.call_batch(nested)
+
+            return
+
+        self.dispatch_batch.run(batch.type, (self, batch))
+
+        if self.dispatch_batched_in.has_name(None) or any(
+                self.dispatch_batched_in.has_name(c) for c in
+                set(line.command for line in batch.lines)):
+            for line in batch.lines:
+                self.call_batched_in(line)
+
+
+    """ Dispatch for a line handled as part of a batch """
+    def call_batched_in(self, line):
+        ret = []
+        for name in (None, line.command):
+            if self.dispatch_batched_in.has_name(name):
+                ret.extend(self.dispatch_batched_in.run(name, (self, line)))
+
+        return ret
+
+
     """ Add command dispatch for input
     
     callback function must take line as first argument
@@ -333,6 +528,32 @@ class IRCClientNetwork(object):
         self.dispatch_cmd_out.add(command, priority, function)
 
 
+    """ Add batch dispatch
+
+    callback function must take the client and a Batch; it is called once the
+    batch ends, with every line in it.
+    """
+    def add_batch(self, batch_type, priority, function):
+        self.dispatch_batch.add(batch_type, priority, function)
+
+
+    """ Add dispatch for lines in batches that have a batch handler
+
+    Such lines don't go through the normal input hooks, so this is the way to
+    see them individually. Use None as the command for all lines.
+    """
+    def add_batched_in(self, command, priority, function):
+        self.dispatch_batched_in.add(command, priority, function)
+
+
+    """ Add event dispatch
+
+    callback function must take the client, then the event's arguments
+    """
+    def add_event(self, event, priority, function):
+        self.dispatch_event.add(event, priority, function)
+
+
     """ Add CTCP dispatch function """
     def add_ctcp_in(self, command, priority, function):
         self.dispatch_ctcp_in.add(command, priority, function)
@@ -345,19 +566,134 @@ class IRCClientNetwork(object):
 
     """ Recieve and process lines (blocking version) """
     def process_in(self):
+        self.check_reconnect()
         if not self.connected:
             self.connect()
 
         return self.process_lines(self.recv())
 
 
+    """ Recieve and process lines (pipelined version)
+
+    Starts the pipeline if needed, and returns a generator of lines that have
+    been dispatched.
+    """
+    def process_pipelined(self):
+        self.check_reconnect()
+
+        pipeline = self.pipeline
+        if pipeline is not None and not pipeline.running:
+            # The old reader mustn't be left holding inlock, or read stale
+            # data into the new connection's buffer
+            pipeline.join()
+            self.pipeline = None
+
+        if not self.connected:
+            self.connect()
+
+        if self.pipeline is None:
+            self.pipeline = Pipeline(self, self.pipeline_queue_size)
+            self.pipeline.start()
+
+        return self.pipeline.lines()
+
+
     """ Process lines for real """
     def process_lines(self, lines):
-        lines = [Line(line=line) for line in lines]
+        lines = self.parse_lines(lines)
 
         for line in lines:
-            self.call_dispatch_in(line)
-            self.log_callback(line, True)
+            self.dispatch_line(line)
 
         return lines
 
+
+    """ Parse raw lines into Line instances """
+    def parse_lines(self, lines):
+        line_filter = self.line_filter
+        metrics = self.metrics
+        if line_filter is None and metrics is None:
+            try:
+                return [Line(line=line) for line in lines]
+            except ValueError:
+                # Something in there is malformed; take the long way round
+                pass
+
+        ret = []
+        for line in lines:
+            try:
+                parts = split_line(line)
+                if line_filter is not None and not line_filter.check(parts[2],
+                                                                     parts[1]):
+                    continue
+
+                parsed = Line.from_parts(*parts)
+                parsed.raw = line
+            except ValueError:
+                self.logger.warn('Could not parse line: {!r}'.format(line))
+                if metrics is not None:
+                    metrics.parse_error()
+                continue
+
+            if metrics is not None:
+                # +2 for crlf
+                metrics.line_in(parsed.command, len(line) + 2)
+
+            ret.append(parsed)
+
+        return ret
+
+
+    """ Dispatch a single parsed line """
+    def dispatch_line(self, line):
+        metrics = self.metrics
+        if metrics is not None:
+            start = monotonic()
+
+        if not ((self.batches or line.command == 'BATCH') and
+                self.collect_batch(line)):
+            self.call_dispatch_in(line)
+
+        self.log_callback(line, True)
+
+        if metrics is not None:
+            metrics.dispatched(monotonic() - start)
+
+
+    """ Handle BATCH lines, and hold lines belonging to an open batch
+
+    Returns True if the line was taken.
+    """
+    def collect_batch(self, line):
+        ref = line.tag('batch') if line.tags else None
+        parent = self.batches.get(ref, None) if ref else None
+
+        if line.command == 'BATCH' and line.params:
+            marker = line.params[0]
+            if marker.startswith('+'):
+                batch = Batch.from_line(line, parent)
+                if batch is None:
+                    return False
+
+                self.batches[batch.ref] = batch
+                return True
+            elif marker.startswith('-'):
+                batch = self.batches.pop(marker[1:], None)
+                if batch is None:
+                    return False
+
+                if batch.parent is not None:
+                    # Handled along with its parent
+                    batch.parent.batches.append(batch)
+                else:
+                    self.call_batch(batch)
+
+                return True
+
+        if parent is None:
+            return False
+
+        line.batch = parent
+        parent.lines.append(line)
+        return True
+
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+""" Threaded reader/dispatcher/writer pipeline for blocking clients """
+
+import errno
+
+from threading import Thread, RLock, current_thread
+
+from irclib.common.util import socketerror
+
+try:
+    from queue import Queue, Full, Empty
+except ImportError:
+    from Queue import Queue, Full, Empty
+
+
+""" Sentinel passed down the pipeline when it shuts down """
+_STOP = object()
+
+
+# How often a stage blocked on a full queue checks for shutdown
+_POLL = 0.5
+
+
+""" A Queue that keeps track of its depth """
+class StageQueue(Queue):
+    def __init__(self, name, maxsize=0):
+        Queue.__init__(self, maxsize)
+        self.name = name
+        self.total = 0
+        self.max_depth = 0
+        self.full_waits = 0
+
+
+    def put(self, item, block=True, timeout=None):
+        if self.full():
+            # Downstream isn't keeping up
+            self.full_waits += 1
+
+        Queue.put(self, item, block, timeout)
+
+        if item is not _STOP:
+            self.total += 1
+            depth = self.qsize()
+            if depth > self.max_depth:
+                self.max_depth = depth
+
+
+    """ Return depth statistics for this queue """
+    def metrics(self):
+        return {
+            'depth' : self.qsize(),
+            'max_depth' : self.max_depth,
+            'maxsize' : self.maxsize,
+            'total' : self.total,
+            'full_waits' : self.full_waits,
+        }
+
+
+""" Runs reading, dispatch, and writing for a client in separate threads
+
+The reader thread receives and parses lines, the dispatcher thread runs the
+incoming hooks, and the writer thread drains outgoing data. Each stage hands
+off to the next through a bounded queue, so a slow peer or a slow handler
+applies backpressure rather than stalling everything else.
+
+Lines that have been dispatched are handed to the consumer through lines().
+"""
+class Pipeline(object):
+    def __init__(self, client, queue_size=1024):
+        self.client = client
+
+        self.parsed = StageQueue('parsed', queue_size)
+        self.delivered = StageQueue('delivered', queue_size)
+        self.outgoing = StageQueue('outgoing', queue_size)
+
+        self.running = False
+        self.error = None
+        self.lock = RLock()
+        self.threads = []
+
+
+    """ Start the pipeline threads """
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+
+            self.running = True
+            self.error = None
+
+            for name, target in (('reader', self.reader),
+                                 ('dispatcher', self.dispatcher),
+                                 ('writer', self.writer)):
+                thread = Thread(target=target, name='irclib_' + name)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+
+    """ Stop the pipeline, optionally recording why """
+    def stop(self, error=None):
+        with self.lock:
+            if error is not None and self.error is None:
+                self.error = error
+
+            if not self.running:
+                return
+
+            self.running = False
+
+        # Wake everything up; this may be called from a stage itself, so it
+        # mustn't wait on a queue only that stage drains
+        self.wake(self.parsed)
+        self.wake(self.outgoing)
+
+
+    """ Wait for the threads of a stopped pipeline to finish """
+    def join(self):
+        current = current_thread()
+        for thread in self.threads:
+            if thread is current:
+                continue
+
+            while thread.is_alive():
+                thread.join(_POLL)
+
+                # Nobody will read these now
+                self.drain(self.delivered)
+
+
+    """ Discard everything on a queue """
+    @staticmethod
+    def drain(queue):
+        while True:
+            try:
+                queue.get_nowait()
+            except Empty:
+                return
+
+
+    """ Put the stop sentinel on a queue without blocking
+
+    If the queue is full, the oldest items are discarded to make room; once
+    stopping, they would never be handled anyway.
+    """
+    @staticmethod
+    def wake(queue):
+        while True:
+            try:
+                queue.put_nowait(_STOP)
+                return
+            except Full:
+                try:
+                    queue.get_nowait()
+                except Empty:
+                    pass
+
+
+    """ Put an item on a queue, giving up if the pipeline stops
+
+    Returns False if the item was not queued.
+    """
+    def put(self, queue, item):
+        while self.running:
+            try:
+                queue.put(item, timeout=_POLL)
+                return True
+            except Full:
+                pass
+
+        return False
+
+
+    """ Reader stage: receive and parse """
+    def reader(self):
+        client = self.client
+        try:
+            while self.running:
+                for line in client.parse_lines(client.recv()):
+                    if not self.put(self.parsed, line):
+                        return
+        except Exception as e:
+            self.stop(e)
+
+
+    """ Dispatcher stage: run incoming hooks """
+    def dispatcher(self):
+        client = self.client
+        while True:
+            line = self.parsed.get()
+            if line is _STOP:
+                break
+
+            try:
+                client.dispatch_line(line)
+            except Exception as e:
+                self.stop(e)
+                break
+
+            self.delivered.put(line)
+
+        self.delivered.put(_STOP)
+
+
+    """ Writer stage: drain outgoing data onto the wire """
+    def writer(self):
+        client = self.client
+        while True:
+            data = self.outgoing.get()
+            if data is _STOP:
+                break
+
+            try:
+                client.sock.sendall(data)
+            except Exception as e:
+                client.connected = False
+                self.stop(e)
+                break
+
+        if not self.running:
+            # Make sure the reader wakes up too
+            client.disconnect()
+
+
+    """ Queue data for the writer """
+    def send(self, data):
+        self.put(self.outgoing, data)
+
+
+    """ Generator yielding dispatched lines; raises when the pipeline dies """
+    def lines(self):
+        while True:
+            line = self.delivered.get()
+            if line is _STOP:
+                break
+
+            yield line
+
+        error = self.error
+        if error is None:
+            socketerror(errno.ECONNRESET, instance=self.client)
+
+        raise error
+
+
+    """ Return queue statistics for each stage """
+    def metrics(self):
+        return {q.name : q.metrics() for q in (self.parsed, self.delivered,
+                                               self.outgoing)}
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+""" Request/response correlation for commands sent to the server """
+
+from __future__ import unicode_literals
+
+from collections import deque
+from concurrent.futures import Future
+from threading import RLock
+from time import time
+
+from irclib.common.numerics import *
+
+try:
+    from time import monotonic
+except ImportError:
+    monotonic = time
+
+
+""" Raised (through a request's Future) when the server answers with an error
+
+line - the error reply
+lines - all replies received for the request
+"""
+class RequestError(Exception):
+    def __init__(self, line, lines=()):
+        Exception.__init__(self, '{} {}'.format(line.command,
+                                                line.params[-1] if line.params
+                                                else ''))
+        self.line = line
+        self.lines = list(lines)
+
+
+""" Reply numerics by command, as (replies, ends, errors, loose)
+
+loose means replies don't carry the request's target, so are matched in order.
+"""
+REPLY_SPECS = {
+    'WHOIS' : (frozenset((RPL_WHOISUSER, RPL_WHOISSERVER, RPL_WHOISOPERATOR,
+                          RPL_WHOISIDLE, RPL_WHOISCHANNELS, RPL_WHOISLOGGEDIN,
+                          RPL_WHOISHOST, RPL_WHOISSECURE, RPL_WHOISACTUALLY,
+                          RPL_WHOISCERTFP, RPL_AWAY, '307', '320')),
+               frozenset((RPL_ENDOFWHOIS,)),
+               frozenset((ERR_NOSUCHNICK, ERR_NOSUCHSERVER)), False),
+    'WHOWAS' : (frozenset((RPL_WHOWASUSER, RPL_WHOISSERVER,
+                           RPL_WHOISACTUALLY)),
+                frozenset((RPL_ENDOFWHOWAS,)),
+                frozenset((ERR_WASNOSUCHNICK,)), False),
+    'WHO' : (frozenset((RPL_WHOREPLY, RPL_WHOSPCRPL)),
+             frozenset((RPL_ENDOFWHO,)),
+             frozenset((ERR_NOSUCHSERVER,)), True),
+    'ISON' : (frozenset(), frozenset((RPL_ISON,)), frozenset(), True),
+    'USERHOST' : (frozenset(), frozenset((RPL_USERHOST,)), frozenset(), True),
+    'NAMES' : (frozenset((RPL_NAMREPLY,)), frozenset((RPL_ENDOFNAMES,)),
+               frozenset((ERR_NOSUCHCHANNEL,)), False),
+    'LIST' : (frozenset((RPL_LISTSTART, RPL_LIST)), frozenset((RPL_LISTEND,)),
+              frozenset(), True),
+    'TOPIC' : (frozenset((RPL_TOPICWHOTIME,)),
+               frozenset((RPL_TOPIC, RPL_NOTOPIC)),
+               frozenset((ERR_NOSUCHCHANNEL, ERR_NOTONCHANNEL)), False),
+    'MODE' : (frozenset(), frozenset((RPL_CHANNELMODEIS,)),
+              frozenset((ERR_NOSUCHCHANNEL, ERR_NOTONCHANNEL,
+                         ERR_CHANOPRIVSNEEDED)), False),
+}
+
+# List mode queries, by mode
+LIST_SPECS = {
+    'b' : (RPL_BANLIST, RPL_ENDOFBANLIST),
+    'e' : (RPL_EXCEPTLIST, RPL_ENDOFEXCEPTLIST),
+    'I' : (RPL_INVITELIST, RPL_ENDOFINVITELIST),
+    'q' : (RPL_QUIETLIST, RPL_ENDOFQUIETLIST),
+}
+
+# Errors which name the command rather than the target
+COMMAND_ERRORS = frozenset((ERR_UNKNOWNCOMMAND, ERR_NEEDMOREPARAMS))
+
+
+""" Work out (replies, ends, errors, loose) for a command, or None """
+def reply_spec(command, params):
+    if command == 'MODE' and len(params) >= 2:
+        mode = params[1].lstrip('+')
+        if len(params) > 2 or mode not in LIST_SPECS:
+            # A mode change; nothing comes back if it works
+            return None
+
+        reply, end = LIST_SPECS[mode]
+        errors = REPLY_SPECS['MODE'][2]
+        return frozenset((reply,)), frozenset((end,)), errors, False
+
+    return REPLY_SPECS.get(command, None)
+
+
+""" A request in flight """
+class Request(object):
+    def __init__(self, command, params, spec=None, label=None, timeout=30):
+        self.command = command
+        self.params = list(params)
+        self.label = label
+        self.deadline = monotonic() + timeout
+
+        if spec is None:
+            spec = (frozenset(), frozenset(), frozenset(), True)
+
+        self.replies, self.ends, self.errors, self.loose = spec
+
+        # What the replies should refer to
+        self.key = self.params[0] if self.params and not self.loose else None
+
+        self.lines = []
+        self.future = Future()
+
+
+    """ Does a reply belong to this request? """
+    def matches(self, line, fold):
+        command = line.command
+        params = line.params
+
+        if command in COMMAND_ERRORS:
+            return len(params) > 1 and params[1].upper() == self.command
+
+        if self.key is None:
+            return True
+
+        key = fold(self.key)
+        return any(fold(param) == key for param in params[1:3])
+
+
+    """ Complete the request """
+    def finish(self, error=None):
+        if self.future.done():
+            return
+
+        if error is not None:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(self.lines)
+
+
+""" Keeps track of requests in flight, and routes replies to them
+
+Labeled requests are matched on their label; the rest on reply numerics, in
+the order they were sent.
+"""
+class RequestTracker(object):
+    def __init__(self, casemap=None):
+        self.casemap = casemap
+
+        # Label -> Request
+        self.labels = dict()
+
+        # Command -> deque of Requests, for unlabeled requests
+        self.pending = dict()
+
+        # Numeric -> set of commands with pending requests it could answer
+        self.watched = dict()
+
+        self.counter = 0
+        self.lock = RLock()
+
+
+    def fold(self, string):
+        if self.casemap is None:
+            return string.lower()
+
+        return self.casemap.fold(string)
+
+
+    def __len__(self):
+        return len(self.labels) + sum(len(q) for q in self.pending.values())
+
+
+    """ Get a fresh label """
+    def new_label(self):
+        with self.lock:
+            self.counter += 1
+            return 'irclib{}'.format(self.counter)
+
+
+    """ Start tracking a request """
+    def add(self, request):
+        with self.lock:
+            if request.label is not None:
+                self.labels[request.label] = request
+                return
+
+            self.pending.setdefault(request.command, deque()).append(request)
+            for numeric in (request.replies | request.ends | request.errors |
+                            COMMAND_ERRORS):
+                self.watched.setdefault(numeric, set()).add(request.command)
+
+
+    """ Stop tracking a request """
+    def remove(self, request):
+        with self.lock:
+            if request.label is not None:
+                self.labels.pop(request.label, None)
+                return
+
+            queue = self.pending.get(request.command, None)
+            if queue is None:
+                return
+
+            try:
+                queue.remove(request)
+            except ValueError:
+                return
+
+            if queue:
+                return
+
+            # No more of these
+            del self.pending[request.command]
+            for numeric in list(self.watched):
+                commands = self.watched[numeric]
+                commands.discard(request.command)
+                if not commands:
+                    del self.watched[numeric]
+
+
+    """ Complete a labeled request with its replies """
+    def labeled(self, label, lines):
+        with self.lock:
+            request = self.labels.pop(label, None)
+            if request is None:
+                return None
+
+            request.lines.extend(lines)
+
+        # Finish outside the lock, as done callbacks may take other locks
+        # (e.g. cancelling a timer); the same goes below
+        for line in request.lines:
+            if (line.command in request.errors or
+                    line.command in COMMAND_ERRORS):
+                request.finish(RequestError(line, request.lines))
+                break
+        else:
+            request.finish()
+
+        return request
+
+
+    """ Route an unlabeled reply; returns the Request it went to, if any """
+    def route(self, line):
+        error = None
+        with self.lock:
+            commands = self.watched.get(line.command, None)
+            if not commands:
+                return None
+
+            request = None
+            for command in list(commands):
+                for pending in self.pending.get(command, ()):
+                    if pending.matches(line, self.fold):
+                        request = pending
+                        break
+
+                if request is not None:
+                    break
+            else:
+                return None
+
+            request.lines.append(line)
+            if line.command in request.ends:
+                self.remove(request)
+            elif (line.command in request.errors or
+                  line.command in COMMAND_ERRORS):
+                self.remove(request)
+                error = RequestError(line, request.lines)
+            else:
+                # More to come
+                return request
+
+        request.finish(error)
+        return request
+
+
+    """ Fail requests past their deadline """
+    def expire(self):
+        with self.lock:
+            now = monotonic()
+            expired = [r for r in self.labels.values() if r.deadline <= now]
+            for queue in self.pending.values():
+                expired.extend(r for r in queue if r.deadline <= now)
+
+            for request in expired:
+                self.remove(request)
+
+        for request in expired:
+            request.finish(IOError('Request timed out: {}'.format(
+                request.command)))
+
+
+    """ Fail everything (e.g. on disconnect) """
+    def fail_all(self, error):
+        with self.lock:
+            requests = list(self.labels.values())
+            for queue in self.pending.values():
+                requests.extend(queue)
+
+            self.labels.clear()
+            self.pending.clear()
+            self.watched.clear()
+
+        for request in requests:
+            request.finish(error)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+""" SCRAM (RFC 5802/7677) SASL authentication, with cached key derivation """
+
+from __future__ import unicode_literals
+
+import base64
+import hashlib
+import hmac
+import os
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import RLock
+
+
+# Mechanism -> hash name
+SCRAM_MECHANISMS = {
+    'SCRAM-SHA-1' : 'sha1',
+    'SCRAM-SHA-256' : 'sha256',
+}
+
+
+""" Derive (ClientKey, ServerKey) from a password
+
+This is the expensive part of SCRAM.
+"""
+def scram_keys(digest, password, salt, iterations):
+    salted = hashlib.pbkdf2_hmac(digest, password, salt, iterations)
+    client_key = hmac.new(salted, b'Client Key', digest).digest()
+    server_key = hmac.new(salted, b'Server Key', digest).digest()
+    return client_key, server_key
+
+
+""" Cache of derived SCRAM keys
+
+Keys are cached by (hash, account, salt, iterations), plus a digest of the
+password so that a changed password is never answered from the cache.
+Derivations run in a small thread pool, and concurrent requests for the same
+keys share one derivation.
+
+One cache is shared by default (see KEY_CACHE), so many clients using the
+same identity in one process only derive once.
+"""
+class ScramKeyCache(object):
+    def __init__(self, workers=2, maxsize=4096):
+        self.maxsize = maxsize
+        self.executor = ThreadPoolExecutor(workers)
+        self.lock = RLock()
+
+        # Key -> Future of (ClientKey, ServerKey)
+        self.keys = dict()
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+
+    @staticmethod
+    def cache_key(digest, account, password, salt, iterations):
+        check = hashlib.sha256(password).digest()
+        return (digest, account, salt, iterations, check)
+
+
+    """ Get a Future for (ClientKey, ServerKey), deriving them if needed """
+    def get(self, digest, account, password, salt, iterations):
+        key = self.cache_key(digest, account, password, salt, iterations)
+        with self.lock:
+            future = self.keys.get(key, None)
+            if future is not None:
+                self.hits += 1
+                return future
+
+            self.misses += 1
+            if len(self.keys) >= self.maxsize:
+                self.keys.clear()
+
+            future = self.keys[key] = self.executor.submit(scram_keys, digest,
+                                                           password, salt,
+                                                           iterations)
+
+        future.add_done_callback(lambda f: self.failed(key, f))
+        return future
+
+
+    """ Don't keep failed derivations """
+    def failed(self, key, future):
+        if future.exception() is None:
+            return
+
+        with self.lock:
+            if self.keys.get(key, None) is future:
+                del self.keys[key]
+
+
+    """ Return cache statistics """
+    def metrics(self):
+        return {
+            'size' : len(self.keys),
+            'hits' : self.hits,
+            'misses' : self.misses,
+        }
+
+
+KEY_CACHE = ScramKeyCache()
+
+
+""" Escape a SCRAM username """
+def scram_escape(name):
+    return name.replace('=', '=3D').replace(',', '=2C')
+
+
+""" Parse a SCRAM message into a dict """
+def scram_parse(message):
+    ret = dict()
+    for item in message.split(','):
+        key, sep, value = item.partition('=')
+        if sep:
+            ret[key] = value
+
+    return ret
+
+
+""" Client side of a SCRAM exchange
+
+mechanism - SCRAM-SHA-1 or SCRAM-SHA-256
+username - account name
+password - account password
+cache - ScramKeyCache to use (default KEY_CACHE)
+"""
+class ScramClient(object):
+    def __init__(self, mechanism, username, password, cache=None, nonce=None):
+        if mechanism not in SCRAM_MECHANISMS:
+            raise ValueError('Unknown SCRAM mechanism {}'.format(mechanism))
+
+        self.mechanism = mechanism
+        self.digest = SCRAM_MECHANISMS[mechanism]
+        self.username = username
+        self.password = password.encode('utf-8')
+        self.cache = cache if cache is not None else KEY_CACHE
+
+        if nonce is None:
+            nonce = base64.b64encode(os.urandom(18)).decode('ascii')
+        self.nonce = nonce
+
+        self.first_bare = None
+        self.auth_message = None
+        self.server_key = None
+
+
+    """ The client-first message """
+    def first(self):
+        self.first_bare = 'n={},r={}'.format(scram_escape(self.username),
+                                             self.nonce)
+        return 'n,,' + self.first_bare
+
+
+    """ Handle the server-first message
+
+    Returns a Future for the client-final message; it is complete straight
+    away if the keys are cached.
+    """
+    def final(self, server_first):
+        attrs = scram_parse(server_first)
+        nonce = attrs.get('r', '')
+        if not nonce.startswith(self.nonce) or 's' not in attrs or 'i' not in \
+                attrs:
+            raise ValueError('Bad SCRAM server-first message')
+
+        salt = base64.b64decode(attrs['s'])
+        iterations = int(attrs['i'])
+
+        without_proof = 'c=biws,r={}'.format(nonce)
+        self.auth_message = ','.join((self.first_bare, server_first,
+                                      without_proof)).encode('utf-8')
+
+        keys = self.cache.get(self.digest, self.username, self.password, salt,
+                              iterations)
+
+        future = Future()
+
+        def done(keys):
+            error = keys.exception()
+            if error is not None:
+                future.set_exception(error)
+                return
+
+            client_key, self.server_key = keys.result()
+            stored_key = hashlib.new(self.digest, client_key).digest()
+            signature = hmac.new(stored_key, self.auth_message,
+                                 self.digest).digest()
+            proof = bytes(bytearray(a ^ b for a, b in
+                                    zip(bytearray(client_key),
+                                        bytearray(signature))))
+
+            future.set_result('{},p={}'.format(without_proof,
+                base64.b64encode(proof).decode('ascii')))
+
+        keys.add_done_callback(done)
+        return future
+
+
+    """ Check the server-final message """
+    def verify(self, server_final):
+        attrs = scram_parse(server_final)
+        if 'v' not in attrs or self.server_key is None:
+            return False
+
+        expected = hmac.new(self.server_key, self.auth_message,
+                            self.digest).digest()
+        return hmac.compare_digest(base64.b64decode(attrs['v']), expected)
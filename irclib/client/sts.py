@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+""" IRCv3 Strict Transport Security (STS) policy storage """
+
+import json
+
+from time import time
+from threading import RLock
+
+
+""" Parse an STS capability value into a dict
+
+>>> sorted(parse_sts_value('port=6697,duration=300').items())
+[('duration', '300'), ('port', '6697')]
+"""
+def parse_sts_value(value):
+    policy = dict()
+    if not value:
+        return policy
+
+    for item in value.split(','):
+        key, sep, val = item.partition('=')
+        policy[key] = val if sep else None
+
+    return policy
+
+
+""" Stores known STS policies, keyed by hostname
+
+If a filename is given, policies are persisted there (as JSON) so they survive
+between runs. Instances may be shared between clients.
+"""
+class STSPolicyStore(object):
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.policies = dict()
+        self.lock = RLock()
+
+        if self.filename:
+            self.load()
+
+
+    """ Load policies from disk """
+    def load(self):
+        with self.lock:
+            try:
+                with open(self.filename, 'r') as f:
+                    policies = json.load(f)
+            except (IOError, OSError, ValueError):
+                # Nonexistent or broken; start afresh
+                policies = dict()
+
+            self.policies = {host.lower() : (int(port), float(expiry))
+                             for host, (port, expiry) in policies.items()}
+
+
+    """ Write policies to disk """
+    def save(self):
+        if not self.filename:
+            return
+
+        with self.lock:
+            with open(self.filename, 'w') as f:
+                json.dump(self.policies, f)
+
+
+    """ Get the policy port for a host, or None if no valid policy exists """
+    def get(self, host):
+        host = host.lower()
+        with self.lock:
+            policy = self.policies.get(host, None)
+            if policy is None:
+                return None
+
+            port, expiry = policy
+            if expiry < time():
+                # Expired
+                self.remove(host)
+                return None
+
+            return port
+
+
+    """ Set (or refresh) the policy for a host
+
+    A duration of 0 removes the policy, as per the spec.
+    """
+    def set(self, host, port, duration):
+        host = host.lower()
+        if duration <= 0:
+            return self.remove(host)
+
+        with self.lock:
+            self.policies[host] = (port, time() + duration)
+            self.save()
+
+
+    """ Remove the policy for a host """
+    def remove(self, host):
+        with self.lock:
+            if self.policies.pop(host.lower(), None) is not None:
+                self.save()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
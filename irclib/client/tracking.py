@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+""" State tracking profiles, to turn off user/channel tracking """
+
+from __future__ import unicode_literals
+
+from irclib.common.maskmatch import compile_glob
+
+
+# Profiles, from least to most state kept
+TRACK_NONE = 0
+TRACK_CHANNELS = 1
+TRACK_MEMBERSHIP = 2
+TRACK_FULL = 3
+
+TRACKING_PROFILES = {
+    # No channel or user objects at all
+    'none' : TRACK_NONE,
+    # Channel objects (topic, modes), but no members
+    'channels-only' : TRACK_CHANNELS,
+    # Members and their status, but no WHO, away, account, or expiry
+    'membership-only' : TRACK_MEMBERSHIP,
+    # Everything
+    'full' : TRACK_FULL,
+}
+
+
+""" Get a profile level from a name or level """
+def tracking_level(profile):
+    if profile in TRACKING_PROFILES.values():
+        return profile
+
+    try:
+        return TRACKING_PROFILES[profile]
+    except KeyError:
+        raise ValueError('Unknown tracking profile: {}'.format(profile))
+
+
+""" Decides how much state to keep for each channel
+
+default - profile for everything not matched by a pattern
+patterns - list of (glob, profile) pairs for channels; the first match wins
+casemap - CaseMapping to match channel names with (optional)
+
+>>> policy = TrackingPolicy('membership-only', [('#relay-*', 'none')])
+>>> policy.get('#relay-1') == TRACK_NONE
+True
+>>> policy.get('#chat') == TRACK_MEMBERSHIP
+True
+>>> policy.max_level() == TRACK_MEMBERSHIP
+True
+"""
+class TrackingPolicy(object):
+    def __init__(self, default='full', patterns=(), casemap=None):
+        self.default = tracking_level(default)
+        self.casemap = casemap
+
+        if hasattr(patterns, 'items'):
+            patterns = patterns.items()
+
+        self.patterns = [(glob, tracking_level(profile)) for glob, profile in
+                         patterns]
+        self.compile()
+
+
+    def fold(self, string):
+        if self.casemap is None:
+            return string.lower()
+
+        return self.casemap.fold(string)
+
+
+    """ (Re)compile the patterns, e.g. after the case mapping changes """
+    def compile(self):
+        self.compiled = [(compile_glob(self.fold(glob)), level) for glob, level
+                         in self.patterns]
+
+        # Folded channel -> level
+        self.cache = dict()
+
+
+    """ Get the profile level for a channel (or the default for None) """
+    def get(self, channel=None):
+        if channel is None or not self.compiled:
+            return self.default
+
+        folded = self.fold(channel)
+        try:
+            return self.cache[folded]
+        except KeyError:
+            pass
+
+        level = self.default
+        for regex, plevel in self.compiled:
+            if regex.match(folded) is not None:
+                level = plevel
+                break
+
+        self.cache[folded] = level
+        return level
+
+
+    """ The most state any channel can have """
+    def max_level(self):
+        return max([self.default] + [level for glob, level in self.patterns])
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
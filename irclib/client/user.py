@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import weakref
+from irclib.common.casemap import CaseFoldWeakValueDict
 
 class User(object):
     def __init__(self, network, nick, user=None, host=None, realname=None,
@@ -27,7 +27,13 @@ class User(object):
         # Unknown server
         self.server = None
 
-        self.channels = weakref.WeakValueDictionary()
+        # Unknown SSL status
+        self.ssl = None
+
+        # When WHOIS info was last complete (monotonic), if ever
+        self.whois_time = None
+
+        self.channels = CaseFoldWeakValueDict(network.casemap)
 
     def channel_add(self, name, ch):
         self.channels[name] = ch
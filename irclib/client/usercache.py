@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+""" Bounded cache for users we share no channels with """
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from time import time
+
+try:
+    from time import monotonic
+except ImportError:
+    monotonic = time
+
+
+""" LRU tier for users who share no channels with us
+
+Rather than polling such users with MONITOR or ISON, they are simply
+forgotten once the cache is full (least recently seen first) or once they
+haven't been seen for ttl seconds. Expiry is checked whenever the cache is
+touched, so there are no timers.
+
+evict - called with the nick of each user evicted
+maxsize - maximum number of users to keep (0 for no limit)
+ttl - seconds a user is kept after being last seen (None for no limit)
+casemap - CaseMapping to fold nicks with (optional)
+
+>>> evicted = []
+>>> cache = StrangerCache(evicted.append, maxsize=2)
+>>> for nick in ('a', 'b', 'c'): cache.add(nick)
+>>> evicted
+['a']
+>>> cache.touch('b')
+True
+>>> cache.add('d')
+>>> evicted
+['a', 'c']
+"""
+class StrangerCache(object):
+    def __init__(self, evict, maxsize=1024, ttl=900, casemap=None):
+        self.evict = evict
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.casemap = casemap
+
+        # Folded nick -> (nick, last seen)
+        self.entries = OrderedDict()
+
+        # Statistics
+        self.hits = 0
+        self.added = 0
+        self.evicted = 0
+        self.expired = 0
+        self.removed = 0
+
+
+    def fold(self, nick):
+        if self.casemap is None:
+            return nick.lower()
+
+        return self.casemap.fold(nick)
+
+
+    def __contains__(self, nick):
+        return self.fold(nick) in self.entries
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    """ Add a user (or refresh one already present) """
+    def add(self, nick):
+        folded = self.fold(nick)
+        if self.entries.pop(folded, None) is None:
+            self.added += 1
+
+        self.entries[folded] = (nick, monotonic())
+        self.prune()
+
+
+    """ Mark a user as seen; returns True if they were in the cache """
+    def touch(self, nick):
+        folded = self.fold(nick)
+        entry = self.entries.pop(folded, None)
+        if entry is None:
+            self.prune()
+            return False
+
+        self.hits += 1
+        self.entries[folded] = (entry[0], monotonic())
+        self.prune()
+        return True
+
+
+    """ Take a user out of the cache without evicting them (e.g. they joined
+    a channel with us, or quit)
+    """
+    def discard(self, nick):
+        if self.entries.pop(self.fold(nick), None) is not None:
+            self.removed += 1
+
+
+    """ Follow a nick change """
+    def rename(self, oldnick, newnick):
+        entry = self.entries.pop(self.fold(oldnick), None)
+        if entry is None:
+            return
+
+        self.entries[self.fold(newnick)] = (newnick, entry[1])
+
+
+    """ Evict users over the size limit or past their TTL """
+    def prune(self):
+        entries = self.entries
+
+        if self.ttl is not None:
+            deadline = monotonic() - self.ttl
+            while entries:
+                folded, (nick, seen) = next(iter(entries.items()))
+                if seen > deadline:
+                    break
+
+                del entries[folded]
+                self.expired += 1
+                self.evict(nick)
+
+        while self.maxsize and len(entries) > self.maxsize:
+            folded, (nick, seen) = entries.popitem(last=False)
+            self.evicted += 1
+            self.evict(nick)
+
+
+    """ Forget everything, without evicting """
+    def clear(self):
+        self.entries.clear()
+
+
+    """ Re-fold all keys, after the case mapping changes """
+    def rekey(self):
+        items = list(self.entries.values())
+        self.entries.clear()
+        for nick, seen in items:
+            self.entries[self.fold(nick)] = (nick, seen)
+
+
+    """ Return cache statistics """
+    def metrics(self):
+        return {
+            'size' : len(self.entries),
+            'maxsize' : self.maxsize,
+            'ttl' : self.ttl,
+            'hits' : self.hits,
+            'added' : self.added,
+            'evicted' : self.evicted,
+            'expired' : self.expired,
+            'removed' : self.removed,
+        }
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
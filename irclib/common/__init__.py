@@ -1,2 +1,2 @@
-__all__ = ['colourmap', 'dispatch', 'line', 'modes', 'numerics', 'six',
+__all__ = ['casemap', 'colourmap', 'dispatch', 'line', 'maskmatch', 'modes', 'numerics', 'six',
            'timer', 'util']
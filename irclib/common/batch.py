@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+""" IRCv3 batches """
+
+from __future__ import unicode_literals
+
+
+""" A batch of lines, as started by BATCH +reference
+
+ref - the batch reference tag
+type - the batch type (e.g. netsplit, netjoin, chathistory)
+params - the batch's parameters
+line - the BATCH line that opened the batch
+parent - the enclosing Batch, for nested batches
+
+Lines are collected in lines, and completed nested batches in batches.
+"""
+class Batch(object):
+    def __init__(self, ref, type, params=(), line=None, parent=None):
+        self.ref = ref
+        self.type = type
+        self.params = list(params)
+        self.line = line
+        self.parent = parent
+
+        self.lines = []
+        self.batches = []
+
+
+    """ Create a batch from a BATCH +ref line, or None if it isn't one """
+    @classmethod
+    def from_line(cls, line, parent=None):
+        params = line.params
+        if len(params) < 2 or not params[0].startswith('+'):
+            return None
+
+        return cls(params[0][1:], params[1], params[2:], line, parent)
+
+
+    def __len__(self):
+        return len(self.lines)
+
+
+    def __repr__(self):
+        return 'Batch({} {} {}, {} lines)'.format(self.ref, self.type,
+                                                   ' '.join(self.params),
+                                                   len(self.lines))
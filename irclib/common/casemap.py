@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+""" IRC case mapping (CASEMAPPING ISUPPORT token) and case-folded maps """
+
+from __future__ import unicode_literals
+
+import weakref
+
+from string import ascii_uppercase
+
+
+def _make_table(extra):
+    table = {ord(c) : c.lower() for c in ascii_uppercase}
+    table.update((ord(k), v) for k, v in extra)
+    return table
+
+
+CASEMAP_TABLES = {
+    'ascii' : _make_table(()),
+    'rfc1459' : _make_table((('[', '{'), (']', '}'), ('\\', '|'),
+                             ('~', '^'))),
+    'strict-rfc1459' : _make_table((('[', '{'), (']', '}'), ('\\', '|'))),
+}
+
+
+""" A case mapping, with a memoised fold cache
+
+One instance is shared by everything belonging to a client, so that a change
+of CASEMAPPING can be applied in one place.
+
+>>> CaseMapping('rfc1459').fold('FOO[]\\\\~')
+'foo{}|^'
+>>> CaseMapping('ascii').fold('FOO[]')
+'foo[]'
+"""
+class CaseMapping(object):
+    def __init__(self, name='rfc1459', cache_size=65536):
+        self.cache_size = cache_size
+        self.cache = dict()
+        self.set(name)
+
+
+    """ Change the mapping in use """
+    def set(self, name):
+        name = name.lower() if name else 'rfc1459'
+        if name not in CASEMAP_TABLES:
+            # Unknown (e.g. rfc7613); ascii is the closest we've got
+            name = 'ascii'
+
+        self.name = name
+        self.table = CASEMAP_TABLES[name]
+        self.cache.clear()
+
+
+    """ Fold a string to its canonical form """
+    def fold(self, string):
+        try:
+            return self.cache[string]
+        except KeyError:
+            pass
+
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+
+        folded = self.cache[string] = string.translate(self.table)
+        return folded
+
+
+    """ Compare two strings under this mapping """
+    def equal(self, a, b):
+        if a is None or b is None:
+            return a is b
+
+        return self.fold(a) == self.fold(b)
+
+
+""" A dict keyed by case-folded strings
+
+Keys are stored folded, so one lookup is a single fold (usually a cache hit)
+and a single dict hit.
+"""
+class CaseFoldDict(dict):
+    def __init__(self, casemap, *args, **kwargs):
+        dict.__init__(self)
+        self.casemap = casemap
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, self.casemap.fold(key))
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, self.casemap.fold(key), value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, self.casemap.fold(key))
+
+    def __contains__(self, key):
+        return dict.__contains__(self, self.casemap.fold(key))
+
+    def get(self, key, default=None):
+        return dict.get(self, self.casemap.fold(key), default)
+
+    def pop(self, key, *default):
+        return dict.pop(self, self.casemap.fold(key), *default)
+
+    def setdefault(self, key, default=None):
+        return dict.setdefault(self, self.casemap.fold(key), default)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def copy(self):
+        return CaseFoldDict(self.casemap, self)
+
+    def __reduce__(self):
+        return (self.__class__, (self.casemap, dict(self)))
+
+
+    """ Re-fold all keys, after the case mapping changes """
+    def rekey(self):
+        items = list(dict.items(self))
+        dict.clear(self)
+        for key, value in items:
+            self[key] = value
+
+
+""" A WeakValueDictionary keyed by case-folded strings """
+class CaseFoldWeakValueDict(weakref.WeakValueDictionary):
+    def __init__(self, casemap):
+        weakref.WeakValueDictionary.__init__(self)
+        self.casemap = casemap
+
+    def __getitem__(self, key):
+        return weakref.WeakValueDictionary.__getitem__(self,
+            self.casemap.fold(key))
+
+    def __setitem__(self, key, value):
+        weakref.WeakValueDictionary.__setitem__(self, self.casemap.fold(key),
+                                                value)
+
+    def __delitem__(self, key):
+        weakref.WeakValueDictionary.__delitem__(self, self.casemap.fold(key))
+
+    def __contains__(self, key):
+        return weakref.WeakValueDictionary.__contains__(self,
+            self.casemap.fold(key))
+
+    def get(self, key, default=None):
+        return weakref.WeakValueDictionary.get(self, self.casemap.fold(key),
+                                               default)
+
+    def pop(self, key, *default):
+        return weakref.WeakValueDictionary.pop(self, self.casemap.fold(key),
+                                               *default)
+
+
+    """ Re-fold all keys, after the case mapping changes """
+    def rekey(self):
+        items = list(weakref.WeakValueDictionary.items(self))
+        weakref.WeakValueDictionary.clear(self)
+        for key, value in items:
+            self[key] = value
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
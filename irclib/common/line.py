@@ -2,8 +2,10 @@
 
 from __future__ import unicode_literals
 
-from itertools import islice
-from collections import deque
+import re
+
+from irclib.common.casemap import CaseMapping
+from irclib.common.maskmatch import glob_pattern
 
 """ Stores a user hostmask
 
@@ -76,8 +78,122 @@ class Hostmask:
     def __repr__(self):
         return "Hostmask({})".format(str(self))
 
+""" Split a raw line into (tags, prefix, command, rest)
+
+Only the cheap parts are done here; rest holds the unparsed parameters.
+
+>>> split_line(":dongs!dongs@lol.org PRIVMSG loldongs :meow")
+('', 'dongs!dongs@lol.org', 'PRIVMSG', 'loldongs :meow')
+>>> split_line("@a=b PING")
+('a=b', '', 'PING', '')
+"""
+def split_line(line):
+    tags = prefix = ''
+
+    if line.startswith('@'):
+        tags, sep, line = line.partition(' ')
+        tags = tags[1:]
+        line = line.lstrip(' ')
+
+    if line.startswith(':'):
+        prefix, sep, line = line.partition(' ')
+        prefix = prefix[1:]
+        line = line.lstrip(' ')
+
+    command, sep, rest = line.partition(' ')
+    return tags, prefix, command, rest
+
+
+# Message tag value escapes
+TAG_UNESCAPE = {':' : ';', 's' : ' ', '\\' : '\\', 'r' : '\r', 'n' : '\n'}
+
+
+""" Parse IRCv3 message tags into a dict
+
+Tags without a value map to ''.
+
+>>> sorted(parse_tags('batch=yXNAbvnRHTRBv;time=2012-06-30T23:59:60.419Z;a').items())
+[('a', ''), ('batch', 'yXNAbvnRHTRBv'), ('time', '2012-06-30T23:59:60.419Z')]
+>>> parse_tags('msg=a\\sb\\:c')['msg']
+'a b;c'
+"""
+def parse_tags(tags):
+    ret = dict()
+    if not tags:
+        return ret
+
+    for tag in tags.split(';'):
+        if not tag:
+            continue
+
+        key, sep, value = tag.partition('=')
+        if '\\' in value:
+            chars = []
+            escape = False
+            for char in value:
+                if escape:
+                    chars.append(TAG_UNESCAPE.get(char, char))
+                    escape = False
+                elif char == '\\':
+                    escape = True
+                else:
+                    chars.append(char)
+
+            value = ''.join(chars)
+
+        ret[key] = value
+
+    return ret
+
+
+r""" Format a dict of message tags for the wire
+
+>>> format_tags({'label' : 'a b;c'})
+'label=a\\sb\\:c'
+>>> format_tags({'draft/typing' : ''})
+'draft/typing'
+"""
+def format_tags(tags):
+    ret = []
+    for key, value in sorted(tags.items()):
+        if value is None or value == '':
+            ret.append(key)
+            continue
+
+        value = (value.replace('\\', '\\\\').replace(';', '\\:').
+                 replace(' ', '\\s').replace('\r', '\\r').
+                 replace('\n', '\\n'))
+        ret.append('{}={}'.format(key, value))
+
+    return ';'.join(ret)
+
+
+""" Split the parameter part of a line
+
+>>> split_params("loldongs meow :dongs dongs")
+['loldongs', 'meow', 'dongs dongs']
+>>> split_params(":")
+['']
+"""
+def split_params(rest):
+    if rest.startswith(':'):
+        return [rest[1:]]
+
+    # XXX - I don't like partition here like this at all. It might not
+    # handle tab. But it works ok and no server I know of will send anything
+    # else other than space-separated parameters.
+    middle, sep, trailing = rest.partition(' :')
+    params = middle.split()
+    if sep:
+        params.append(trailing)
+
+    return params
+
+
 """ Stores an IRC line
 
+Hostmasks and parameters are parsed lazily, on first access.
+
 >>> repr(Line(line=":lol.org PRIVMSG"))
 'Line(:lol.org PRIVMSG)'
 >>> repr(Line(line="PING"))
@@ -91,89 +207,138 @@ class Hostmask:
 >>> repr(Line(line=":dongs!dongs@lol.org PRIVMSG loldongs meow :dongs"))
 'Line(:dongs!dongs@lol.org PRIVMSG loldongs meow :dongs)'
 """
-class Line:
+class Line(object):
+    # The Batch this line arrived in, if any
+    batch = None
+
+    # Replayed history, not live (skip live-only side effects, e.g. CTCP)
+    replay = False
+
+    # Text (or bytes, going out) as it was on the wire, if known
+    raw = None
+
     def __init__(self, *kargs, **kwargs):
+        self._prefix = None
+        self._rest = None
+
+        line = None
         if len(kargs) == 0:
             line = kwargs.get("line", None)
             self.tags = kwargs.get("tags", None)
+            if isinstance(self.tags, dict):
+                self.tags = format_tags(self.tags) or None
             self.hostmask = kwargs.get("host", None)
             self.command = kwargs.get("command", None)
             self.params = kwargs.get("params", [])
         elif len(kargs) == 1:
             line = kargs[0]
         elif len(kargs) == 2:
+            self.tags = None
+            self.hostmask = None
             self.command = kargs[0]
             self.params = kargs[1]
         else:
+            self.tags = None
+            self.hostmask = None
             self.command = kargs[0]
             self.params = kargs[1:]
 
         if line is not None:
             self.__parse_line(line)
 
-        # In case they're not mutable
-        self.params = list(self.params)
-
         self.cancelled = False
 
+
+    """ Build a line from the output of split_line """
+    @classmethod
+    def from_parts(cls, tags, prefix, command, rest):
+        line = cls.__new__(cls)
+        line._set_parts(tags, prefix, command, rest)
+        line.cancelled = False
+        return line
+
+
+    def _set_parts(self, tags, prefix, command, rest):
+        if not command:
+            raise ValueError('No command in line')
+
+        self.tags = tags or None
+        self.command = command
+
+        # Parsed on demand
+        self._hostmask = None
+        self._prefix = prefix or None
+        self._params = None
+        self._rest = rest
+
+
     def __parse_line(self, line, encoding='UTF-8'):
         if isinstance(line, bytes):
             line = line.decode(encoding)
 
         line = line.rstrip('\r\n')
 
-        # Split out the last param, which might have spaces
-        # If not there, this transformation does nothing
-        # XXX - I don't like partition here like this at all. It might not
-        # handle tab. But it works ok and no server I know of will send anything
-        # else other than space-separated parameters.
-        line, sep, lparam = line.partition(' :')
-
-        # Split
-        sp = deque(x for x in line.split() if x is not None)
-
-        # Do we have tags?
-        if sp[0].startswith('@'):
-            # TODO - more parsing of tags
-            self.tags = sp[0][1:]
-            sp.popleft()
-        else:
-            self.tags = None
+        self._set_parts(*split_line(line))
+        self.raw = line
+
+
+    @property
+    def hostmask(self):
+        if self._prefix is not None:
+            self._hostmask = Hostmask(mask=self._prefix)
+            self._prefix = None
+
+        return self._hostmask
+
+
+    @hostmask.setter
+    def hostmask(self, hostmask):
+        self._prefix = None
+        self._hostmask = hostmask
+
+
+    """ Get a message tag's value (parsed on first use) """
+    def tag(self, name, default=None):
+        tagmap = getattr(self, '_tagmap', None)
+        if tagmap is None or tagmap[0] is not self.tags:
+            tagmap = self._tagmap = (self.tags, parse_tags(self.tags))
+
+        return tagmap[1].get(name, default)
 
-        # Do we have a mask?
-        if sp[0].startswith(':'):
-            self.hostmask = Hostmask(mask=sp[0][1:])
-            sp.popleft()
-        else:
-            self.hostmask = None
 
-        assert len(sp) > 0
+    @property
+    def params(self):
+        if self._rest is not None:
+            self._params = split_params(self._rest)
+            self._rest = None
 
-        # Command next
-        self.command = sp.popleft()
+        return self._params
 
-        # Params?
-        self.params = sp
-        if lparam:
-            # Append
-            self.params.append(lparam)
 
-        # Because deques are poopy and don't support nice things like slicing
-        self.params = list(self.params)
+    @params.setter
+    def params(self, params):
+        # In case they're not mutable
+        self._rest = None
+        self._params = list(params)
+
 
     def __str__(self):
         line = []
+        if self.tags:
+            line.append('@' + self.tags)
+
         if self.hostmask:
             line.append(':' + str(self.hostmask))
 
         line.append(self.command)
 
-        if self.params:
-            if any(x in (' ', ':') for x in self.params[-1]):
-                line.extend(self.params[:-1])
-                line.append(':' + self.params[-1])
+        params = self.params
+        if params:
+            if not params[-1] or any(x in (' ', ':') for x in params[-1]):
+                line.extend(params[:-1])
+                line.append(':' + params[-1])
             else:
-                line.extend(self.params)
+                line.extend(params)
 
         return ' '.join(line) + '\r\n'
 
@@ -183,6 +348,86 @@ class Line:
     def __repr__(self):
          return 'Line({})'.format(str(self))
 
+
+""" Decides which incoming lines are worth parsing at all
+
+Lines are checked on their command and raw prefix only, before a Line is
+built. Commands the library needs for state tracking are never dropped by the
+allow list or the mask list; commands in ignore always are.
+
+allow - if given, only these commands (plus protected ones) pass
+ignore - commands to always drop
+ignore_masks - glob masks of sources whose lines are dropped (only * and ?
+               are wildcards)
+protected - commands exempt from allow and ignore_masks
+casemap - CaseMapping to match masks under (a client sets its own)
+
+>>> f = LineFilter(allow=('PRIVMSG',), ignore_masks=('*!*@spam.example',))
+>>> f.check('NOTICE', 'a!b@c')
+False
+>>> f.check('PRIVMSG', 'a!b@spam.example')
+False
+>>> f.check('QUIT', 'a!b@spam.example')
+True
+>>> f = LineFilter(ignore_masks=('[bot]*!*@*',))
+>>> f.check('PRIVMSG', '{BOT}x!u@h'), f.check('PRIVMSG', 'bx!u@h')
+(False, True)
+"""
+class LineFilter(object):
+    PROTECTED = frozenset(('PING', 'PONG', 'ERROR', 'CAP', 'AUTHENTICATE',
+                           'NICK', 'JOIN', 'PART', 'KICK', 'QUIT', 'MODE',
+                           'TOPIC', 'ACCOUNT', 'AWAY', 'BATCH', 'CHGHOST'))
+
+    def __init__(self, allow=None, ignore=(), ignore_masks=(),
+                 protected=PROTECTED, casemap=None):
+        self.allow = frozenset(c.upper() for c in allow) if allow else None
+        self.ignore = frozenset(c.upper() for c in ignore)
+        self.protected = frozenset(protected)
+
+        self.ignore_masks = list(ignore_masks)
+        self.casemap = casemap if casemap is not None else CaseMapping()
+        self.compile()
+
+        # Statistics
+        self.passed = 0
+        self.dropped = 0
+
+
+    """ Build the mask regex; needed again if the case mapping changes """
+    def compile(self):
+        if not self.ignore_masks:
+            self.mask_re = None
+            return
+
+        fold = self.casemap.fold
+        pattern = '|'.join('(?:{})'.format(glob_pattern(fold(m)))
+                           for m in self.ignore_masks)
+        self.mask_re = re.compile(pattern, re.DOTALL)
+
+
+    """ Return True if a line should be parsed and dispatched """
+    def check(self, command, prefix):
+        command = command.upper()
+        keep = True
+
+        if command in self.ignore:
+            keep = False
+        elif command in self.protected or command.isdigit():
+            pass
+        elif self.allow is not None and command not in self.allow:
+            keep = False
+        elif (self.mask_re is not None and prefix and
+              self.mask_re.match(self.casemap.fold(prefix))):
+            keep = False
+
+        if keep:
+            self.passed += 1
+        else:
+            self.dropped += 1
+
+        return keep
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
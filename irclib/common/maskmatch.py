@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+""" Hostmask (ban/exception/invex) matching """
+
+from __future__ import unicode_literals
+
+import re
+
+from collections import defaultdict
+
+
+r""" Turn an IRC glob into regex source; only * and ? are special
+
+>>> glob_pattern('[bot]*')
+'\\[bot\\].*\\Z'
+"""
+def glob_pattern(glob):
+    pattern = []
+    for char in glob:
+        if char == '*':
+            if not pattern or pattern[-1] != '.*':
+                pattern.append('.*')
+        elif char == '?':
+            pattern.append('.')
+        else:
+            pattern.append(re.escape(char))
+
+    pattern.append(r'\Z')
+    return ''.join(pattern)
+
+
+""" Compile an IRC glob into a regex
+
+>>> compile_glob('*!*@*.example.org').match('n!u@host.example.org') is not None
+True
+>>> compile_glob('n?ck!*@*').match('nick!u@h') is not None
+True
+"""
+def compile_glob(glob):
+    return re.compile(glob_pattern(glob), re.DOTALL)
+
+
+""" Split the literal prefix and suffix off a glob
+
+>>> glob_literals('*!*@*.example.org')
+('', '.example.org')
+>>> glob_literals('nick!*@*')
+('nick!', '')
+"""
+def glob_literals(glob):
+    first = len(glob)
+    last = -1
+    for wildcard in '*?':
+        index = glob.find(wildcard)
+        if index != -1:
+            first = min(first, index)
+        last = max(last, glob.rfind(wildcard))
+
+    if last == -1:
+        # No wildcards at all
+        return glob, glob
+
+    return glob[:first], glob[last+1:]
+
+
+""" Strings a user may be matched as """
+def user_subjects(user, fold):
+    nick = getattr(user, 'nick', None) or '*'
+    username = getattr(user, 'user', None) or '*'
+    subjects = []
+
+    for host in (getattr(user, 'host', None), getattr(user, 'ip', None)):
+        if host:
+            subject = fold('{}!{}@{}'.format(nick, username, host))
+            if subject not in subjects:
+                subjects.append(subject)
+
+    if not subjects:
+        subjects.append(fold('{}!{}@*'.format(nick, username)))
+
+    return subjects
+
+
+""" An index of masks, for matching many masks against users quickly
+
+Masks are bucketed by their longest literal prefix or suffix, so a user is
+only tested against masks that could possibly match. Extended bans (as
+described by the EXTBAN ISUPPORT token) are matched on what they refer to;
+unknown extban types never match.
+
+casemap - CaseMapping to fold with (optional)
+extban - (prefix, types) as parsed from EXTBAN (optional)
+"""
+class MaskIndex(object):
+    # Extban types we understand, by letter; the account type depends on the
+    # style. With a prefix (charybdis $a:, UnrealIRCd ~a:) it's a, but with
+    # none (InspIRCd R:) it's R, and InspIRCd's a: is a mask+realname match.
+    EXTBAN_ACCOUNT = 'a'
+    EXTBAN_ACCOUNT_BARE = 'R'
+    EXTBAN_REALNAME = 'r'
+
+    def __init__(self, casemap=None, extban=None):
+        self.casemap = casemap
+        self.extban = extban
+
+        if extban and not extban[0]:
+            self.extban_account = self.EXTBAN_ACCOUNT_BARE
+        else:
+            self.extban_account = self.EXTBAN_ACCOUNT
+
+        self.masks = set()
+
+        # Literal -> set of masks
+        self.prefixes = defaultdict(set)
+        self.suffixes = defaultdict(set)
+        self.generic = set()
+
+        # Literal lengths in use, with counts
+        self.prefix_lengths = defaultdict(int)
+        self.suffix_lengths = defaultdict(int)
+
+        # Folded mask -> compiled regex
+        self.compiled = dict()
+
+        # Mask -> (negate, type, arg)
+        self.extbans = dict()
+
+
+    def fold(self, string):
+        if self.casemap is None:
+            return string.lower()
+
+        return self.casemap.fold(string)
+
+
+    """ Parse an extban, returning (negate, type, arg), or None """
+    def parse_extban(self, mask):
+        if not self.extban:
+            return None
+
+        prefix, types = self.extban
+        if prefix:
+            if not mask.startswith(prefix):
+                return None
+            rest = mask[len(prefix):]
+        else:
+            # e.g. InspIRCd, where extbans look like R:account
+            if len(mask) < 2 or mask[1] != ':':
+                return None
+            rest = mask
+
+        negate = rest.startswith('~')
+        if negate:
+            rest = rest[1:]
+
+        if not rest or rest[0] not in types:
+            return None
+
+        extype, sep, arg = rest.partition(':')
+        if len(extype) != 1:
+            return None
+
+        return negate, extype, arg if sep else None
+
+
+    def __contains__(self, mask):
+        return mask in self.masks
+
+
+    def __len__(self):
+        return len(self.masks)
+
+
+    def __iter__(self):
+        return iter(self.masks)
+
+
+    """ Add a mask """
+    def add(self, mask):
+        if mask in self.masks:
+            return
+
+        self.masks.add(mask)
+
+        extban = self.parse_extban(mask)
+        if extban is not None:
+            self.extbans[mask] = extban
+            return
+
+        folded = self.fold(mask)
+        self.compiled[mask] = compile_glob(folded)
+
+        prefix, suffix = glob_literals(folded)
+        if prefix and len(prefix) >= len(suffix):
+            self.prefixes[prefix].add(mask)
+            self.prefix_lengths[len(prefix)] += 1
+        elif suffix:
+            self.suffixes[suffix].add(mask)
+            self.suffix_lengths[len(suffix)] += 1
+        else:
+            self.generic.add(mask)
+
+
+    """ Remove a mask """
+    def remove(self, mask):
+        if mask not in self.masks:
+            return
+
+        self.masks.discard(mask)
+        if self.extbans.pop(mask, None) is not None:
+            return
+
+        del self.compiled[mask]
+
+        folded = self.fold(mask)
+        prefix, suffix = glob_literals(folded)
+        if prefix and len(prefix) >= len(suffix):
+            buckets, lengths, key = self.prefixes, self.prefix_lengths, prefix
+        elif suffix:
+            buckets, lengths, key = self.suffixes, self.suffix_lengths, suffix
+        else:
+            self.generic.discard(mask)
+            return
+
+        buckets[key].discard(mask)
+        if not buckets[key]:
+            del buckets[key]
+
+        lengths[len(key)] -= 1
+        if not lengths[len(key)]:
+            del lengths[len(key)]
+
+
+    """ Remove all masks """
+    def clear(self):
+        self.__init__(self.casemap, self.extban)
+
+
+    """ Masks that could match a subject string """
+    def candidates(self, subject):
+        found = set(self.generic)
+
+        for length in self.prefix_lengths:
+            bucket = self.prefixes.get(subject[:length], None)
+            if bucket:
+                found.update(bucket)
+
+        for length in self.suffix_lengths:
+            if length > len(subject):
+                continue
+
+            bucket = self.suffixes.get(subject[-length:], None)
+            if bucket:
+                found.update(bucket)
+
+        return found
+
+
+    """ Check an extban against a user """
+    def match_extban(self, extban, user):
+        negate, extype, arg = extban
+
+        if extype == self.extban_account:
+            account = getattr(user, 'account', None)
+            if arg is None:
+                # Any logged in user
+                matched = bool(account)
+            else:
+                matched = bool(account) and (self.fold(account) ==
+                                             self.fold(arg))
+        elif extype == self.EXTBAN_REALNAME:
+            realname = getattr(user, 'realname', None)
+            matched = (realname is not None and arg is not None and
+                       compile_glob(self.fold(arg)).match(self.fold(realname))
+                       is not None)
+        else:
+            # Don't know how to match this
+            return False
+
+        return matched != negate
+
+
+    """ Return the masks that match a user (anything with nick, user, host,
+    and optionally ip, account, and realname attributes, e.g. User or
+    Hostmask)
+    """
+    def match(self, user):
+        matched = []
+
+        for subject in user_subjects(user, self.fold):
+            for mask in self.candidates(subject):
+                if mask in matched:
+                    continue
+
+                if self.compiled[mask].match(subject) is not None:
+                    matched.append(mask)
+
+        for mask, extban in self.extbans.items():
+            if self.match_extban(extban, user):
+                matched.append(mask)
+
+        return matched
+
+
+    """ Check if any mask matches a user """
+    def matches(self, user):
+        return bool(self.match(user))
+
+
+""" Return the users (from an iterable) matching a single mask """
+def users_matching(mask, users, casemap=None, extban=None):
+    index = MaskIndex(casemap, extban)
+    index.add(mask)
+    return [user for user in users if index.matches(user)]
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+
+""" Measurement helpers, and a metrics registry with a Prometheus exporter """
+
+from __future__ import unicode_literals, division
+
+from bisect import bisect_left
+from collections import deque, OrderedDict
+from math import ceil
+from threading import RLock, Thread
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+
+""" Rolling window of samples, with percentiles
+
+Only the last window samples are kept; percentiles are worked out when asked
+for, so adding a sample is cheap.
+
+>>> h = RollingHistogram(4)
+>>> for x in (5, 1, 4, 2, 3):
+...     h.add(x)
+>>> h.percentile(50), h.percentile(100), h.count
+(2, 4, 5)
+"""
+class RollingHistogram(object):
+    def __init__(self, window=1024):
+        self.samples = deque(maxlen=window)
+        self.lock = RLock()
+
+        # Samples ever added, and their sum
+        self.count = 0
+        self.total = 0
+
+
+    def __len__(self):
+        return len(self.samples)
+
+
+    """ Add a sample """
+    def add(self, value):
+        with self.lock:
+            self.samples.append(value)
+            self.count += 1
+            self.total += value
+
+
+    """ Get the pth percentile of the window (nearest rank), or None """
+    def percentile(self, p):
+        with self.lock:
+            samples = sorted(self.samples)
+
+        return self.rank(samples, p)
+
+
+    @staticmethod
+    def rank(samples, p):
+        if not samples:
+            return None
+
+        index = int(ceil(p / 100 * len(samples))) - 1
+        return samples[min(max(index, 0), len(samples) - 1)]
+
+
+    """ Return statistics for the window """
+    def metrics(self, percentiles=(50, 95, 99)):
+        with self.lock:
+            samples = sorted(self.samples)
+            count = self.count
+
+        ret = {
+            'count' : count,
+            'window' : len(samples),
+        }
+
+        if samples:
+            ret['min'] = samples[0]
+            ret['max'] = samples[-1]
+            ret['mean'] = sum(samples) / len(samples)
+            for p in percentiles:
+                ret['p{}'.format(p)] = self.rank(samples, p)
+
+        return ret
+
+
+""" Format a sample value the way Prometheus likes """
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+
+    return str(value)
+
+
+""" Escape a label value """
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+""" Render a sample line """
+def format_sample(name, labels, value):
+    if not labels:
+        return '{} {}'.format(name, format_value(value))
+
+    pairs = ','.join('{}="{}"'.format(k, escape_label(v)) for k, v in labels)
+    return '{}{{{}}} {}'.format(name, pairs, format_value(value))
+
+
+""" Base of all metrics
+
+name - metric name
+help - description
+labels - label names; values are given as a tuple in the same order
+
+Besides values set directly, a metric can track callbacks (see track), which
+are only called when the metric is collected.
+"""
+class Metric(object):
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = RLock()
+
+        # Label values -> value
+        self.values = OrderedDict()
+
+        # Label values -> callback
+        self.callbacks = OrderedDict()
+
+
+    """ Report the result of function under the given label values
+
+    function may return None to leave the sample out.
+    """
+    def track(self, function, labels=()):
+        with self.lock:
+            self.callbacks[tuple(labels)] = function
+
+
+    """ Stop tracking a callback """
+    def untrack(self, labels=()):
+        with self.lock:
+            self.callbacks.pop(tuple(labels), None)
+
+
+    """ Get (label values, value) for everything """
+    def items(self):
+        with self.lock:
+            items = list(self.values.items())
+            callbacks = list(self.callbacks.items())
+
+        for labels, function in callbacks:
+            value = function()
+            if value is not None:
+                items.append((labels, value))
+
+        return items
+
+
+    """ Yield (name, label pairs, value) samples """
+    def samples(self):
+        for labels, value in self.items():
+            yield self.name, tuple(zip(self.labels, labels)), value
+
+
+""" A value that only goes up """
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+""" A value that goes up and down """
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+
+""" Bucketed distribution of observations
+
+buckets - upper bounds, ascending (+Inf is added)
+"""
+class Histogram(Metric):
+    type = 'histogram'
+
+    DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                       0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+
+    """ Record an observation """
+    def observe(self, value, labels=()):
+        with self.lock:
+            state = self.values.get(labels, None)
+            if state is None:
+                # [bucket counts..., sum]
+                state = self.values[labels] = [0] * len(self.buckets) + [0]
+
+            state[bisect_left(self.buckets, value)] += 1
+            state[-1] += value
+
+
+    def samples(self):
+        with self.lock:
+            items = [(labels, list(state)) for labels, state in
+                     self.values.items()]
+
+        for labels, state in items:
+            pairs = tuple(zip(self.labels, labels))
+            count = 0
+            for bound, bucket in zip(self.buckets, state):
+                count += bucket
+                yield (self.name + '_bucket', pairs + (('le', format_value(
+                    float(bound))),), count)
+
+            yield self.name + '_sum', pairs, state[-1]
+            yield self.name + '_count', pairs, count
+
+
+""" Quantiles over a RollingHistogram, worked out when collected
+
+Values (or callbacks) are RollingHistogram instances.
+"""
+class Summary(Metric):
+    type = 'summary'
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def set(self, histogram, labels=()):
+        with self.lock:
+            self.values[labels] = histogram
+
+
+    def samples(self):
+        for labels, histogram in self.items():
+            pairs = tuple(zip(self.labels, labels))
+            with histogram.lock:
+                samples = sorted(histogram.samples)
+                count = histogram.count
+                total = histogram.total
+
+            if samples:
+                for q in self.QUANTILES:
+                    yield (self.name, pairs + (('quantile', str(q)),),
+                           RollingHistogram.rank(samples, q * 100))
+
+            yield self.name + '_sum', pairs, total
+            yield self.name + '_count', pairs, count
+
+
+""" A set of named metrics
+
+Asking for a metric that exists returns the existing one, so several clients
+can share a registry.
+
+>>> registry = MetricsRegistry()
+>>> lines = registry.counter('lines_total', 'Lines seen', ('command',))
+>>> lines.inc(labels=('PRIVMSG',))
+>>> print(registry.render().strip())
+# HELP lines_total Lines seen
+# TYPE lines_total counter
+lines_total{command="PRIVMSG"} 1
+"""
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.lock = RLock()
+
+
+    """ Add a metric, or get the one already registered under its name """
+    def register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name, None)
+            if existing is None:
+                self.metrics[metric.name] = metric
+                return metric
+
+            if type(existing) is not type(metric):
+                raise ValueError('Metric {} already registered as a {}'.format(
+                    metric.name, existing.type))
+
+            return existing
+
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+
+    def histogram(self, name, help, labels=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+
+    def summary(self, name, help, labels=()):
+        return self.register(Summary(name, help, labels))
+
+
+    def get(self, name, default=None):
+        return self.metrics.get(name, default)
+
+
+    """ Return {sample name: {label pairs: value}} for every sample """
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        ret = dict()
+        for metric in metrics:
+            for name, labels, value in metric.samples():
+                ret.setdefault(name, dict())[labels] = value
+
+        return ret
+
+
+    """ Render every metric in the Prometheus text format """
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        out = []
+        for metric in metrics:
+            out.append('# HELP {} {}'.format(metric.name, metric.help))
+            out.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                out.append(format_sample(name, labels, value))
+
+        out.append('')
+        return '\n'.join(out)
+
+
+class _MetricsHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; '
+                         'charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+""" Serve a registry over HTTP for Prometheus to scrape
+
+Runs in a daemon thread; port 0 picks a free port (see port).
+"""
+class MetricsServer(object):
+    def __init__(self, registry, host='', port=9100):
+        self.registry = registry
+        self.address = (host, port)
+        self.server = None
+        self.thread = None
+
+
+    @property
+    def port(self):
+        return self.server.server_address[1] if self.server else None
+
+
+    def start(self):
+        if self.server is not None:
+            return
+
+        self.server = _MetricsHTTPServer(self.address, _MetricsHandler)
+        self.server.registry = self.registry
+        self.thread = Thread(target=self.server.serve_forever,
+                             name='irclib_metrics')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def stop(self):
+        if self.server is None:
+            return
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        self.thread = None
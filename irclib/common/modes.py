@@ -1,119 +1,318 @@
-from collections import Sequence
-from itertools import chain
+import warnings
 
-class ModeSet:
+from collections import OrderedDict
+
+from irclib.common.casemap import CaseFoldDict
+
+# Mode classes
+MODE_SIMPLE = 0
+MODE_SET = 1
+MODE_UNSET = 2
+MODE_BOTH = 3
+MODE_LIST = 4
+MODE_PREFIX = 5
+
+""" Immutable mode definitions, shared between ModeSets
+
+p_set - modes that take a param only when set (+k)
+p_unset - modes that take a param only when unset (normally unused)
+p_both - modes that take a param when set and unset
+p_list - modes which are list modes
+p_prefix - modes which are status modes (+ov), highest rank first
+
+>>> spec = ModeSpec(p_list='beI', p_both='k', p_set='l', p_prefix='ov')
+>>> spec.classify('v') == MODE_PREFIX
+True
+"""
+class ModeSpec(object):
+    __slots__ = ('p_set', 'p_unset', 'p_both', 'p_list', 'p_prefix',
+                 'mode_class', 'prefix_bits')
+
+    def __init__(self, p_set='', p_unset='', p_both='', p_list='',
+                 p_prefix=''):
+        mode_class = dict()
+        for modes, cls in ((p_set, MODE_SET), (p_unset, MODE_UNSET),
+                           (p_both, MODE_BOTH), (p_list, MODE_LIST),
+                           (p_prefix, MODE_PREFIX)):
+            for m in modes:
+                mode_class[m] = cls
+
+        prefix_bits = {m : 1 << i for i, m in enumerate(p_prefix)}
+
+        for name, value in (('p_set', p_set), ('p_unset', p_unset),
+                            ('p_both', p_both), ('p_list', p_list),
+                            ('p_prefix', p_prefix),
+                            ('mode_class', mode_class),
+                            ('prefix_bits', prefix_bits)):
+            object.__setattr__(self, name, value)
+
+
+    """ Build a spec for channel modes from ISUPPORT """
+    @classmethod
+    def from_isupport(cls, isupport):
+        p_prefix = ''.join(p[0] for p in isupport.get('PREFIX', ()))
+
+        chanmodes = isupport.get('CHANMODES', [])
+        if not isinstance(chanmodes, (list, tuple)):
+            # Only one group
+            chanmodes = [chanmodes]
+
+        # A = list, B = always param, C = param when set, D = no param
+        p_list, p_both, p_set = (list(chanmodes) + ['', '', ''])[:3]
+
+        return cls(p_set=p_set, p_both=p_both, p_list=p_list,
+                   p_prefix=p_prefix)
+
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ModeSpec is immutable')
+
+
+    def __eq__(self, other):
+        if not isinstance(other, ModeSpec):
+            return NotImplemented
+
+        return self.key() == other.key()
+
+
+    def __ne__(self, other):
+        return not self == other
+
+
+    def __hash__(self):
+        return hash(self.key())
+
+
+    def key(self):
+        return (self.p_set, self.p_unset, self.p_both, self.p_list,
+                self.p_prefix)
+
+
+    """ Get the class of a mode (MODE_SIMPLE if unknown) """
+    def classify(self, mode):
+        return self.mode_class.get(mode, MODE_SIMPLE)
+
+
+class ModeSet(object):
     """ Initalise
 
+    spec - ModeSpec to use; if None, one is built from the params below
     p_set - modes that take a param only when set (+k)
     p_unset - modes that take a param only when unset (normally unused)
     p_both - modes that take a param when set and unset
     p_list - modes which are list modes
-    p_prefix - modes which are status modes (+ov)
+    p_prefix - modes which are status modes (+ov), highest rank first
+    casemap - CaseMapping to key status modes with (optional)
+
+    List modes are stored as insertion-ordered sets. Status modes are stored as
+    a bitmask per nick, in self.prefixes; self.prefix_nicks has the nicks as
+    they were given.
     """
     def __init__(self, p_set='', p_unset='', p_both='', p_list='',
-                 p_prefix=''):
-        self.p_set = p_set
-        self.p_unset = p_unset
-        self.p_both = p_both
-        self.p_list = p_list
-        self.p_prefix = p_prefix
+                 p_prefix='', casemap=None, spec=None):
+        if spec is None:
+            spec = ModeSpec(p_set, p_unset, p_both, p_list, p_prefix)
 
+        self.spec = spec
         self.modes = dict()
 
         # Lists
-        for m in chain(self.p_list, self.p_prefix):
-            self.modes[m] = list()
+        for m in spec.p_list:
+            self.modes[m] = OrderedDict()
+
+        # Status modes, nick -> bitmask, and nick -> nick as given
+        if casemap is not None:
+            self.prefixes = CaseFoldDict(casemap)
+            self.prefix_nicks = CaseFoldDict(casemap)
+        else:
+            self.prefixes = dict()
+            self.prefix_nicks = dict()
+
+
+    """ Switch to a new ModeSpec, keeping what state still makes sense """
+    def rebind(self, spec):
+        old = self.spec
+        if spec is old:
+            return
+
+        # Move status modes to their new bits
+        prefixes = self.prefixes.copy()
+        prefix_nicks = self.prefix_nicks.copy()
+        for nick, bits in self.prefixes.items():
+            newbits = 0
+            for m, bit in old.prefix_bits.items():
+                if bits & bit and m in spec.prefix_bits:
+                    newbits |= spec.prefix_bits[m]
+
+            if newbits:
+                prefixes[nick] = newbits
+            else:
+                del prefixes[nick]
+                prefix_nicks.pop(nick, None)
+
+        modes = dict()
+        for m, value in self.modes.items():
+            cls = spec.classify(m)
+            if isinstance(value, OrderedDict):
+                if cls == MODE_LIST:
+                    modes[m] = value
+            elif cls < MODE_LIST:
+                modes[m] = value
+
+        for m in spec.p_list:
+            if m not in modes:
+                modes[m] = OrderedDict()
+
+        self.modes = modes
+        self.prefixes = prefixes
+        self.prefix_nicks = prefix_nicks
+        self.spec = spec
+
+
+    """ Re-fold status mode nicks, after the case mapping changes """
+    def rekey(self):
+        if isinstance(self.prefixes, CaseFoldDict):
+            self.prefixes.rekey()
+            self.prefix_nicks.rekey()
+
+
+    @property
+    def p_prefix(self):
+        return self.spec.p_prefix
 
 
     """ Does this mode use a param? """
     def use_param(self, mode, adding):
+        cls = self.spec.classify(mode)
+
         # Unconditional param use
-        if mode in chain(self.p_both, self.p_list, self.p_prefix):
+        if cls >= MODE_BOTH:
             return True
 
         if adding:
-            if mode in self.p_set: 
-                return True
+            return cls == MODE_SET
         else:
-            if mode in self.p_unset:
-                return True
-
-        return False
+            return cls == MODE_UNSET
 
 
     """ Match up a list mode
-    
+
+    Returns the stored entry, or False if there is none.
     NOTE - no pattern matching is done, yet.
     """
     def list_match(self, mode, param):
-        if not isinstance(self.modes[mode], list):
+        cls = self.spec.classify(mode)
+        if cls == MODE_PREFIX:
+            if self.prefixes.get(param, 0) & self.spec.prefix_bits[mode]:
+                return param
+
+            return False
+        elif cls != MODE_LIST:
             return # -.-
 
         if param == None:
             return # nothing to do
-        
-        for index, item in enumerate(self.modes[mode]):
-            if param == item: return index
+
+        if param in self.modes[mode]:
+            return param
 
         return False
 
 
-    """ Add a list mode """
+    """ Add a list mode; returns True if it wasn't already set """
     def add_listmode(self, mode, param):
-        match = self.list_match(mode, param)
-        if match is not False:
-            return
+        if self.spec.classify(mode) == MODE_PREFIX:
+            bit = self.spec.prefix_bits[mode]
+            bits = self.prefixes.get(param, 0)
+            if bits & bit:
+                return False
 
-        self.modes[mode].append(param)
+            self.prefixes[param] = bits | bit
+            self.prefix_nicks[param] = param
+            return True
 
+        modelist = self.modes[mode]
+        if param in modelist:
+            return False
 
-    """ Delete a list mode """
+        modelist[param] = True
+        return True
+
+
+    """ Delete a list mode; returns True if it was set """
     def del_listmode(self, mode, param):
-        match = self.list_match(mode, param) 
-        if match is None or match is False:
-            return
+        if self.spec.classify(mode) == MODE_PREFIX:
+            bit = self.spec.prefix_bits[mode]
+            bits = self.prefixes.get(param, 0)
+            if not bits & bit:
+                return False
+
+            bits &= ~bit
+            if bits:
+                self.prefixes[param] = bits
+            else:
+                self.prefixes.pop(param, None)
+                self.prefix_nicks.pop(param, None)
+            return True
 
-        del self.modes[mode][match]
+        return self.modes[mode].pop(param, None) is not None
 
 
-    """ Add a mode """
+    """ Add a mode; returns True if anything changed """
     def add_mode(self, mode, param):
-        if mode in chain(self.p_list, self.p_prefix):
+        if self.spec.classify(mode) >= MODE_LIST:
             return self.add_listmode(mode, param)
-        
+
+        if self.modes.get(mode, None) == param:
+            return False
+
         self.modes[mode] = param
+        return True
 
 
-    """ Delete a mode """
+    """ Delete a mode; returns True if anything changed """
     def del_mode(self, mode, param):
-        if mode in chain(self.p_list, self.p_prefix):
+        if self.spec.classify(mode) >= MODE_LIST:
             return self.del_listmode(mode, param)
 
-        try:
-            del self.modes[mode]
-        except:
-            pass
+        return self.modes.pop(mode, None) is not None
 
 
-    """ Set a mode """
+    """ Set a mode; returns True if anything changed """
     def set_mode(self, mode, adding, param):
         if adding:
-            self.add_mode(mode, param)
+            return self.add_mode(mode, param)
         else:
-            self.del_mode(mode, param)
+            return self.del_mode(mode, param)
 
 
-    """ Parse a modestring """
-    def parse_modestring(self, string):
-        # Split the params up
-        split = string.split()
-        modes = split[0]
-        if len(split) > 1:
-            params = split[1:]
-        else:
-            params = []
+    """ Check if set_mode would change anything, without changing it
+
+    Parameter modes are only unchanged by being set to the value they have.
+    """
+    def would_change(self, mode, adding, param):
+        if self.spec.classify(mode) >= MODE_LIST:
+            return bool(self.list_match(mode, param)) != adding
+
+        if adding:
+            return self.modes.get(mode, None) != param
+
+        return mode in self.modes
+
+
+    """ Apply a mode change from a mode string and its parameters
+
+    modes - the mode string, e.g. '+ov-b'
+    params - the list of parameters
+
+    Returns a list of (adding, mode, param) for each change that actually
+    altered state; param is True for modes without one.
+    """
+    def apply(self, modes, params=()):
+        changes = []
+        use_param = self.use_param
+        set_mode = self.set_mode
 
-        # Parse the mode string
         adding = True # default
         pindex = 0
         plen = len(params)
@@ -126,39 +325,130 @@ class ModeSet:
                 # I've seen some crappy ircd's use this :|
                 continue
             else:
-                if self.use_param(mode, adding):
-                    if (pindex+1) > plen:
+                if use_param(mode, adding):
+                    if pindex >= plen:
                         warnings.warn('Unexpected parameter')
                         continue
                     param = params[pindex]
                     pindex += 1
                 else:
-                    param = True 
+                    param = True
 
-                self.set_mode(mode, adding, param)
+                if set_mode(mode, adding, param):
+                    changes.append((adding, mode, param))
 
-        if plen > (pindex+1):
+        if plen > pindex:
             warnings.warn('Excessive parameters passed')
 
+        return changes
+
+
+    """ Parse a modestring """
+    def parse_modestring(self, string):
+        # Split the params up
+        split = string.split()
+        if not split:
+            return []
+
+        return self.apply(split[0], split[1:])
+
 
     """ Check if a mode is set """
     def is_set(self, mode, param=None):
-        if mode in chain(self.p_list, self.p_prefix):
+        cls = self.spec.classify(mode)
+        if cls == MODE_PREFIX:
+            bit = self.spec.prefix_bits[mode]
+            if not param:
+                # Return nick list
+                nicks = self.prefix_nicks
+                return [dict.get(nicks, n, n) for n, b in self.prefixes.items()
+                        if b & bit]
+
+            return self.list_match(mode, param)
+        elif cls == MODE_LIST:
             # List modes
             if not param:
                 # Return param list
-                return self.modes[mode]
-
-            match = self.list_match(mode, param)
-            if isinstance(match, int):
-                # We got a match!
-                return self.modes[mode][match]
+                return list(self.modes[mode])
 
-            # Failure :(
-            return match
+            # Failure is False
+            return self.list_match(mode, param)
         else:
             if mode not in self.modes:
                 return False
 
             return self.modes[mode]
 
+
+    """ Get status modes for a nick, highest rank first """
+    def get_prefix(self, nick):
+        bits = self.prefixes.get(nick, 0)
+        prefix_bits = self.spec.prefix_bits
+        return ''.join(m for m in self.spec.p_prefix if bits & prefix_bits[m])
+
+
+    """ Forget status modes for a nick """
+    def prefix_remove(self, nick):
+        self.prefixes.pop(nick, None)
+        self.prefix_nicks.pop(nick, None)
+
+
+    """ Move status modes for a nick to a new nick """
+    def prefix_rename(self, oldnick, newnick):
+        bits = self.prefixes.pop(oldnick, 0)
+        self.prefix_nicks.pop(oldnick, None)
+        if bits:
+            self.prefixes[newnick] = bits
+            self.prefix_nicks[newnick] = newnick
+
+
+""" Pack mode changes into as few MODE lines as possible
+
+changes - list of (adding, mode, param); param is True for no param
+maxmodes - maximum modes with a parameter per line (MODES ISUPPORT token)
+maxlen - maximum length of the mode string and params
+
+Returns a list of (modestring, params).
+
+>>> pack_mode_changes([(True, 'v', 'a'), (True, 'v', 'b'), (False, 'o', 'c'),
+...                    (True, 'n', True)], 2, 400)
+[('+vv', ['a', 'b']), ('-o+n', ['c'])]
+"""
+def pack_mode_changes(changes, maxmodes=3, maxlen=400):
+    ret = []
+    modestr = []
+    params = []
+    length = 0
+    sign = None
+
+    for adding, mode, param in changes:
+        newsign = '+' if adding else '-'
+        add = len(mode) + (1 if newsign != sign else 0)
+        if param is not True:
+            add += len(param) + 1
+
+        full = (param is not True and len(params) >= maxmodes)
+        if modestr and (full or length + add > maxlen):
+            ret.append((''.join(modestr), params))
+            modestr = []
+            params = []
+            length = 0
+            sign = None
+            add = len(mode) + 1
+            if param is not True:
+                add += len(param) + 1
+
+        if newsign != sign:
+            modestr.append(newsign)
+            sign = newsign
+
+        modestr.append(mode)
+        if param is not True:
+            params.append(param)
+
+        length += add
+
+    if modestr:
+        ret.append((''.join(modestr), params))
+
+    return ret
@@ -2,6 +2,8 @@ from string import ascii_letters, digits
 from random import choice, randint
 from os import strerror
 from socket import error as SocketError
+from calendar import timegm
+from datetime import datetime
 
 """ Generate a random string """
 def randomstr(minlen=6, maxlen=30):
@@ -24,3 +26,19 @@ def socketerror(error, errstr=None, instance=None):
 def splitstr(buf, length):
     return [buf[i:i+length] for i in range(0, len(buf), length)]
 
+
+
+""" Parse an IRCv3 server-time tag value into a UNIX timestamp
+
+Returns None if the value can't be parsed.
+"""
+def parse_server_time(value):
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ'):
+        try:
+            stamp = datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            continue
+
+        return timegm(stamp.timetuple()) + stamp.microsecond / 1000000.0
+
+    return None
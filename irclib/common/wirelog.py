@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+""" Logging of lines on the wire, kept off the I/O path """
+
+from __future__ import unicode_literals
+
+import atexit
+import logging
+import sys
+
+from threading import RLock
+from time import time
+
+from irclib.common.colourmap import replace_colours
+
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+    # Python 2; records are written as they come
+    QueueHandler = QueueListener = None
+
+
+# Logger lines go to; raise its level above INFO to turn wire logging off
+WIRE_LOGGER = 'irclib.wire'
+
+
+""" A line to log, formatted only if and when it is written
+
+raw is the text (or bytes) as it was on the wire, if known; otherwise the
+line is rendered.
+"""
+class WireRecord(object):
+    __slots__ = ('line', 'raw', 'recv', 'created')
+
+    def __init__(self, line, raw, recv):
+        self.line = line
+        self.raw = raw
+        self.recv = recv
+        self.created = time()
+
+
+    def __str__(self):
+        raw = self.raw
+        if raw is None:
+            raw = str(self.line)
+        elif isinstance(raw, bytes):
+            raw = raw.decode('utf-8', 'replace')
+
+        raw = raw.rstrip('\r\n')
+        if self.line.command in ('PRIVMSG', 'NOTICE'):
+            raw = replace_colours(raw)
+
+        return '{} {}'.format('>' if self.recv else '<', raw)
+
+
+if QueueHandler is not None:
+    """ Queues records untouched, so they're formatted by the listener """
+    class DeferredQueueHandler(QueueHandler):
+        def __init__(self, queue):
+            QueueHandler.__init__(self, queue)
+            self.dropped = 0
+
+
+        def prepare(self, record):
+            return record
+
+
+        def enqueue(self, record):
+            try:
+                self.queue.put_nowait(record)
+            except Full:
+                # Better to lose log lines than to stall I/O
+                self.dropped += 1
+
+
+    """ Turns queued WireRecords into LogRecords, in the listener thread """
+    class WireListener(QueueListener):
+        def __init__(self, logger, level, queue, *handlers):
+            QueueListener.__init__(self, queue, *handlers)
+            self.logger = logger
+            self.level = level
+
+
+        def prepare(self, record):
+            if not isinstance(record, WireRecord):
+                return record
+
+            created = record.created
+            record = self.logger.makeRecord(self.logger.name, self.level, '',
+                                            0, '%s', (record,), None)
+            record.created = created
+            record.msecs = (created - int(created)) * 1000
+            return record
+
+
+""" Writes wire lines through a background thread
+
+Lines are queued as they are, and a QueueListener thread makes log records
+of them, formats them, and writes them; so the I/O path only pays for
+queueing. Anything else logged to the wire logger goes through the same
+queue, by way of a QueueHandler. If the logger isn't enabled for level,
+nothing at all is done.
+
+logger - Logger to use (default the irclib.wire logger)
+level - level to log lines at (default INFO)
+handlers - handlers to write to (default a StreamHandler on stdout)
+queue_size - lines buffered before new ones are dropped (default 10000)
+"""
+class WireLogger(object):
+    def __init__(self, logger=None, level=logging.INFO, handlers=None,
+                 queue_size=10000):
+        self.logger = logger if logger is not None else \
+                      logging.getLogger(WIRE_LOGGER)
+        self.level = level
+
+        # On unless configured otherwise
+        if self.logger.level == logging.NOTSET:
+            self.logger.setLevel(level)
+
+        if handlers is None:
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            handlers = (handler,)
+
+        self.handlers = tuple(handlers)
+        self.queue_size = queue_size
+        self.queue = None
+        self.handler = None
+        self.listener = None
+        self.lock = RLock()
+
+        # Lines lost to a full queue
+        self.overflow = 0
+
+
+    """ Start the background writer (done on first use) """
+    def start(self):
+        with self.lock:
+            if self.queue is not None:
+                return
+
+            # Wire lines don't belong in the application's log
+            self.logger.propagate = False
+
+            if QueueHandler is None:
+                self.queue = False
+                for handler in self.handlers:
+                    self.logger.addHandler(handler)
+
+                return
+
+            self.queue = Queue(self.queue_size)
+            self.handler = DeferredQueueHandler(self.queue)
+            self.listener = WireListener(self.logger, self.level, self.queue,
+                                         *self.handlers)
+            self.listener.start()
+            self.logger.addHandler(self.handler)
+            atexit.register(self.stop)
+
+
+    """ Stop the background writer, writing out what's queued """
+    def stop(self):
+        with self.lock:
+            if self.queue is None:
+                return
+
+            if self.listener is not None:
+                self.logger.removeHandler(self.handler)
+                self.listener.stop()
+            else:
+                for handler in self.handlers:
+                    self.logger.removeHandler(handler)
+
+            self.queue = None
+            self.handler = None
+            self.listener = None
+
+
+    """ Is anything going to be written? """
+    def enabled(self):
+        return self.logger.isEnabledFor(self.level)
+
+
+    """ Log a line; raw is its wire text or bytes, if known """
+    def log(self, line, raw, recv):
+        if not self.logger.isEnabledFor(self.level):
+            return
+
+        queue = self.queue
+        if queue is None:
+            self.start()
+            queue = self.queue
+
+        if queue is False:
+            # No background writer to be had
+            self.logger.log(self.level, '%s', WireRecord(line, raw, recv))
+            return
+
+        try:
+            queue.put_nowait(WireRecord(line, raw, recv))
+        except Full:
+            # Better to lose log lines than to stall I/O
+            self.overflow += 1
+
+
+    """ Lines dropped because the writer couldn't keep up """
+    @property
+    def dropped(self):
+        return self.overflow + getattr(self.handler, 'dropped', 0)
+
+
+_default = None
+_default_lock = RLock()
+
+""" The WireLogger shared by clients that aren't given one """
+def default_wire_logger():
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = WireLogger()
+
+        return _default
@@ -20,6 +20,8 @@ setup(name=PKGNAME,
       version='0.01-alpha',
       keywords=['irc', 'protocol'],
       packages=find_packages(),
+      # concurrent.futures, on Python 2
+      install_requires=['futures; python_version < "3"'],
       classifiers=[
           'Development Status :: 2 - Pre-Alpha',
           'Intended Audience :: Developers',